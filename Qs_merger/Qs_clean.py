@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Cleaning the final Qs frame of a period (secondary_error_check):
+#   1) rows with any nan value are set to entirely nan (except the timestamp)
+#   2) rows with a value above its column's cutoff are trimmed (set to nan).
+#      The 'Bedload all' values of the trimmed rows are kept for the log,
+#      along with the total bedload before trimming.
+#   3) the timestamps of the rows where chunks overlapped are collected
+#
+# The 'pandas' engine is the original: an isnull frame, a .loc assignment, a
+# cutoff mask, another .loc assignment, and a separate pass for the overlap.
+# Each step makes a frame (or column) sized mask and reads the whole frame.
+#
+# The 'fused' engine does all three in one pass over the frame's float64
+# array, a block of rows at a time, writing the nans in place. The only masks
+# are block sized, so a block stays in the CPU cache while every step runs on
+# it. Under pandas copy-on-write a frame never hands out writable values, so
+# the caller passes the array the frame was built on if it owns it (the
+# combined frame's array, see Qs_combine.py). Other frames that aren't one
+# writable float64 array (eg. compact dtypes, see Qs_dtypes.py, or a raw Qs
+# frame) are cleaned in a float64 copy that becomes the cleaned frame.
+#
+# Both engines give the same frame and results. Cutoffs are {column : max},
+# so any column can be trimmed. The default is only 'Bedload all' (see
+# column_cutoffs in settings.py). Qs_stream.py cleans its blocks with
+# clean_block too.
+
+import numpy as np
+import pandas as pd
+
+import Qs_dtypes
+
+clean_engines = ['pandas', 'fused']
+
+# Columns from here on are set to nan by the cleaning
+first_clean_column = 'missing ratio'
+bedload_column = 'Bedload all'
+
+# Rows per block for the fused engine. 44 float64 columns * 4096 rows is
+# about 1.4 MB.
+default_block_rows = 4096
+
+
+def make_cutoffs(cutoffs):
+    # A single number is the 'Bedload all' cutoff, like the old
+    # lighttable_bedload_cutoff setting
+    if isinstance(cutoffs, dict):
+        return dict(cutoffs)
+    return {bedload_column : cutoffs}
+
+def describe_cutoffs(cutoffs):
+    # For the log
+    if list(cutoffs) == [bedload_column]:
+        return f"{cutoffs[bedload_column]}"
+    return ', '.join(f"{value} ({column})" for column, value in cutoffs.items())
+
+
+class CleaningResult:
+    # What the cleaning found in one period (or a stream of blocks)
+
+    def __init__(self, cutoffs):
+        self.cutoffs = cutoffs
+        self.trim_counts = {column : 0 for column in cutoffs}
+        self.total_bedload = 0.0 # before trimming
+        self._trim_vals = []
+        self._overlap_rows = []
+
+    def get_trim_vals(self):
+        # 'Bedload all' values of the trimmed rows, in row order
+        return np.concatenate(self._trim_vals) if self._trim_vals \
+                else np.array([])
+
+    def get_overlap_rows(self):
+        # Row positions of the overlapped rows
+        return np.concatenate(self._overlap_rows) if self._overlap_rows \
+                else np.array([], dtype=np.intp)
+
+
+def clean_block(block, result, cutoff_idx, bedload_idx, first_idx=1,
+        overlap=None, row_offset=0):
+    # Clean a 2D float64 block of rows in place and add what was found to
+    # result. cutoff_idx is [(column, column index, cutoff)]. overlap is the
+    # block's rows of the overlap mask or None.
+    nan_rows = np.isnan(block).any(axis=1)
+    if nan_rows.any():
+        block[nan_rows, first_idx:] = np.nan
+
+    bedload = block[:, bedload_idx]
+    result.total_bedload += float(np.nansum(bedload))
+
+    trim_rows = None
+    for column, idx, cutoff in cutoff_idx:
+        above = block[:, idx] > cutoff
+        count = int(np.count_nonzero(above))
+        if count:
+            result.trim_counts[column] += count
+            trim_rows = above if trim_rows is None else trim_rows | above
+    if trim_rows is not None:
+        result._trim_vals.append(bedload[trim_rows].copy())
+        block[trim_rows, first_idx:] = np.nan
+
+    if overlap is not None and overlap.any():
+        result._overlap_rows.append(np.flatnonzero(overlap) + row_offset)
+
+def column_indices(columns, cutoffs):
+    # (cutoff_idx, bedload_idx, first_idx) for clean_block
+    cutoff_idx = [(c, columns.get_loc(c), v) for c, v in cutoffs.items()]
+    return (cutoff_idx, columns.get_loc(bedload_column),
+            columns.get_loc(first_clean_column))
+
+def clean_array(values, columns, cutoffs, overlap=None,
+        block_rows=default_block_rows):
+    # Fused cleaning of a 2D float64 (rows, columns) array in place. Returns
+    # a CleaningResult.
+    cutoffs = make_cutoffs(cutoffs)
+    result = CleaningResult(cutoffs)
+    cutoff_idx, bedload_idx, first_idx = column_indices(columns, cutoffs)
+
+    n_rows = values.shape[0]
+    for start in range(0, n_rows, block_rows):
+        stop = min(start + block_rows, n_rows)
+        clean_block(values[start:stop], result, cutoff_idx, bedload_idx,
+                first_idx,
+                None if overlap is None else overlap[start:stop], start)
+    return result
+
+def writable_values(data):
+    # The frame's own float64 values as one writable 2D array, or None if it
+    # doesn't have one (mixed dtypes, or read only memory). Pandas hands out
+    # read only values when other frames might share them (copy-on-write),
+    # so those are never made writable.
+    if any(dtype != np.float64 for dtype in data.dtypes):
+        return None
+    values = data.to_numpy()
+    if values.dtype != np.float64 or not values.flags.writeable or \
+            not np.may_share_memory(values, data.iloc[:, 0].to_numpy()):
+        return None # read only, or to_numpy had to make a copy
+    return values
+
+def is_frame_values(values, data):
+    # Whether values is a writable float64 array that data's values are a 
+    # view of
+    return values.dtype == np.float64 and values.flags.writeable and \
+            values.shape == data.shape and \
+            all(dtype == np.float64 for dtype in data.dtypes) and \
+            np.may_share_memory(values, data.iloc[:, 0].to_numpy())
+
+def clean_frame(data, cutoffs, overlap=None, engine='fused',
+        block_rows=default_block_rows, values=None):
+    # Clean a final Qs frame. overlap is a boolean array (or Series) of the
+    # overlapped rows, or None. values is the array data was built on, if
+    # nothing else uses it (eg. from Qs_combine.combine_chunks). Returns 
+    # (cleaned frame, CleaningResult). The fused engine cleans the frame in 
+    # place when it can write to the values, and a copy otherwise, so use 
+    # the returned frame.
+    if engine == 'fused':
+        return clean_frame_fused(data, cutoffs, overlap, block_rows, values)
+    elif engine == 'pandas':
+        return clean_frame_pandas(data, cutoffs, overlap)
+    else:
+        raise ValueError(f"Unknown clean engine {engine}. " +
+                         f"Choose from {clean_engines}")
+
+def clean_frame_fused(data, cutoffs, overlap=None,
+        block_rows=default_block_rows, values=None):
+    if overlap is not None:
+        overlap = np.asarray(overlap, dtype=bool)
+    if values is None or not is_frame_values(values, data):
+        values = writable_values(data)
+    if values is not None:
+        result = clean_array(values, data.columns, cutoffs, overlap,
+                block_rows)
+        return data, result
+
+    values = data.to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+    result = clean_array(values, data.columns, cutoffs, overlap, block_rows)
+    cleaned = pd.DataFrame(values, columns=data.columns, index=data.index,
+            copy=False)
+    return Qs_dtypes.restore_dtypes(cleaned, data.dtypes), result
+
+def clean_frame_pandas(data, cutoffs, overlap=None):
+    cutoffs = make_cutoffs(cutoffs)
+    result = CleaningResult(cutoffs)
+
+    ## Set rows with any Nan values to entirely Nan values
+    nan_rows = data.isnull().any(axis=1)
+    data.loc[nan_rows, first_clean_column:] = np.nan
+
+    ## Set outliers to Nan
+    result.total_bedload = float(np.sum(data[bedload_column]))
+    trim_rows = pd.Series(False, index=data.index)
+    for column, cutoff in cutoffs.items():
+        above = (data[column] > cutoff).fillna(False).astype(bool)
+        result.trim_counts[column] = int(above.sum())
+        trim_rows |= above
+    if trim_rows.any():
+        result._trim_vals.append(
+                data.loc[trim_rows, bedload_column].to_numpy(dtype=np.float64))
+        data.loc[trim_rows, first_clean_column:] = np.nan
+
+    if overlap is not None and np.any(overlap):
+        result._overlap_rows.append(np.flatnonzero(np.asarray(overlap)))
+    return data, result
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# Command line entry point for Qs_merger. Installed as the Qs-merger console
+# script, and also run by `python -m Qs_merger` and
+# `python Qs_pickle_processor.py`.
+#
+# Scheduled runs usually find nothing to do, so startup is kept cheap:
+#   - only the standard library is imported up front. Pandas, helpyr, and the
+#     extractor/processor modules are imported once there is work to do.
+#   - settings.py doesn't touch the filesystem. Output directories and log
+#     files are only made for a real run.
+#   - before anything else, pending_work checks the discovery index, build
+#     manifest, and metastore with stat calls only (no hashing, no pickles).
+#     If every Qs file and every period's inputs and outputs match the last
+#     run, it prints "Nothing to do" and exits.
+# Anything the quick check isn't sure about (eg. a touched file) means a full
+# run, which does the careful hash based checks.
+#
+# Big data roots can be merged by several nodes at once (see Qs_shard.py):
+#   Qs-merger --extract-only     on one node
+#   Qs-merger --shard [NODE]     on every node, they share the periods
+#   Qs-merger --reduce           once they are done, for the summary stats
+#
+# During an experiment, Qs-merger --watch keeps running and merges each period
+# as its files land (see Qs_watch.py).
+#
+#   Qs-merger [--workers N] [--extract-workers N] [--max-in-flight N]
+#             [--pipeline] [--force] [--check]
+#             [--extract-only | --shard [NODE] | --reduce | --watch]
+
+import argparse
+import os
+import sys
+from os.path import join as pjoin
+
+# The Qs_merger modules import each other as top level modules
+module_dir = os.path.dirname(os.path.abspath(__file__))
+if module_dir not in sys.path:
+    sys.path.insert(0, module_dir)
+
+import settings
+import Qs_manifest
+import Qs_metastore
+from Qs_discovery import make_finder
+
+
+def positive_int(text):
+    # argparse type for counts that must be at least 1
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return value
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+            description="Merge Qs#.txt files into one Qs file per period")
+    parser.add_argument('--workers', type=positive_int, default=None,
+            help="Number of worker processes used to merge periods")
+    parser.add_argument('--extract-workers', type=positive_int, default=None,
+            help="Number of worker processes used to parse Qs#.txt files")
+    parser.add_argument('--max-in-flight', type=positive_int, default=None,
+            help="Max number of Qs#.txt files queued for the extract workers")
+    parser.add_argument('--pipeline', action='store_true',
+            help="Load and write periods in the background while merging")
+    parser.add_argument('--force', action='store_true',
+            help="Skip the quick up to date check")
+    parser.add_argument('--check', action='store_true',
+            help="Only check for work. Exits with 1 if there is work to do.")
+    shard = parser.add_mutually_exclusive_group()
+    shard.add_argument('--extract-only', action='store_true',
+            help="Only extract the Qs#.txt files (before a sharded run)")
+    shard.add_argument('--shard', nargs='?', const='', default=None,
+            metavar='NODE',
+            help="Merge periods claimed from the shared work queue. NODE "
+                 "names this node (default host-pid).")
+    shard.add_argument('--reduce', action='store_true',
+            help="Combine the results of a sharded run. Exits with 1 if "
+                 "some periods aren't done.")
+    shard.add_argument('--watch', action='store_true',
+            help="Keep running and merge periods as their Qs files change")
+    return parser
+
+def pending_work(settings=settings):
+    # Returns a short reason there is work to do, or None if everything
+    # matches the last run. Only stats files, nothing is read or hashed.
+    raw_dir = settings.Qs_raw_pickles_dir
+    manifest_path = pjoin(raw_dir, settings.manifest_name)
+    metastore_path = pjoin(raw_dir, settings.metastore_name)
+    if not (os.path.isfile(manifest_path) and os.path.isfile(metastore_path)):
+        return "No previous run"
+    if settings.stats_storage == 'pickle' and not os.path.isfile(pjoin(
+            settings.Qs_merged_pickles_dir, f"{settings.statspickle_name}.pkl")):
+        return "No summary stats"
+
+    manifest = Qs_manifest.BuildManifest(manifest_path)
+    finder = make_finder(settings.root_dir, raw_dir,
+            pjoin(settings.root_dir, 'log-files'),
+            settings.discovery_index_name, settings.discovery_workers)
+    # A check only reads, so the index file is left as it is
+    txt_paths = finder.find(save_index=False)
+    for path in txt_paths:
+        if not manifest.is_stat_unchanged(path):
+            return f"{path} is new or changed"
+
+    metastore = Qs_metastore.MetaStore(metastore_path)
+    try:
+        periods = metastore.periods()
+        new_periods = set(os.path.dirname(p) for p in txt_paths) - set(periods)
+        if new_periods:
+            return f"{min(new_periods)} has not been extracted"
+
+        for period_path in periods:
+            record = manifest.periods.get(period_path)
+            if record is None:
+                return f"{period_path} has not been merged"
+            if sorted(record['inputs']) != sorted(metastore[period_path]):
+                return f"The raw files of {period_path} changed"
+            for path in list(record['inputs']) + list(record['outputs']):
+                if not manifest.is_stat_unchanged(path):
+                    return f"{path} is missing or changed"
+    finally:
+        metastore.close()
+    return None
+
+def make_frame_cache(args):
+    # Freshly extracted frames go straight to the processor. Only a serial 
+    # extraction fills the cache and only a processor merging in this process 
+    # uses it, so there is no cache otherwise.
+    from Qs_frame_cache import FrameCache
+    if not settings.frame_cache_bytes or args.extract_only or \
+            (args.workers or 1) > 1 or (args.extract_workers or 1) > 1:
+        return None
+    return FrameCache(settings.frame_cache_bytes)
+
+def run(args):
+    # The full extract and merge. Everything big is imported here.
+    import Qs_extractor
+    from Qs_pickle_processor import QsPickleProcessor
+
+    settings.ensure_output_dirs()
+    frame_cache = make_frame_cache(args)
+
+    # Run the extraction crawler
+    crawler = Qs_extractor.QsExtractor(
+            root_dir = settings.root_dir,
+            output_dir = settings.Qs_raw_pickles_dir,
+            max_workers = args.extract_workers,
+            max_in_flight = args.max_in_flight,
+            frame_cache = frame_cache,
+            )
+    metapickle_path = crawler.run()
+    if args.extract_only:
+        # The shard nodes read the metastore from other hosts
+        if metapickle_path is not None:
+            Qs_metastore.share_metastore(metapickle_path)
+        return
+
+    # Run the script
+    merger = QsPickleProcessor(output_txt=True,
+            metapickle_path=metapickle_path, max_workers=args.workers,
+            pipeline=args.pipeline or None, frame_cache=frame_cache)
+    merger.run()
+
+def run_shard(args):
+    # A node of a sharded run, or the reduce step
+    import Qs_shard
+    from Qs_pickle_processor import QsPickleProcessor
+
+    settings.ensure_output_dirs()
+    queue_dir = pjoin(settings.Qs_raw_pickles_dir, settings.shard_queue_name)
+    node_id = 'reduce' if args.reduce else (args.shard or None)
+    queue = Qs_shard.LeaseQueue(queue_dir, node_id,
+            lease_seconds=settings.shard_lease_seconds,
+            poll_interval=settings.shard_poll_interval)
+
+    merger = QsPickleProcessor(output_txt=True, shard_queue=queue)
+    if args.reduce:
+        return 0 if merger.reduce_shards() else 1
+    merger.run()
+    return 0
+
+def run_watch(args):
+    # Merge periods as they land until interrupted
+    import Qs_extractor
+    import Qs_watch
+    from Qs_pickle_processor import QsPickleProcessor
+
+    settings.ensure_output_dirs()
+    frame_cache = make_frame_cache(args)
+
+    extractor = Qs_extractor.QsExtractor(
+            root_dir = settings.root_dir,
+            output_dir = settings.Qs_raw_pickles_dir,
+            max_workers = args.extract_workers,
+            max_in_flight = args.max_in_flight,
+            frame_cache = frame_cache,
+            )
+    merger = QsPickleProcessor(output_txt=True, frame_cache=frame_cache)
+    finder = make_finder(settings.root_dir, settings.Qs_raw_pickles_dir,
+            pjoin(settings.root_dir, 'log-files'),
+            settings.discovery_index_name, settings.discovery_workers)
+    detector = Qs_watch.make_detector(settings.watch_detector, finder)
+
+    watcher = Qs_watch.QsWatcher(extractor, merger, detector,
+            settle_seconds=settings.watch_settle_seconds,
+            poll_interval=settings.watch_poll_interval,
+            empty_settle_seconds=settings.watch_empty_settle_seconds,
+            retry_seconds=settings.watch_retry_seconds,
+            max_retry_seconds=settings.watch_max_retry_seconds)
+    watcher.run()
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.force and args.check:
+        parser.error("--force and --check can't be used together")
+
+    if args.shard is not None or args.reduce:
+        # The work queue says what is left to do
+        if args.workers or args.pipeline or args.check:
+            parser.error("--shard and --reduce can't be used with " +
+                         "--workers, --pipeline, or --check")
+        return run_shard(args)
+
+    if args.watch:
+        # The watcher finds its own work
+        if args.workers or args.pipeline or args.check:
+            parser.error("--watch can't be used with --workers, " +
+                         "--pipeline, or --check")
+        run_watch(args)
+        return 0
+
+    if not args.force:
+        reason = pending_work()
+        if reason is None:
+            print("Nothing to do. Every period is up to date.")
+            return 0
+        print(f"Work to do: {reason}")
+        if args.check:
+            return 1
+
+    run(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# Engines for combining the Qs# chunks of a period into one Qs dataframe.
+#
+# The data is split up into multiple chunks (each Qs# file is a chunk). Each
+# chunk has rows for the whole period, but only rows within the chunk's valid
+# time have data in every bedload/count/D column. Overlapping rows are
+# converted to nan because I can't see any way to choose which one to keep.
+#
+# 'loop'       : The original engine. Adds the chunks one at a time, checking
+#                the growing combined frame for overlap on every pass.
+# 'vectorized' : Finds the data rows of every chunk once, then works out the
+#                final value of every row in bulk. Gives the same output as the
+#                loop engine.
+#
+# With with_values=True combine_chunks also returns the float64 array the
+# vectorized engine built the combined frame on (None if there isn't one, eg.
+# the loop engine or compact chunks). Nothing else holds that array, so the
+# caller can clean it in place (see Qs_clean.py) instead of copying the frame.
+
+import numpy as np
+import pandas as pd
+
+import Qs_dtypes
+
+combine_engines = ['loop', 'vectorized']
+
+# Meta columns are ignored when deciding if a row has data
+meta_cols = ['timestamp', 'missing ratio', 'vel', 'sd vel', 'number vel']
+
+
+def get_target_cols(columns):
+    return [c for c in columns if c not in meta_cols]
+
+def make_like_df(like_df, columns_to_copy=[], fill_val=np.nan):
+    # Make a dataframe like the Qs data with a few columns copied and the
+    # rest filled with a default value. Compact frames keep their dtypes.
+
+    if Qs_dtypes.is_compact(like_df):
+        pd_like = pd.DataFrame({c : Qs_dtypes.full_like_column(like_df[c],
+                                        fill_val) for c in like_df.columns},
+                columns=like_df.columns, index=like_df.index)
+    else:
+        np_like = np.empty_like(like_df.values)
+        np_like.fill(fill_val)
+        pd_like = pd.DataFrame(np_like,
+                columns=like_df.columns, index=like_df.index)
+
+    for column in columns_to_copy:
+        pd_like.loc[:, column] = like_df.loc[:, column]
+    return pd_like
+
+def combine_chunks(chunks, names, engine='vectorized', logger=None,
+        with_values=False):
+    # Returns (combined_Qs, accumulating_overlap), plus the combined frame's
+    # own values array (or None) if with_values
+    chunks = Qs_dtypes.align_dtypes(chunks)
+    if engine == 'vectorized' and can_vectorize(chunks):
+        combined, overlap, values = combine_chunks_vectorized(chunks,
+                with_values=True)
+        if logger is not None:
+            logger.write(f"Combined {len(chunks)} chunks " +
+                         f"({overlap.sum()} overlapping rows)")
+    elif engine in combine_engines:
+        combined, overlap = combine_chunks_loop(chunks, names, logger)
+        values = None
+    else:
+        raise ValueError(f"Unknown combine engine {engine}. " +
+                         f"Choose from {combine_engines}")
+    if with_values:
+        return combined, overlap, values
+    return combined, overlap
+
+def can_vectorize(chunks):
+    # The vectorized engine works on row positions, so every chunk needs the
+    # same rows and columns.
+    first = chunks[0]
+    return all(c.shape == first.shape and c.index.equals(first.index)
+               and c.columns.equals(first.columns) for c in chunks[1:])
+
+def combine_chunks_loop(chunks, names, logger=None):
+    combined = make_like_df(chunks[0], ['timestamp'])
+    accumulating_overlap = None
+
+    target_cols = get_target_cols(combined.columns)
+    # All columns except the timestamp
+    value_cols = combined.columns[1:]
+
+    # Set up a few lambda functions
+    get_num = lambda s: int(s[2:]) # get the file number from the name
+    get_target_subset = lambda c: c.loc[:, target_cols]
+    # Find rows with data. Should remove meta columns beforehand
+    # Will select rows with non-null values (selects zero rows)
+    find_data_rows = lambda df: df.notnull().all(axis=1)
+
+    for raw_chunk, name in zip(chunks, names):
+        # Each raw dataframe contains only a chunk of the overall data.
+        # However they contain zero values for all times outside of the
+        # valid chunk time. Some chunks overlap too.
+        if logger is not None:
+            ch_num, max_num = get_num(name), get_num(names[-1])
+            logger.debug(f"Processing chunk {ch_num} of {max_num}")
+
+        # Get bedload subsets
+        bedload_chunk = get_target_subset(raw_chunk)
+        bedload_combined = get_target_subset(combined)
+
+        # Find rows with data
+        chunk_rows = find_data_rows(bedload_chunk)
+        combined_rows = find_data_rows(bedload_combined)
+
+        # Find overlap
+        overlap_rows = chunk_rows & combined_rows
+
+        # Add chunk to combined array
+        combined.loc[chunk_rows, value_cols] = \
+                raw_chunk.loc[chunk_rows, value_cols]
+        combined.loc[overlap_rows, value_cols] = np.nan
+
+        # Keep track of overlap rows
+        if accumulating_overlap is None:
+            accumulating_overlap = overlap_rows
+        else:
+            accumulating_overlap = accumulating_overlap | overlap_rows
+
+    return combined, accumulating_overlap
+
+def combine_chunks_vectorized(chunks, with_values=False):
+    # In the loop engine, a row covered by several chunks flips between data
+    # and nan: the first chunk with data fills it, the second finds overlap
+    # and clears it, a third finds it empty and fills it again, and so on. So
+    # the final row is the last covering chunk's data if the row is covered
+    # an odd number of times and nan if even. Any row covered more than once
+    # counts as overlap.
+    first = chunks[0]
+    columns = first.columns
+    target_idx = [columns.get_loc(c) for c in get_target_cols(columns)]
+
+    chunk_values = [c.to_numpy(dtype=np.float64, copy=False) for c in chunks]
+    combined, overlap = combine_chunk_arrays(chunk_values, target_idx)
+
+    values = combined
+    combined = pd.DataFrame(values, columns=columns, index=first.index,
+            copy=False)
+    # Compact chunks give a compact combined frame
+    if Qs_dtypes.is_compact(first):
+        combined = Qs_dtypes.restore_dtypes(combined, first.dtypes)
+        values = None
+    overlap = pd.Series(overlap, index=first.index)
+    if with_values:
+        return combined, overlap, values
+    return combined, overlap
+
+def combine_chunk_arrays(chunk_values, target_idx):
+    # Array version of combine_chunks_vectorized. chunk_values is a list of
+    # 2D float arrays with the timestamp in column 0. Returns a new combined
+    # array and a boolean overlap array.
+    n_rows = chunk_values[0].shape[0]
+    coverage = np.zeros(n_rows, dtype=np.int32)
+    last_chunk = np.full(n_rows, -1, dtype=np.int32)
+
+    # One pass over the chunks to find their data rows. Done a column at a
+    # time so the chunks (possibly memory mapped) are only read, never copied.
+    data_rows = np.empty(n_rows, dtype=bool)
+    for i, values in enumerate(chunk_values):
+        data_rows[:] = False
+        for j in target_idx:
+            data_rows |= np.isnan(values[:, j])
+        np.logical_not(data_rows, out=data_rows)
+        coverage += data_rows
+        last_chunk[data_rows] = i
+
+    # Build the combined array. Rows start as nan except for the timestamp.
+    combined = np.full(chunk_values[0].shape, np.nan, dtype=np.float64)
+    combined[:, 0] = chunk_values[0][:, 0]
+
+    keep_rows = (coverage % 2) == 1
+    for i, values in enumerate(chunk_values):
+        rows = np.flatnonzero(keep_rows & (last_chunk == i))
+        if rows.size:
+            combined[rows, 1:] = values[rows, 1:]
+
+    return combined, coverage > 1
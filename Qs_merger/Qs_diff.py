@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Difference check between the Qs.txt data and the combined Qs# data.
+#
+# The rules are the same as the original dataframe version:
+#   - values that are not equal count as different (nan vs a value counts)
+#   - rows with a nan in the same column of both frames are ignored
+#   - the excluded columns (velocities and missing ratio) never count
+#
+# The dataframe version made four or five full size boolean frames per
+# period. Here the two float arrays are compared a block of rows at a time, so
+# the temporary masks are only block sized, and only the row/column flags are
+# kept for the whole period.
+
+import numpy as np
+
+# Columns that are likely to be different and don't seem to have any
+# practical value
+diff_exclude_cols = ['missing ratio', 'vel', 'sd vel', 'number vel']
+
+default_block_rows = 2**16
+
+
+class DiffResult:
+
+    def __init__(self, diff_rows, diff_cols):
+        self.diff_rows = diff_rows # bool per row
+        self.diff_cols = diff_cols # bool per column
+        self.n_rows = diff_rows.shape[0]
+        self.n_diff_rows = int(diff_rows.sum())
+
+    def any(self):
+        return self.n_diff_rows > 0
+
+    def row_indices(self, max_rows=None):
+        # Positions of the differing rows, optionally only the first max_rows
+        rows = np.flatnonzero(self.diff_rows)
+        return rows if max_rows is None else rows[:max_rows]
+
+    def col_indices(self):
+        return np.flatnonzero(self.diff_cols)
+
+
+def diff_arrays(raw, combined, exclude_idx=[], block_rows=default_block_rows):
+    # raw and combined are 2D float arrays of the same shape. exclude_idx are
+    # column positions to ignore. Returns a DiffResult.
+    if raw.shape != combined.shape:
+        raise ValueError(f"Can't compare arrays of shapes {raw.shape} " +
+                         f"and {combined.shape}")
+    n_rows, n_cols = raw.shape
+    included = np.ones(n_cols, dtype=bool)
+    included[list(exclude_idx)] = False
+
+    diff_rows = np.zeros(n_rows, dtype=bool)
+    diff_cols = np.zeros(n_cols, dtype=bool)
+    for start in range(0, n_rows, block_rows):
+        stop = min(start + block_rows, n_rows)
+        raw_block = raw[start:stop]
+        combined_block = combined[start:stop]
+
+        diff = combined_block != raw_block
+        both_nan = np.isnan(combined_block)
+        both_nan &= np.isnan(raw_block)
+        diff[both_nan.any(axis=1)] = False
+        diff &= included
+
+        diff_rows[start:stop] = diff.any(axis=1)
+        diff_cols |= diff.any(axis=0)
+
+    return DiffResult(diff_rows, diff_cols)
+
+def diff_frames(raw_Qs, combined_Qs, exclude_cols=diff_exclude_cols,
+        block_rows=default_block_rows):
+    # Dataframe wrapper for diff_arrays. Like the dataframe != operator, the
+    # frames need the same rows and columns.
+    if not (raw_Qs.index.equals(combined_Qs.index) and
+            raw_Qs.columns.equals(combined_Qs.columns)):
+        raise ValueError("Can only compare identically-labeled DataFrame " +
+                         "objects")
+    exclude_idx = [raw_Qs.columns.get_loc(c) for c in exclude_cols
+                   if c in raw_Qs.columns]
+    return diff_arrays(raw_Qs.to_numpy(dtype=np.float64),
+            combined_Qs.to_numpy(dtype=np.float64), exclude_idx, block_rows)
+
+def diff_frames_at(raw_Qs, combined_Qs, rows, exclude_cols=diff_exclude_cols,
+        block_rows=default_block_rows):
+    # diff_frames when only some rows can differ, eg. Qs.txt is a near copy
+    # of Qs1.txt and the combined frame is made from Qs1.txt alone (see
+    # Qs_fingerprint.py). A row that is the same in both files is either
+    # copied as is, or blanked in the combined frame because it has a nan
+    # in a bedload column, which is then nan in both. Neither counts, so only
+    # the given rows are compared.
+    if not (raw_Qs.index.equals(combined_Qs.index) and
+            raw_Qs.columns.equals(combined_Qs.columns)):
+        raise ValueError("Can only compare identically-labeled DataFrame " +
+                         "objects")
+    exclude_idx = [raw_Qs.columns.get_loc(c) for c in exclude_cols
+                   if c in raw_Qs.columns]
+    rows = np.asarray(rows, dtype=np.int64)
+    subset = diff_arrays(raw_Qs.iloc[rows].to_numpy(dtype=np.float64),
+            combined_Qs.iloc[rows].to_numpy(dtype=np.float64), exclude_idx,
+            block_rows)
+
+    diff_rows = np.zeros(len(raw_Qs), dtype=bool)
+    diff_rows[rows] = subset.diff_rows
+    return DiffResult(diff_rows, subset.diff_cols)
+
+def get_diff_block(data, result, max_rows=None):
+    # The differing rows and columns of a frame, for the log. Only the first
+    # max_rows differing rows are copied.
+    return data.iloc[result.row_indices(max_rows), result.col_indices()]
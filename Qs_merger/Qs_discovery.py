@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# Finds the Qs#.txt files under the data root.
+#
+# The data root has a huge number of unrelated files (vel_particle.txt,
+# allparticlesallframes.txt, images, ...), so walking and logging the whole
+# tree every run is slow. QsFileFinder walks the tree with os.scandir, skips
+# directories that can't hold Qs files (outputs, logs, hidden directories),
+# and keeps an index of every directory it visited:
+#   {dir path : {'mtime_ns', 'scanned_ns', 'subdirs', 'files'}}
+# A directory's mtime changes whenever an entry is added, removed, or renamed
+# in it, so on a rerun a directory with the same mtime reuses its indexed
+# subdirs and Qs files with a single stat instead of listing every entry.
+# (Changes to the content of a Qs file are caught by the build manifest.)
+#
+# Some filesystems only keep mtimes to the second (or 2 s on FAT, and network
+# mounts use the server's clock), so an entry added just after a scan can
+# leave the mtime the same. scanned_ns is the time the directory was listed,
+# and a directory whose mtime is within mtime_window_ns of it is always listed
+# again.
+#
+# The tree is walked one level at a time. With max_workers, each level is
+# listed by a pool of threads, which helps a lot on network mounted roots
+# where every listing waits on the network.
+
+import fnmatch
+import json
+import os
+import time
+from os.path import join as pjoin
+
+# Qs.txt is matched too so it can be compared to Qs1.txt (Qs_fingerprint.py)
+default_patterns = ['Qs.txt', 'Qs?.txt', 'Qs??.txt']
+default_prune_names = ['log-files', 'Qs-merger-output', '__pycache__']
+
+# Directories changed this close to when they were listed are listed again
+mtime_window_ns = 2 * 10**9
+
+
+def make_finder(root_dir, output_dir, report_dir, index_name,
+        max_workers=None):
+    # The finder used by the extractor (and the no-op check, which needs the
+    # same index). The output and log directories are never scanned.
+    return QsFileFinder(root_dir, index_path=pjoin(output_dir, index_name),
+            prune_paths=[output_dir, report_dir], max_workers=max_workers)
+
+
+class QsFileFinder:
+
+    def __init__(self, root_dir, index_path=None, patterns=default_patterns,
+            prune_names=default_prune_names, prune_paths=[],
+            max_workers=None):
+        # index_path is where the directory index is saved (None for no
+        # index). prune_names are directory names to skip anywhere in the
+        # tree, prune_paths are specific directories to skip.
+        self.root_dir = os.path.abspath(root_dir)
+        self.index_path = index_path
+        self.patterns = list(patterns)
+        self.prune_names = set(prune_names)
+        self.prune_paths = set(os.path.abspath(p) for p in prune_paths)
+        self.max_workers = max_workers
+        self.index = self._load_index()
+        self.counts = {}
+
+    def _index_key(self):
+        # The index is only valid for the same root, patterns, and pruning
+        return {'root_dir'    : self.root_dir,
+                'patterns'    : sorted(self.patterns),
+                'prune_names' : sorted(self.prune_names),
+                'prune_paths' : sorted(self.prune_paths),
+                }
+
+    def _load_index(self):
+        if self.index_path is None or not os.path.isfile(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r') as index_file:
+                stored = json.load(index_file)
+        except (OSError, ValueError):
+            # A broken index just means a full scan
+            return {}
+        if stored.get('key') != self._index_key():
+            return {}
+        return stored.get('dirs', {})
+
+    def save_index(self):
+        if self.index_path is None:
+            return
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w') as index_file:
+            json.dump({'key' : self._index_key(), 'dirs' : self.index},
+                    index_file)
+        os.replace(tmp_path, self.index_path)
+
+    def is_pruned(self, name, path):
+        return name.startswith('.') or name in self.prune_names \
+                or path in self.prune_paths
+
+    def is_target(self, name):
+        return any(fnmatch.fnmatchcase(name, p) for p in self.patterns)
+
+    def find(self, save_index=True):
+        # Returns the sorted list of Qs file paths and updates the index.
+        # self.counts has the summary counts. save_index=False only keeps the
+        # updated index in memory (eg. for the frequent watch mode scans).
+        self.counts = {'dirs scanned' : 0, 'dirs from index' : 0,
+                       'dirs pruned' : 0, 'files found' : 0}
+        new_index = {}
+        found = []
+
+        if self.max_workers is not None and self.max_workers > 1:
+            # Imported here to keep the no-op startup check cheap (Qs_cli.py)
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            visit_all = lambda paths: executor.map(self._visit, paths)
+        else:
+            executor = None
+            visit_all = lambda paths: map(self._visit, paths)
+
+        try:
+            level = [self.root_dir]
+            while level:
+                next_level = []
+                for path, entry, was_scanned, n_pruned in visit_all(level):
+                    if entry is None:
+                        # Removed while walking
+                        continue
+                    new_index[path] = entry
+                    key = 'dirs scanned' if was_scanned else 'dirs from index'
+                    self.counts[key] += 1
+                    self.counts['dirs pruned'] += n_pruned
+                    found.extend(pjoin(path, f) for f in entry['files'])
+                    next_level.extend(pjoin(path, d) for d in entry['subdirs'])
+                level = next_level
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        self.index = new_index
+        if save_index:
+            self.save_index()
+        self.counts['files found'] = len(found)
+        return sorted(found)
+
+    def _visit(self, path):
+        # Returns (path, index entry, was_scanned, pruned dir count). Only
+        # lists the directory if it changed since it was indexed. Runs in the
+        # worker threads, so it doesn't touch any shared state.
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return path, None, False, 0
+
+        known = self.index.get(path)
+        if known is not None and known['mtime_ns'] == mtime_ns and \
+                mtime_ns < known.get('scanned_ns', 0) - mtime_window_ns:
+            return path, known, False, 0
+
+        scanned_ns = time.time_ns()
+        subdirs, files = [], []
+        n_pruned = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.is_pruned(entry.name, entry.path):
+                            n_pruned += 1
+                        else:
+                            subdirs.append(entry.name)
+                    elif self.is_target(entry.name) and entry.is_file():
+                        files.append(entry.name)
+        except OSError:
+            return path, None, False, 0
+
+        entry = {'mtime_ns' : mtime_ns, 'scanned_ns' : scanned_ns,
+                 'subdirs' : sorted(subdirs), 'files' : sorted(files)}
+        return path, entry, True, n_pruned
+
+    def summary_lines(self):
+        periods = sum(1 for e in self.index.values() if e['files'])
+        return [f"Found {self.counts['files found']} Qs files in {periods} " +
+                "directories",
+                f"{self.counts['dirs scanned']} directories scanned, " +
+                f"{self.counts['dirs from index']} unchanged from the index, " +
+                f"{self.counts['dirs pruned']} pruned"]
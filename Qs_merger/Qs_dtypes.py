@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Compact dtype mode for the raw and merged Qs frames.
+#
+# Every Qs column is read as float64, but most of them don't need it:
+#   timestamp     : float64, unix seconds need the full precision
+#   Count *       : grain counts, so nullable integers. Pandas keeps the values
+#                   and a separate missing value mask, so NaN rows still work.
+#                   UInt16 for the size classes and Int32 for 'Count all'.
+#   everything else (masses, velocities, D stats) : float32
+# That is about half the memory and disk of the float64 frames.
+#
+# A count column that has fractions, negative numbers, or numbers too big for
+# its dtype is moved up to the next dtype that holds it (UInt16 -> Int32 ->
+# float64) so the counts are never changed. float32 keeps about 7 significant
+# digits, which is plenty for 3 decimal masses, but the validation mode checks
+# every compacted frame against the float64 data and reports each column that
+# changed by more than a tolerance.
+#
+# Frames are compacted as they are read from the txt files. The combine
+# engines and make_like_df keep the dtypes of the chunks, so merged frames
+# come out compact too. Anything that needs float64 math (stats, difference
+# checks) converts with to_numpy(dtype=np.float64), which turns missing counts
+# into NaN.
+
+import numpy as np
+import pandas as pd
+
+from Qs_schema import Qs_column_names, count_column_names
+
+dtype_modes = ['float64', 'compact']
+
+# Bigger count dtypes to try when the values don't fit
+count_dtype_ladder = ['UInt16', 'Int32', 'float64']
+
+compact_dtypes = {}
+for column in Qs_column_names:
+    compact_dtypes[column] = 'float32'
+compact_dtypes['timestamp'] = 'float64'
+for column in count_column_names:
+    compact_dtypes[column] = 'UInt16'
+compact_dtypes['Count all'] = 'Int32'
+
+# Integer ranges of the count dtypes
+_int_limits = {'UInt16' : (0, 2**16 - 1), 'Int32' : (-2**31, 2**31 - 1)}
+
+
+def is_compact(data):
+    return any(dtype != np.float64 for dtype in data.dtypes)
+
+def fits_dtype(values, dtype):
+    # Whether a float array can be stored as dtype without changing anything
+    # but float precision. NaNs always fit.
+    if dtype not in _int_limits:
+        return True
+    valid = values[~np.isnan(values)]
+    low, high = _int_limits[dtype]
+    return bool(np.all(valid == np.round(valid)) and
+                (valid.size == 0 or (valid.min() >= low and valid.max() <= high)))
+
+def count_dtype(values, dtype):
+    # The first dtype from dtype up the ladder that holds the values
+    ladder = count_dtype_ladder[count_dtype_ladder.index(dtype):]
+    for candidate in ladder:
+        if fits_dtype(values, candidate):
+            return candidate
+    return 'float64'
+
+def convert_column(values, dtype):
+    # float array -> array of dtype. Int dtypes get a mask from the NaNs.
+    if dtype in _int_limits:
+        is_nan = np.isnan(values)
+        ints = np.where(is_nan, 0, values).astype(dtype.lower())
+        return pd.arrays.IntegerArray(ints, is_nan)
+    return values.astype(dtype, copy=False)
+
+def compact_frame(data, dtypes=compact_dtypes):
+    # Returns a compacted copy of a Qs frame. Columns not in dtypes are left
+    # as they are.
+    columns = {}
+    for column in data.columns:
+        values = data[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        dtype = dtypes.get(column)
+        if dtype is None:
+            columns[column] = data[column].array
+            continue
+        if dtype in _int_limits:
+            dtype = count_dtype(values, dtype)
+        columns[column] = convert_column(values, dtype)
+    return pd.DataFrame(columns, index=data.index, columns=data.columns)
+
+def expand_frame(data):
+    # Back to all float64 columns, with NaN for missing counts
+    values = data.to_numpy(dtype=np.float64, na_value=np.nan)
+    return pd.DataFrame(values, index=data.index, columns=data.columns)
+
+def restore_dtypes(data, dtypes):
+    # Cast a float64 frame back to the dtypes of the frames it was built from
+    # (eg. after combining compact chunks as float arrays). dtypes is a Series
+    # like DataFrame.dtypes. Lossless when the values came from those frames.
+    if all(dtype == np.float64 for dtype in dtypes):
+        return data
+    columns = {}
+    for column in data.columns:
+        values = data[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        columns[column] = convert_column(values, str(dtypes[column]))
+    return pd.DataFrame(columns, index=data.index, columns=data.columns)
+
+# Order for picking a dtype that holds the values of several frames
+_dtype_ranks = {'UInt16' : 0, 'Int32' : 1, 'float32' : 2, 'float64' : 3}
+
+def align_dtypes(frames):
+    # Make the chunks of a period use the same dtypes. A count column can be
+    # moved up to a bigger dtype in some chunks but not others.
+    if not any(is_compact(frame) for frame in frames):
+        return frames
+    dtypes = {}
+    for frame in frames:
+        for column, dtype in frame.dtypes.items():
+            dtype = str(dtype)
+            if _dtype_ranks.get(dtype, 3) > _dtype_ranks.get(
+                    dtypes.get(column, 'UInt16'), 3):
+                dtypes[column] = dtype
+            else:
+                dtypes.setdefault(column, dtype)
+    return [frame if all(str(frame[c].dtype) == dtypes[c] for c in frame.columns)
+            else frame.astype(dtypes) for frame in frames]
+
+def full_like_column(like_column, fill_val=np.nan):
+    # Array like a column filled with fill_val. NaN in an int column is a
+    # missing value.
+    n_rows = len(like_column)
+    dtype = like_column.dtype
+    if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+        is_nan = np.isnan(fill_val)
+        ints = np.full(n_rows, 0 if is_nan else fill_val,
+                dtype=dtype.numpy_dtype)
+        return pd.arrays.IntegerArray(ints, np.full(n_rows, is_nan))
+    return np.full(n_rows, fill_val, dtype=dtype)
+
+
+def compare_frames(original, compacted, tolerance):
+    # Compare a compacted frame to the float64 data it was made from. Returns
+    # a frame with one row per column that changed by more than tolerance:
+    # the dtype, the number of changed values, and the biggest change.
+    # Missing values that moved count as changed.
+    rows = {}
+    for column in original.columns:
+        before = original[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        after = compacted[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        nan_changed = np.isnan(before) != np.isnan(after)
+        with np.errstate(invalid='ignore'):
+            error = np.abs(after - before)
+        changed = nan_changed | (error > tolerance)
+        n_changed = int(changed.sum())
+        if n_changed:
+            max_error = np.nanmax(np.where(nan_changed, np.nan, error)) \
+                    if not nan_changed.all() else np.nan
+            rows[column] = {'dtype' : str(compacted[column].dtype),
+                            'changed' : n_changed,
+                            'max error' : max_error}
+    return pd.DataFrame.from_dict(rows, orient='index',
+            columns=['dtype', 'changed', 'max error'])
+
+
+class DtypePolicy:
+    # How Qs frames are stored, passed to the extractor workers. apply() is
+    # called on every frame read from a txt file.
+
+    def __init__(self, mode='float64', validate=False, tolerance=5e-4):
+        if mode not in dtype_modes:
+            raise ValueError(f"Unknown dtype mode {mode}. " +
+                             f"Choose from {dtype_modes}")
+        self.mode = mode
+        self.validate = validate
+        self.tolerance = tolerance
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.Qs_dtype_mode, settings.validate_compact,
+                   settings.compact_tolerance)
+
+    def apply(self, data, logger=None, name=''):
+        if self.mode == 'float64':
+            return data
+        compacted = compact_frame(data)
+        if self.validate and logger is not None:
+            self.log_validation(data, compacted, logger, name)
+        return compacted
+
+    def conform(self, data):
+        # Convert a stored frame to this mode if it was saved in the other
+        # one (eg. pickles from before the mode was changed)
+        if is_compact(data) == (self.mode == 'compact'):
+            return data
+        return compact_frame(data) if self.mode == 'compact' \
+                else expand_frame(data)
+
+    def log_validation(self, original, compacted, logger, name=''):
+        losses = compare_frames(original, compacted, self.tolerance)
+        if losses.empty:
+            logger.write(f"Compact dtypes of {name} are within " +
+                         f"{self.tolerance} of the original values")
+        else:
+            logger.warning([f"Compact dtypes changed {name} by more than " +
+                            f"{self.tolerance}", losses.to_string()])
+        return losses
@@ -1,18 +1,32 @@
 import os
 from os.path import join as pjoin
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
 import numpy as np
+import pandas as pd
 
 # From Helpyr
 from helpyr import data_loading
 from helpyr.helpyr_misc import nsplit
 from helpyr.helpyr_misc import ensure_dir_exists
-from helpyr import logger as hlp_logger
 from helpyr import crawler as hlp_crawler
 
 from xlrd.biffh import XLRDError
 
 
 import settings
+from Qs_schema import Qs_column_names
+from Qs_reader import read_Qs_txt
+from Qs_reader import is_available as fast_reader_available
+from Qs_log_buffer import LogRecorder, replay_records
+import Qs_logging
+import Qs_storage
+import Qs_manifest
+import Qs_profiler
+import Qs_metastore
+import Qs_dtypes
+import Qs_fingerprint
+from Qs_discovery import make_finder
 
 
 # ISSUE TO ADDRESS:
@@ -24,17 +38,69 @@ class QsExtractor (hlp_crawler.Crawler):
     # The Extraction Crawler does the initial work of finding all the data 
     # files and converting them to pickles
 
-    def __init__(self, root_dir, output_dir):
+    def __init__(self, root_dir, output_dir, max_workers=None,
+            max_in_flight=None, fast_reader=True, storage_format=None,
+            frame_cache=None):
         log_filepath = pjoin(root_dir, 'log-files', 'QsExtractor.txt')
-        logger = hlp_logger.Logger(log_filepath, default_verbose=True)
+        logger = Qs_logging.make_logger(log_filepath, settings.log_mode,
+                settings.log_level)
         hlp_crawler.Crawler.__init__(self, logger)
 
+        self.root_dir = root_dir
         self.set_root(root_dir)
         self.output_dir = output_dir
         ensure_dir_exists(output_dir, logger)
 
         self.loader = data_loading.DataLoader(root_dir, output_dir, logger)
 
+        # Storage backend for the raw Qs# frames. The metastore is a SQLite 
+        # file.
+        if storage_format is None:
+            storage_format = settings.storage_format
+        self.storage_format = storage_format
+        self.store = Qs_storage.make_store(
+                storage_format, output_dir, self.loader, logger)
+
+        # The build manifest tracks the raw txt files so changed files are 
+        # pickled again
+        self.manifest = Qs_manifest.BuildManifest(
+                pjoin(output_dir, settings.manifest_name))
+
+        # Parallel extraction settings. None or 1 worker parses every file in 
+        # this process. max_in_flight limits how many files are submitted to 
+        # the pool at once so memory stays flat on huge extractions.
+        self.max_workers = max_workers
+        if max_in_flight is None and max_workers is not None:
+            max_in_flight = 2 * max_workers
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1, " +
+                             f"not {max_in_flight}")
+        self.max_in_flight = max_in_flight
+
+        # Use the fixed schema Qs reader before falling back to the generic 
+        # DataLoader text reader. Needs pyarrow.
+        self.fast_reader = fast_reader and fast_reader_available()
+
+        # float64 or compact dtypes for the raw frames. See Qs_dtypes.py
+        self.dtype_policy = Qs_dtypes.DtypePolicy.from_settings(settings)
+
+        # Spot Qs.txt files that copy Qs1.txt. See Qs_fingerprint.py
+        self.dedup = settings.dedup_raw_files
+        self.max_diff_fraction = settings.near_duplicate_fraction
+        self.raw_links = {} # period path : link or None, for the metastore
+
+        # Frames stored by the serial extraction are also put in this 
+        # Qs_frame_cache.FrameCache so a processor in the same run doesn't 
+        # have to load them again. The parallel workers' frames never come 
+        # back to this process, so they aren't cached.
+        self.frame_cache = frame_cache
+
+        # Time and memory records for each extraction stage. See 
+        # Qs_profiler.py
+        self.profiler = Qs_profiler.StageProfiler('QsExtractor',
+                enabled=settings.profile_stages)
+        self.report_dir = os.path.dirname(log_filepath)
+
 
     def run(self):
         # Overloads Crawler.run function. The flexibility from run modes is not 
@@ -44,11 +110,12 @@ class QsExtractor (hlp_crawler.Crawler):
 
         # Extract the Qs data from text files and save them as pickles
         logger.write_section_break()
-        logger.write(["Extracting light table data"])
+        logger.write(["Extracting light table data", self.reader_line()])
 
         logger.write("Finding files")
-        raw_Qs_files = self.get_target_files(['Qs?.txt', 'Qs??.txt'],
-                verbose_file_list=True)
+        with self.profiler.stage('file_discovery') as record:
+            raw_Qs_files = self.find_Qs_files()
+            record['rows'] = len(raw_Qs_files)
 
         if len(raw_Qs_files) == 0:
             logger.write("No files found!")
@@ -60,92 +127,80 @@ class QsExtractor (hlp_crawler.Crawler):
             return metapickle_path
 
 
+    def reader_line(self):
+        # Which reader parses the Qs#.txt files, for the log
+        if self.fast_reader:
+            return "Reading Qs#.txt files with the pyarrow Qs reader"
+        reason = "turned off" if fast_reader_available() \
+                else "pyarrow is not installed"
+        return f"Reading Qs#.txt files with the DataLoader reader ({reason})"
+
+    def find_Qs_files(self):
+        # Find the Qs#.txt files with the indexed scanner instead of 
+        # crawling and logging the whole root directory. See Qs_discovery.py
+        finder = make_finder(self.root_dir, self.output_dir, self.report_dir,
+                settings.discovery_index_name, settings.discovery_workers)
+        raw_Qs_files = finder.find()
+        self.logger.write(finder.summary_lines(), local_indent=1)
+        return raw_Qs_files
+
     def extract_light_table(self, raw_Qs_txt_files):
         lg = self.logger
         lg.write("Extracting light table data")
         lg.increase_global_indent()
 
         # Prepare kwargs for reading Qs text files
-        Qs_column_names = [
-                # Timing and meta data
-                #'elapsed-time sec', <- Calculate this column later
-                'timestamp', 'missing ratio', 'vel', 'sd vel', 'number vel',
-                # Bedload transport masses (g)
-                'Bedload all', 'Bedload 0.5', 'Bedload 0.71', 'Bedload 1',
-                'Bedload 1.4', 'Bedload 2', 'Bedload 2.8', 'Bedload 4',
-                'Bedload 5.6', 'Bedload 8', 'Bedload 11.2', 'Bedload 16',
-                'Bedload 22', 'Bedload 32', 'Bedload 45',
-                # Grain counts
-                'Count all', 'Count 0.5', 'Count 0.71', 'Count 1', 'Count 1.4',
-                'Count 2', 'Count 2.8', 'Count 4', 'Count 5.6', 'Count 8',
-                'Count 11.2', 'Count 16', 'Count 22', 'Count 32', 'Count 45',
-                # Statistics
-                'D10', 'D16', 'D25', 'D50', 'D75', 'D84', 'D90', 'D95', 'Dmax'
-                ]
         Qs_kwargs = {
                 'index_col' : None,
                 'header'    : None,
                 'names'     : Qs_column_names,
                 }
 
-        period_dict = self.build_period_dict(raw_Qs_txt_files)
+        with self.profiler.stage('build_period_dict') as record:
+            period_dict = self.build_period_dict(raw_Qs_txt_files)
+            record['rows'] = len(raw_Qs_txt_files)
         pickle_dict = {}
 
         # Create new pickles if necessary
-        for period_path in period_dict:
-            lg.write(f"Extracting {period_path}")
-            lg.increase_global_indent()
-
-            fnames = period_dict[period_path]
-            pickle_dict[period_path] = self.pickle_Qs_text_files(
-                    period_path, fnames, Qs_kwargs)
-            lg.decrease_global_indent()
-
-        # Update the metapickle
-        # it describes which pkl files belong to which periods
-        metapickle_name = settings.metapickle_name
-        if self.loader.is_pickled(metapickle_name):
-            # Pickled metapickle already exists.
-            # Update the metapickle
-            lg.write(f"Updating {metapickle_name}...")
-            existing = self.loader.load_pickle(
-                    metapickle_name, use_source=False)
-            pickle_dict = self._merge_metapickle(
-                    period_dict, pickle_dict, existing)
-
-        metapickle_path = self.make_pickle(metapickle_name, pickle_dict, 
-                overwrite=True)[0]
+        if self.max_workers is not None and self.max_workers > 1:
+            pickle_dict = self.pickle_Qs_text_files_parallel(
+                    period_dict, Qs_kwargs)
+        else:
+            for period_path in period_dict:
+                lg.write(f"Extracting {period_path}")
+                lg.increase_global_indent()
+
+                fnames = period_dict[period_path]
+                pickle_dict[period_path] = self.pickle_Qs_text_files(
+                        period_path, fnames, Qs_kwargs)
+                lg.decrease_global_indent()
+
+        # Update the metastore (replaces the metapickle)
+        # it describes which pkl files belong to which periods. Only the new 
+        # paths are added. See Qs_metastore.py
+        with self.profiler.stage('merge_metapickle') as record:
+            lg.write(f"Updating {settings.metastore_name}...")
+            metastore = self.open_metastore()
+            metastore.add_periods(pickle_dict)
+            metastore.set_links(self.raw_links)
+            metastore.close()
+            metapickle_path = metastore.db_path
+            self.manifest.save()
+            record['rows'] = len(pickle_dict)
+            record['bytes'] = Qs_profiler.path_sizes([metapickle_path])
 
         lg.decrease_global_indent()
         lg.write("Light table data extraction complete")
+        self.write_run_report()
 
         return metapickle_path
     
-    def _merge_metapickle(self, period_dict, new_dict, old_dict):
-        merge = lambda a, b: list(set(a + b))
-
-        # Note: your file naming convention will be different so I can't sort 
-        # the dictionary entries.
-        #
-        file_name = lambda path: path.rsplit('_',1)[1]
-        file_num = lambda name: int(name[2:-4]) if name[2:-4].isdigit() else 0
-        sort_key = lambda path: file_num(file_name(path))
-
-        # Can't remember why I sort period_dict here..... Seems like it should 
-        # be somewhere else
-        for period_path in period_dict.keys():
-            sorted = period_dict[period_path].sort(key=file_num)
-            period_dict[period_path] = sorted
-
-        nd = new_dict
-        od = old_dict
-
-        old_dict.update(
-            {nk: merge(nd[nk], od[nk] if nk in od else []) for nk in nd.keys()})
-        for key in old_dict:
-            old_dict[key].sort(key=sort_key)
-
-        return old_dict
+    def open_metastore(self):
+        # Open the metastore, copying an old metapickle into it if needed
+        legacy_path = pjoin(self.output_dir,
+                f"{settings.metapickle_name}{Qs_storage.pickle_extension}")
+        return Qs_metastore.open_metastore(
+                pjoin(self.output_dir, settings.metastore_name), legacy_path)
 
     def build_period_dict(self, raw_Qs_txt_files):
         # Build a dict of associated Qs#.txt files per 20 minute periods
@@ -186,35 +241,309 @@ class QsExtractor (hlp_crawler.Crawler):
         _, period_name = nsplit(period_path, 1)
         period_name = period_name.replace('results-', '')
 
+        # Qs.txt goes last so it can be linked to the Qs1.txt frame if it's 
+        # a copy
+        Qs_names = sorted(Qs_names, key=lambda name: name == 'Qs.txt')
+        is_current = {name : self.is_pickle_current(
+                                f"{period_name}_{name[:-4]}",
+                                pjoin(period_path, name))
+                      for name in Qs_names}
+        duplicate = self.find_duplicate(period_path, Qs_names, is_current)
+        self.log_duplicate(duplicate)
+
         picklepaths = []
         for name in Qs_names:
             #pkl_name = f"{experiment}_{step}_{rtime[8:]}_{name[:-4]}"
             pkl_name = f"{period_name}_{name[:-4]}"
 
-            if self.loader.is_pickled(pkl_name):
-                self.logger.write(f'Pickle {pkl_name} preexists. Nothing to do.')
+            filepath = pjoin(period_path, name)
+
+            if is_current[name]:
+                self.logger.debug(f'Pickle {pkl_name} preexists. Nothing to do.')
+            elif name == 'Qs.txt' and duplicate is not None and \
+                    duplicate.kind == 'exact':
+                picklepaths += self.link_duplicate(period_path, filepath)
             else:
-                self.logger.write(f'Pickling {pkl_name}')
+                overwrite = self.prepare_overwrite(pkl_name)
+                if overwrite:
+                    self.logger.write(f'{name} changed. Pickling {pkl_name} again')
+                else:
+                    self.logger.write(f'Pickling {pkl_name}')
                 
                 # Read and prep raw data
-                filepath = pjoin(period_path, name)
-                data = self.loader.load_txt(filepath, Qs_kwargs, add_path=False)
+                with self.profiler.stage('parse_txt', period_name) as record:
+                    signature = Qs_manifest.path_signature(filepath)
+                    data = load_Qs_txt(self.loader, self.logger, filepath,
+                            Qs_kwargs, self.fast_reader, self.dtype_policy)
+                    record['rows'] = len(data)
+                    record['bytes'] = signature['size']
 
                 # Make pickles
-                picklepaths += self.make_pickle(pkl_name, data)
+                with self.profiler.stage('write_pickle', period_name) as record:
+                    new_paths = self.make_pickle(pkl_name, data, overwrite)
+                    record['rows'] = len(data)
+                    record['bytes'] = Qs_profiler.path_sizes(new_paths)
+                self.cache_frame(new_paths, data)
+                picklepaths += new_paths
+                self.manifest.record(filepath, signature)
 
         return picklepaths
 
+    def find_duplicate(self, period_path, Qs_names, is_current):
+        # Compare Qs.txt to Qs1.txt if either needs pickling. Returns a 
+        # Qs_fingerprint.Duplicate or None and queues the link for the 
+        # metastore.
+        if not ('Qs.txt' in Qs_names and 'Qs1.txt' in Qs_names):
+            return None
+        if is_current['Qs.txt'] and is_current['Qs1.txt']:
+            # Keep whatever was found last time
+            return None
+        # Any old link is out of date now
+        self.raw_links[period_path] = None
+        if not self.dedup:
+            return None
+
+        period_name = self.get_period_name(period_path)
+        with self.profiler.stage('fingerprint', period_name) as record:
+            duplicate = Qs_fingerprint.compare_files(
+                    pjoin(period_path, 'Qs.txt'), pjoin(period_path, 'Qs1.txt'),
+                    self.max_diff_fraction)
+            record['rows'] = None if duplicate is None else duplicate.n_rows
+
+        if duplicate is not None:
+            self.raw_links[period_path] = (
+                    self.store.path(f"{period_name}_Qs"),
+                    self.store.path(f"{period_name}_Qs1"),
+                    duplicate.kind, duplicate.diff_rows)
+        return duplicate
+
+    def log_duplicate(self, duplicate):
+        if duplicate is None:
+            return
+        kind = 'an exact' if duplicate.kind == 'exact' else 'a near'
+        self.logger.write(f"Qs.txt is {kind} copy of Qs1.txt " +
+                f"({len(duplicate.diff_rows)} of {duplicate.n_rows} " +
+                "rows differ)")
+
+    def link_duplicate(self, period_path, filepath):
+        # Store the Qs.txt frame as a link to the Qs1.txt frame
+        raw_path, original_path = self.raw_links[period_path][:2]
+        self.logger.write(f"Linking {raw_path} to {original_path}")
+        with self.profiler.stage('link_pickle',
+                self.get_period_name(period_path)):
+            new_paths = Qs_storage.link_frame(original_path, raw_path)
+        self.manifest.record(filepath)
+        if self.frame_cache is not None:
+            self.frame_cache.link(raw_path, original_path)
+        return new_paths
+
+    def cache_frame(self, paths, data):
+        if self.frame_cache is None:
+            return
+        for path in paths:
+            self.frame_cache.put(path, data)
+
+    def prepare_overwrite(self, pkl_name):
+        # Returns whether pkl_name is already stored. A linked frame is 
+        # removed first so the frame it shares files with isn't overwritten 
+        # too.
+        if not self.store.is_stored(pkl_name):
+            return False
+        if Qs_storage.is_linked(self.store.path(pkl_name)):
+            Qs_storage.remove_frame(self.store.path(pkl_name))
+        if self.frame_cache is not None:
+            self.frame_cache.discard(self.store.path(pkl_name))
+        return True
+
+    @staticmethod
+    def get_period_name(period_path):
+        _, period_name = nsplit(period_path, 1)
+        return period_name.replace('results-', '')
+
+    def write_run_report(self):
+        if not self.profiler.enabled:
+            return
+        self.logger.write(self.profiler.summary_lines())
+        report_paths = self.profiler.write_report(self.report_dir)
+        self.logger.write(["Run report written to"] + list(report_paths))
+        self.profiler.pop_records()
+
+
+    def is_pickle_current(self, pkl_name, txt_filepath):
+        # Check for a preexisting pickle that is up to date with its txt file
+        if not self.store.is_stored(pkl_name):
+            return False
+        if txt_filepath not in self.manifest.files:
+            # Pickled before there was a manifest. Assume it's current.
+            self.manifest.record(txt_filepath)
+            return True
+        return self.manifest.is_unchanged(txt_filepath)
+
+    def pickle_Qs_text_files_parallel(self, period_dict, Qs_kwargs):
+        # Same as calling pickle_Qs_text_files on every period, but the 
+        # parsing and pickling is spread over a pool of worker processes.  
+        # Workers only return pickle paths and log records, so the parent 
+        # never holds the parsed data. The metapickle merge stays here.
+        lg = self.logger
+
+        # Find which files need pickling. Results are keyed by 
+        # (period_path, file index) so the log can be written in order.
+        jobs = []
+        preexisting = {}
+        duplicates = {} # Qs.txt files to link once Qs1.txt is stored
+        period_duplicates = {}
+        for period_path in period_dict:
+            period_name = self.get_period_name(period_path)
+            # Qs.txt last, like pickle_Qs_text_files
+            Qs_names = sorted(period_dict[period_path],
+                    key=lambda name: name == 'Qs.txt')
+            period_dict[period_path] = Qs_names
+            is_current = {name : self.is_pickle_current(
+                                    f"{period_name}_{name[:-4]}",
+                                    pjoin(period_path, name))
+                          for name in Qs_names}
+            duplicate = self.find_duplicate(period_path, Qs_names, is_current)
+            period_duplicates[period_path] = duplicate
+
+            for i, name in enumerate(Qs_names):
+                pkl_name = f"{period_name}_{name[:-4]}"
+                filepath = pjoin(period_path, name)
+                if is_current[name]:
+                    preexisting[(period_path, i)] = pkl_name
+                elif name == 'Qs.txt' and duplicate is not None and \
+                        duplicate.kind == 'exact':
+                    duplicates[(period_path, i)] = filepath
+                else:
+                    overwrite = self.prepare_overwrite(pkl_name)
+                    jobs.append(((period_path, i), filepath, pkl_name,
+                                 overwrite))
+
+        lg.write(f"Pickling {len(jobs)} files with {self.max_workers} " +
+                 f"workers ({len(preexisting)} pickles preexist)")
+
+        results = {}
+        root_dir = self.root_dir
+        output_dir = self.output_dir
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = {}
+            job_iter = iter(jobs)
+            while True:
+                # Top up the pool without exceeding the in-flight limit
+                while len(in_flight) < self.max_in_flight:
+                    job = next(job_iter, None)
+                    if job is None:
+                        break
+                    key, filepath, pkl_name, overwrite = job
+                    future = executor.submit(_pickle_Qs_text_file, root_dir,
+                            output_dir, filepath, pkl_name, Qs_kwargs,
+                            self.fast_reader, self.storage_format, overwrite,
+                            self.profiler.enabled, self.dtype_policy)
+                    in_flight[future] = (key, filepath)
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, filepath = in_flight.pop(future)
+                    # Raises the worker's error, if any
+                    new_paths, log_records, signature, stage_records = \
+                            future.result()
+                    results[key] = (new_paths, log_records)
+                    self.profiler.extend(stage_records)
+                    self.manifest.record(filepath, signature)
+
+        # Write the logs in the same order as a serial run
+        pickle_dict = {}
+        for period_path in period_dict:
+            lg.write(f"Extracting {period_path}")
+            lg.increase_global_indent()
+            self.log_duplicate(period_duplicates[period_path])
+
+            picklepaths = []
+            for i in range(len(period_dict[period_path])):
+                key = (period_path, i)
+                if key in preexisting:
+                    lg.debug(f'Pickle {preexisting[key]} preexists. Nothing to do.')
+                elif key in duplicates:
+                    picklepaths += self.link_duplicate(period_path,
+                            duplicates[key])
+                else:
+                    new_paths, log_records = results[key]
+                    replay_records(lg, log_records)
+                    picklepaths += new_paths
+
+            pickle_dict[period_path] = picklepaths
+            lg.decrease_global_indent()
+
+        return pickle_dict
 
     def make_pickle(self, pkl_name, data, overwrite=False):
-        self.logger.write(f"Performing picklery on {pkl_name}")
+        self.logger.debug(f"Performing picklery on {pkl_name}")
         self.logger.increase_global_indent()
 
-        picklepaths = self.loader.produce_pickles({pkl_name:data}, overwrite=overwrite)
+        if isinstance(data, pd.DataFrame):
+            # Qs frames go to the configured storage backend
+            picklepaths = self.store.save(pkl_name, data, overwrite=overwrite)
+        else:
+            picklepaths = self.loader.produce_pickles({pkl_name:data}, overwrite=overwrite)
         self.logger.decrease_global_indent()
         return picklepaths
 
 
+def load_Qs_txt(loader, logger, filepath, Qs_kwargs, fast_reader=True,
+        dtype_policy=None):
+    # Read a Qs#.txt file. Tries the fixed schema reader first and falls back 
+    # to the generic loader if the file is malformed. dtype_policy can 
+    # compact the columns (see Qs_dtypes.py).
+    data = None
+    if fast_reader:
+        data = read_Qs_txt(filepath, Qs_kwargs['names'])
+        if data is None:
+            logger.write(f"Fast reader could not parse {filepath}. " +
+                         "Using generic loader.")
+    if data is None:
+        data = loader.load_txt(filepath, Qs_kwargs, add_path=False)
+    if dtype_policy is not None:
+        data = dtype_policy.apply(data, logger, filepath)
+    return data
+
+def _pickle_Qs_text_file(root_dir, output_dir, filepath, pkl_name, Qs_kwargs,
+        fast_reader=True, storage_format='pickle', overwrite=False,
+        profile=True, dtype_policy=None):
+    # Parse and pickle one Qs#.txt file in a worker process. Returns the new 
+    # pickle paths, the recorded log calls, the txt file signature, and the 
+    # stage records.
+    recorder = LogRecorder()
+    profiler = Qs_profiler.StageProfiler('QsExtractor', enabled=profile)
+    period_name = pkl_name.rsplit('_', 1)[0]
+    loader = data_loading.DataLoader(root_dir, output_dir, recorder)
+    store = Qs_storage.make_store(storage_format, output_dir, loader, recorder)
+
+    if overwrite:
+        name = nsplit(filepath, 1)[1]
+        recorder.write(f'{name} changed. Pickling {pkl_name} again')
+    else:
+        recorder.write(f'Pickling {pkl_name}')
+    with profiler.stage('parse_txt', period_name) as record:
+        signature = Qs_manifest.path_signature(filepath)
+        data = load_Qs_txt(loader, recorder, filepath, Qs_kwargs, fast_reader,
+                dtype_policy)
+        record['rows'] = len(data)
+        record['bytes'] = signature['size']
+
+    recorder.write(f"Performing picklery on {pkl_name}")
+    recorder.increase_global_indent()
+    with profiler.stage('write_pickle', period_name) as record:
+        picklepaths = store.save(pkl_name, data, overwrite=overwrite)
+        record['rows'] = len(data)
+        record['bytes'] = Qs_profiler.path_sizes(picklepaths)
+    recorder.decrease_global_indent()
+
+    return picklepaths, recorder.pop_records(), signature, \
+            profiler.pop_records()
+
+
 #if __name__ == "__main__":
 #    crawler = QsExtractor()
 #    exp_root = '/home/alex/ubc/research/feed-timing/data'
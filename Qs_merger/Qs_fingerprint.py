@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Fingerprints for spotting Qs.txt files that are copies of Qs1.txt.
+#
+# A lot of periods have a Qs.txt that is a near copy of Qs1.txt: the first row
+# is usually different and sometimes a random row has a grain count 1 off
+# (see the note at the top of Qs_extractor.py). Parsing and storing both, then
+# comparing the full frames in the processor, is mostly wasted work.
+#
+# The two txt files are compared as bytes before anything is parsed:
+#   exact : the files are the same. The Qs.txt frame is stored as a hard link
+#           to the Qs1.txt frame instead of being parsed and saved again.
+#   near  : same number of rows and at most max_diff_fraction of them differ.
+#           Each row (line) is hashed, and the positions of the rows whose
+#           hashes differ are kept.
+# The result goes in the metastore (see MetaStore.set_link). When a period
+# only has Qs.txt and Qs1.txt, the processor's difference check only compares
+# the recorded rows. Rows that are the same text in both files parse to the
+# same values, and can never count as different (see Qs_diff.diff_frames_at),
+# so the result is the same as comparing the full frames.
+#
+# Row hashes use Python's hash, so they are only compared within one process
+# and never stored.
+
+import numpy as np
+
+duplicate_kinds = ['exact', 'near']
+
+
+class Duplicate:
+    # How a raw file copies another one
+
+    def __init__(self, kind, diff_rows, n_rows):
+        self.kind = kind
+        self.diff_rows = diff_rows # int64 positions of the differing rows
+        self.n_rows = n_rows
+
+    def __repr__(self):
+        return f"Duplicate({self.kind}, {len(self.diff_rows)} rows differ)"
+
+
+def split_rows(text):
+    # One bytes object per row. Returns None if the rows can't be lined up
+    # with the parsed frame (eg. blank lines, which the readers skip).
+    rows = text.split(b'\n')
+    if rows and rows[-1] == b'':
+        rows.pop()
+    rows = [row[:-1] if row.endswith(b'\r') else row for row in rows]
+    if any(not row for row in rows):
+        return None
+    return rows
+
+def row_hashes(rows):
+    return np.fromiter(map(hash, rows), dtype=np.int64, count=len(rows))
+
+def compare_files(path, original_path, max_diff_fraction=0.01):
+    # Returns a Duplicate if path is an exact or near copy of original_path,
+    # otherwise None
+    with open(path, 'rb') as txt_file:
+        text = txt_file.read()
+    with open(original_path, 'rb') as txt_file:
+        original_text = txt_file.read()
+
+    rows = split_rows(text)
+    original_rows = split_rows(original_text)
+    if rows is None or original_rows is None or \
+            len(rows) != len(original_rows) or not rows:
+        return None
+    if text == original_text:
+        return Duplicate('exact', np.empty(0, dtype=np.int64), len(rows))
+
+    diff_rows = np.flatnonzero(row_hashes(rows) != row_hashes(original_rows))
+    if len(diff_rows) > max_diff_fraction * len(rows):
+        return None
+    return Duplicate('near', diff_rows.astype(np.int64), len(rows))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# In memory cache of raw Qs frames, keyed by their stored path.
+#
+# A combined run (Qs_cli.run) parses every new Qs#.txt file in the extractor,
+# stores it, and then the processor loads the same frame straight back from
+# the store. With a FrameCache shared between the two, the extractor also
+# puts each frame it stores in the cache and the processor takes it from there
+# instead of reading the file again. The frames are still stored as usual, so
+# later runs (and anything the cache dropped) load from the store.
+#
+# The cache is bounded by max_bytes (the memory_usage of the frames). When it
+# is full, the least recently used frames are dropped first. A frame bigger
+# than the whole budget isn't cached at all. Each raw frame is only merged
+# once, so the processor takes frames out of the cache (take) rather than
+# leaving them in. A frame cached under several paths (see link) is only
+# counted once.
+#
+# Frames are shared, not copied, so nothing may write to a frame after it is
+# put in the cache or after it is taken out (see Qs0_is_shared in
+# Qs_pickle_processor.py). The cache is locked so the pipeline's prefetch
+# thread can use it too.
+
+import threading
+from collections import OrderedDict
+
+
+def frame_nbytes(data):
+    return int(data.memory_usage(index=True).sum())
+
+
+class FrameCache:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.frames = OrderedDict() # path : (frame, nbytes), oldest first
+        self.frame_paths = {} # id(frame) : number of paths it is cached under
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, path):
+        return path in self.frames
+
+    def put(self, path, data):
+        # Returns whether the frame was cached
+        nbytes = frame_nbytes(data)
+        with self.lock:
+            self._drop(path)
+            if nbytes > self.max_bytes:
+                return False
+            while self.frames and self._new_bytes(data, nbytes) + \
+                    self.nbytes > self.max_bytes:
+                self._drop(next(iter(self.frames)))
+                self.evictions += 1
+            self.nbytes += self._new_bytes(data, nbytes)
+            self.frames[path] = (data, nbytes)
+            self.frame_paths[id(data)] = self.frame_paths.get(id(data), 0) + 1
+            return True
+
+    def get(self, path):
+        # The frame or None. Marks the frame as recently used.
+        with self.lock:
+            entry = self.frames.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.frames.move_to_end(path)
+            return entry[0]
+
+    def take(self, path):
+        # Like get, but the frame leaves the cache
+        with self.lock:
+            entry = self.frames.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._drop(path)
+            return entry[0]
+
+    def link(self, path, original_path):
+        # Cache the frame of original_path under path too (eg. a Qs.txt frame
+        # stored as a link to the Qs1.txt frame). Doesn't count as a hit.
+        with self.lock:
+            entry = self.frames.get(original_path)
+        return entry is not None and self.put(path, entry[0])
+
+    def discard(self, path):
+        # Forget a frame that changed in the store
+        with self.lock:
+            self._drop(path)
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.frame_paths.clear()
+            self.nbytes = 0
+
+    def summary(self):
+        # For the logs
+        return (f"Frame cache: {self.hits} hits, {self.misses} misses, " +
+                f"{self.evictions} evicted, {len(self.frames)} frames " +
+                f"({self.nbytes / 2**20:.1f} MiB) left")
+
+    def _new_bytes(self, data, nbytes):
+        # Bytes added by caching data, 0 if it is already cached. Caller 
+        # holds the lock.
+        return 0 if id(data) in self.frame_paths else nbytes
+
+    def _drop(self, path):
+        # Caller holds the lock. The bytes are freed with the frame's last 
+        # path.
+        entry = self.frames.pop(path, None)
+        if entry is None:
+            return
+        key = id(entry[0])
+        self.frame_paths[key] -= 1
+        if self.frame_paths[key] == 0:
+            del self.frame_paths[key]
+            self.nbytes -= entry[1]
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# The LogRecorder stands in for a helpyr Logger inside worker processes. Each
+# logger call is recorded instead of written, then the parent process replays
+# the records onto the real logger. This keeps the log file in the same order
+# as a serial run no matter which worker finishes first.
+
+from Qs_logging import log_levels
+
+
+class LogRecorder:
+
+    def __init__(self, level='debug'):
+        self.records = [] # list of (method name, args, kwargs)
+        # Calls below the level are still recorded (the real logger drops
+        # them), but is_enabled lets the caller skip building big messages
+        self.level = log_levels[level]
+
+    def __getattr__(self, name):
+        # Any logger method not defined here is recorded as-is.
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def record(*args, **kwargs):
+            self.records.append((name, args, kwargs))
+        return record
+
+    def run_indented_function(self, function, before_msg=None, after_msg=None):
+        # Mimics helpyr's Logger.run_indented_function, but the function has
+        # to actually run here. Only the log calls around it are recorded.
+        if before_msg is not None:
+            self.write(before_msg)
+        self.increase_global_indent()
+        output = function()
+        self.decrease_global_indent()
+        if after_msg is not None:
+            self.write(after_msg)
+        return output
+
+    def is_enabled(self, level):
+        return log_levels[level] >= self.level
+
+    def clear(self):
+        self.records = []
+
+    def pop_records(self):
+        records = self.records
+        self.records = []
+        return records
+
+
+def replay_records(logger, records):
+    # Replay recorded calls onto a real logger
+    for name, args, kwargs in records:
+        getattr(logger, name)(*args, **kwargs)
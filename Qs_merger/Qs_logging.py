@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# Leveled logging for the extractor and processor.
+#
+# Two log modes (log_mode in settings.py):
+#   text     : the helpyr Logger, which opens the log file and writes every
+#              line as it is logged. Wrapped in a LeveledLogger to add the
+#              levels and period records.
+#   buffered : BufferedLogger keeps the lines in memory and hands them to a
+#              background thread in batches. The thread appends each batch to
+#              the log file (and the console) with one write, so logging stays
+#              off the hot path. Everything is written by end_output (or at
+#              exit).
+#
+# Levels are 'debug', 'info', and 'warning'. Bulky details are debug only: the
+# full list of overlapped timestamps, the conflicting rows, and the per file
+# pickling chatter. At 'info' the overlapped and conflicting rows are logged
+# as short ranges instead (see format_ranges), eg.
+#   rows 120-139 (3640694546.000000-3640694565.000000), 300 (...)
+# 'debug' logs the same lines as the helpyr Logger always did.
+#
+# Both modes also write a json lines file next to the log with one record per
+# period (status, error codes like CQF/NDF/MMD, row counts), so a run can be
+# filtered without reading the log:
+#   python -c "import json; [print(r['name']) for r in map(json.loads,
+#       open('QsPickleProcessor-periods.jsonl')) if 'MMD' in r['errors']]"
+# The records file is emptied when the logger is made (ie. at the start of a
+# run) and each record is appended as soon as it is written, so the file can
+# be read while a watch is running and a crash only loses the current period.
+
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+from time import asctime
+
+import numpy as np
+
+log_levels = {'debug' : 10, 'info' : 20, 'warning' : 30}
+log_modes = ['text', 'buffered']
+
+
+def level_number(level):
+    if level not in log_levels:
+        raise ValueError(f"Unknown log level {level}. " +
+                         f"Choose from {list(log_levels)}")
+    return log_levels[level]
+
+def records_path_for(log_filepath):
+    # QsPickleProcessor.txt -> QsPickleProcessor-periods.jsonl
+    return f"{os.path.splitext(log_filepath)[0]}-periods.jsonl"
+
+def make_logger(log_filepath, mode='text', level='debug', default_verbose=True,
+        records_path=None):
+    # The logger for a log mode. helpyr is only needed for the text mode.
+    if records_path is None:
+        records_path = records_path_for(log_filepath)
+    if mode == 'text':
+        from helpyr import logger as hlp_logger
+        logger = hlp_logger.Logger(log_filepath,
+                default_verbose=default_verbose)
+        return LeveledLogger(logger, level, records_path)
+    elif mode == 'buffered':
+        return BufferedLogger(log_filepath, default_verbose, level,
+                records_path=records_path)
+    else:
+        raise ValueError(f"Unknown log mode {mode}. Choose from {log_modes}")
+
+
+## Range summaries
+
+def find_runs(values):
+    # [(first position, last position)] of each run of consecutive integers
+    # in a sorted array
+    values = np.asarray(values, dtype=np.int64)
+    if values.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(values) != 1)
+    starts = np.concatenate([[0], breaks + 1])
+    ends = np.concatenate([breaks, [values.size - 1]])
+    return list(zip(starts.tolist(), ends.tolist()))
+
+def format_ranges(rows, times=None, max_ranges=20):
+    # Rows as ranges, eg. "120-139, 300". times (same length as rows) adds the
+    # first and last time of each range.
+    rows = np.asarray(rows)
+    runs = find_runs(rows)
+    parts = []
+    for first, last in runs[:max_ranges]:
+        if first == last:
+            part = f"{rows[first]}"
+            if times is not None:
+                part += f" ({times[first]:f})"
+        else:
+            part = f"{rows[first]}-{rows[last]}"
+            if times is not None:
+                part += f" ({times[first]:f}-{times[last]:f})"
+        parts.append(part)
+    if len(runs) > max_ranges:
+        parts.append(f"... {len(runs) - max_ranges} more ranges")
+    return ', '.join(parts)
+
+
+## Period records
+
+class PeriodRecordWriter:
+    # Writes the per period records as json lines. The last run's records are
+    # removed when it is made.
+
+    def __init__(self, path):
+        self.path = path
+        self.run_started = asctime()
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            open(path, 'w').close()
+
+    def add(self, record):
+        if self.path is None:
+            return
+        record = dict(record)
+        record.setdefault('run', self.run_started)
+        # One write per record so a partly written file is still whole lines
+        with open(self.path, 'a') as records_file:
+            records_file.write(json.dumps(record, default=str) + '\n')
+
+    def close(self):
+        # Every record is already in the file
+        pass
+
+
+## Loggers
+
+class LeveledLogger:
+    # Adds levels and period records to a helpyr Logger. Everything else is
+    # passed straight through.
+
+    def __init__(self, logger, level='debug', records_path=None):
+        self.logger = logger
+        self.level = level_number(level)
+        self.records = PeriodRecordWriter(records_path)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.logger, name)
+
+    def is_enabled(self, level):
+        return log_levels[level] >= self.level
+
+    def debug(self, msg, local_indent=0):
+        if self.is_enabled('debug'):
+            self.logger.write(msg, local_indent=local_indent)
+
+    def debug_dataframe(self, data, name=''):
+        if self.is_enabled('debug'):
+            self.logger.write_dataframe(data, name)
+
+    def write_period_record(self, record):
+        self.records.add(record)
+
+    def end_output(self):
+        self.records.close()
+        self.logger.end_output()
+
+
+class BufferedLogger:
+    # Same calls as the helpyr Logger, but lines are written in batches by a
+    # background thread
+
+    def __init__(self, log_filepath, default_verbose=True, level='info',
+            flush_lines=2000, records_path=None, tab='    '):
+        self.log_filepath = log_filepath
+        self.default_verbose = default_verbose
+        self.level = level_number(level)
+        self.flush_lines = flush_lines
+        self.tab = tab
+        self.global_indent = 0
+        self.records = PeriodRecordWriter(records_path)
+        os.makedirs(os.path.dirname(os.path.abspath(log_filepath)),
+                exist_ok=True)
+
+        self.buffer = []
+        self.batches = queue.Queue()
+        self.errors = []
+        self.closed = False
+        self.thread = threading.Thread(target=self._write_loop,
+                name='Qs-log-writer', daemon=True)
+        self.thread.start()
+        # Don't lose the buffered lines if the run dies
+        atexit.register(self.close)
+
+    def is_enabled(self, level):
+        return log_levels[level] >= self.level
+
+    def write(self, msg, verbose=None, local_indent=0):
+        if self.closed:
+            return
+        msgs = msg if isinstance(msg, list) else [msg]
+        indent = self.tab * (self.global_indent + local_indent)
+        self.buffer.extend(f"{indent}{m}" for m in msgs)
+        if len(self.buffer) >= self.flush_lines:
+            self.flush(wait=False)
+
+    def debug(self, msg, local_indent=0):
+        if self.is_enabled('debug'):
+            self.write(msg, local_indent=local_indent)
+
+    def warning(self, msg, local_indent=0):
+        msgs = msg if isinstance(msg, list) else [msg]
+        self.write(["Warning!"] + msgs, local_indent=local_indent)
+
+    def write_blankline(self, n_lines=1):
+        self.write([''] * n_lines)
+
+    def write_section_break(self):
+        self.write(['', '#' * 80, ''])
+
+    def write_dataframe(self, data, name=''):
+        self.write(f"{name}:")
+        self.write(data.to_string().split('\n'), local_indent=1)
+
+    def debug_dataframe(self, data, name=''):
+        if self.is_enabled('debug'):
+            self.write_dataframe(data, name)
+
+    def increase_global_indent(self, n=1):
+        self.global_indent += n
+
+    def decrease_global_indent(self, n=1):
+        self.global_indent = max(0, self.global_indent - n)
+
+    def run_indented_function(self, function, before_msg=None, after_msg=None):
+        if before_msg is not None:
+            self.write(before_msg)
+        self.increase_global_indent()
+        try:
+            output = function()
+        finally:
+            self.decrease_global_indent()
+        if after_msg is not None:
+            self.write(after_msg)
+        return output
+
+    def write_period_record(self, record):
+        self.records.add(record)
+
+    def flush(self, wait=True):
+        # Hand the buffered lines to the writer thread. wait blocks until
+        # they are in the file and raises the first error the writer hit.
+        if self.buffer:
+            self.batches.put(self.buffer)
+            self.buffer = []
+        if wait:
+            self.batches.join()
+            self._raise_errors()
+
+    def _raise_errors(self):
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+    def end_output(self):
+        self.write(["End of output", asctime()])
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush(wait=False)
+        self.closed = True
+        self.batches.put(None)
+        self.thread.join()
+        self.records.close()
+        self._raise_errors()
+
+    def _write_loop(self):
+        while True:
+            lines = self.batches.get()
+            try:
+                if lines is None:
+                    return
+                text = '\n'.join(lines) + '\n'
+                with open(self.log_filepath, 'a') as log_file:
+                    log_file.write(text)
+                if self.default_verbose:
+                    sys.stdout.write(text)
+            except Exception as error:
+                self.errors.append(error)
+            finally:
+                self.batches.task_done()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# Build manifest for incremental reruns.
+#
+# Records the size, mtime, and content hash of every raw Qs#.txt file, raw Qs#
+# frame, and merged output, plus which inputs each merged period was built
+# from. On a rerun, a file whose size and mtime match the manifest is assumed
+# unchanged. If they differ, the file is hashed and only counts as changed if
+# the content is different (so touching a file does not trigger a rebuild).
+#
+# The manifest is a json file next to the metapickle:
+#   'files'   : {path : {'size', 'mtime_ns', 'hash'}}
+#   'periods' : {period_path : {'inputs' : {path : hash},
+#                               'outputs' : {path : hash}}}
+#
+# A manifest without a path only lives in memory. period_manifest makes one
+# with a single period's records, which is all a worker process needs.
+
+import hashlib
+import json
+import os
+from os.path import join as pjoin
+
+hash_block_size = 2**20
+
+
+def hash_path(path):
+    # Hash a file, or every file in a directory (eg. an npy store frame)
+    hasher = hashlib.sha1()
+    if os.path.isdir(path):
+        for fname in sorted(os.listdir(path)):
+            hasher.update(fname.encode())
+            _hash_file(pjoin(path, fname), hasher)
+    else:
+        _hash_file(path, hasher)
+    return hasher.hexdigest()
+
+def _hash_file(filepath, hasher):
+    with open(filepath, 'rb') as hash_file:
+        for block in iter(lambda: hash_file.read(hash_block_size), b''):
+            hasher.update(block)
+
+def path_signature(path):
+    # Full signature of a path, always hashing it
+    size, mtime_ns = stat_path(path)
+    return {'size' : size, 'mtime_ns' : mtime_ns, 'hash' : hash_path(path)}
+
+def stat_path(path):
+    # Returns (size, mtime_ns). Directories use the total size and latest
+    # mtime of their files.
+    if os.path.isdir(path):
+        stats = [os.stat(pjoin(path, f)) for f in os.listdir(path)]
+        return (sum(s.st_size for s in stats),
+                max((s.st_mtime_ns for s in stats), default=0))
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class BuildManifest:
+
+    def __init__(self, manifest_path=None):
+        self.manifest_path = manifest_path
+        self.files = {}
+        self.periods = {}
+        if manifest_path is not None and os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as manifest_file:
+                stored = json.load(manifest_file)
+            self.files = stored.get('files', {})
+            self.periods = stored.get('periods', {})
+
+    def save(self):
+        # Write to a temp file first so an interrupted run can't corrupt it
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump({'files' : self.files, 'periods' : self.periods},
+                    manifest_file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def signature(self, path):
+        # Get the current signature of a path, only hashing it if the size or
+        # mtime changed since it was last recorded. Returns None if the path
+        # does not exist.
+        if not os.path.exists(path):
+            return None
+        size, mtime_ns = stat_path(path)
+        known = self.files.get(path)
+        if known is not None and \
+                known['size'] == size and known['mtime_ns'] == mtime_ns:
+            return known
+
+        return path_signature(path)
+
+    def record(self, path, signature=None):
+        # Record a path's current signature. Returns the content hash.
+        if signature is None:
+            signature = self.signature(path)
+        if signature is None:
+            self.files.pop(path, None)
+            return None
+        self.files[path] = signature
+        return signature['hash']
+
+    def is_stat_unchanged(self, path):
+        # Cheaper is_unchanged that never hashes. The path has to have the
+        # recorded size and mtime. Touched files count as changed.
+        known = self.files.get(path)
+        if known is None or not os.path.exists(path):
+            return False
+        return stat_path(path) == (known['size'], known['mtime_ns'])
+
+    def is_unchanged(self, path):
+        # True if the path's content matches the manifest. Paths that are not
+        # in the manifest count as changed.
+        known = self.files.get(path)
+        if known is None:
+            return False
+        current = self.signature(path)
+        if current is None or current['hash'] != known['hash']:
+            return False
+        # Same content. Remember the new mtime so it isn't hashed next time.
+        self.files[path] = current
+        return True
+
+    def is_period_current(self, period_path, input_paths):
+        # True if the period was built from exactly these inputs, none of
+        # them have changed, and its outputs are untouched. Returns None if
+        # the period has no build record.
+        record = self.periods.get(period_path)
+        if record is None:
+            return None
+        if sorted(record['inputs']) != sorted(input_paths):
+            return False
+
+        for path, known_hash in record['inputs'].items():
+            current = self.signature(path)
+            if current is None or current['hash'] != known_hash:
+                return False
+        for path, known_hash in record['outputs'].items():
+            current = self.signature(path)
+            if current is None or current['hash'] != known_hash:
+                return False
+        return True
+
+    def make_period_record(self, input_paths, output_paths):
+        # Build a record of a period's inputs and outputs. Also returns the
+        # file signatures so a worker process can send them to the parent.
+        signatures = {}
+        record = {'inputs' : {}, 'outputs' : {}}
+        for key, paths in [('inputs', input_paths), ('outputs', output_paths)]:
+            for path in paths:
+                signature = self.signature(path)
+                if signature is None:
+                    continue
+                signatures[path] = signature
+                record[key][path] = signature['hash']
+        return record, signatures
+
+    def period_manifest(self, period_path, input_paths):
+        # In memory manifest with only what is known about this period's 
+        # current inputs and its last build
+        manifest = BuildManifest()
+        record = self.periods.get(period_path)
+        paths = list(input_paths)
+        if record is not None:
+            manifest.periods[period_path] = record
+            paths += list(record['inputs']) + list(record['outputs'])
+        manifest.files = {path : self.files[path] for path in paths
+                          if path in self.files}
+        return manifest
+
+    def replace_paths(self, path_map):
+        # Move the records of converted files to their new paths, eg. after 
+        # a storage format migration (Qs_storage.py). A file that still has 
+        # its recorded content is recorded again under its new path. The 
+        # others keep their old hash, so they still count as changed.
+        new_hashes = {}
+        for old_path, new_path in path_map.items():
+            known = self.files.get(old_path)
+            if known is None:
+                continue
+            current = self.signature(old_path)
+            del self.files[old_path]
+            if current is not None and current['hash'] == known['hash']:
+                new_hashes[old_path] = (known['hash'], self.record(new_path))
+
+        for record in self.periods.values():
+            for key in ['inputs', 'outputs']:
+                paths = record[key]
+                record[key] = {}
+                for path, known_hash in paths.items():
+                    old_hash, new_hash = new_hashes.get(path, (None, None))
+                    if known_hash == old_hash:
+                        known_hash = new_hash
+                    record[key][path_map.get(path, path)] = known_hash
+
+    def update_period(self, period_path, record, signatures):
+        self.periods[period_path] = record
+        self.files.update(signatures)
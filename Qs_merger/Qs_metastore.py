@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Indexed replacement for the metapickle.
+#
+# The metapickle was one pickled dict of {period path : [raw Qs# frame paths]}
+# that was loaded, merged, re-sorted, and rewritten in full every run. The
+# MetaStore keeps the same mapping in a SQLite file instead:
+#   periods   : (period_path) in the order they were first added
+#   raw_files : (period_path, raw_path, file_num), indexed by period
+#   raw_links : (period_path, raw_path, original_path, kind, diff_rows) for
+#               Qs.txt frames that copy the Qs1.txt frame (see
+#               Qs_fingerprint.py). diff_rows are the int64 row positions
+#               that differ, as bytes.
+# Adding a period's paths only inserts the new rows, and looking up a period
+# only reads that period's rows. The paths come back sorted by Qs file number
+# like the old metapickle lists.
+#
+# SQLite handles the locking, so an extractor can add periods while a
+# processor is reading them. The database uses write-ahead logging so readers
+# don't block the writer.
+#
+# Write-ahead logging only works for connections on one host, so it can't be
+# used by the nodes of a sharded run on a network filesystem (see
+# Qs_shard.py). Once the extraction is done, share_metastore switches the
+# file back to a plain rollback journal, and the nodes open it read only
+# (MetaStore(path, read_only=True)) so they never lock or write it.
+#
+# MetaStore acts like a read only dict (store[period_path], iteration over
+# period paths, len, in), so it can be used anywhere the metapickle dict was.
+
+import os
+import pathlib
+import pickle
+import sqlite3
+from collections.abc import Mapping
+
+# Seconds to wait for another process's write to finish
+lock_timeout = 60
+
+
+def Qs_file_num(path):
+    # File number of a raw Qs# frame path, eg. .../K01_0100_Qs12.pkl -> 12.
+    # Qs (Qs.txt) is 0.
+    name = os.path.basename(path).rsplit('_', 1)[-1].split('.')[0]
+    return int(name[2:]) if name[2:].isdigit() else 0
+
+
+def uses_wal(db_path):
+    # The file format write version in the database header is 2 for 
+    # write-ahead logging
+    with open(db_path, 'rb') as db_file:
+        header = db_file.read(20)
+    return len(header) == 20 and header[18] == 2
+
+
+class MetaStore(Mapping):
+
+    def __init__(self, db_path, read_only=False):
+        # read_only opens the file as immutable: no locks, no journal, and no 
+        # writes. It must not change while it is open this way.
+        self.db_path = db_path
+        self.read_only = read_only
+        if read_only:
+            if uses_wal(db_path):
+                raise ValueError(f"{db_path} uses write-ahead logging and " +
+                        "can't be opened read only. Run Qs-merger " +
+                        "--extract-only to share it.")
+            uri = f"{pathlib.Path(db_path).absolute().as_uri()}" + \
+                    "?mode=ro&immutable=1"
+            self.connection = sqlite3.connect(uri, uri=True)
+            return
+        self.connection = sqlite3.connect(db_path, timeout=lock_timeout)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS periods (
+                    period_path TEXT PRIMARY KEY)""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS raw_files (
+                    period_path TEXT NOT NULL,
+                    raw_path TEXT NOT NULL,
+                    file_num INTEGER NOT NULL,
+                    PRIMARY KEY (period_path, raw_path))""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS raw_links (
+                    period_path TEXT NOT NULL,
+                    raw_path TEXT NOT NULL,
+                    original_path TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    diff_rows BLOB NOT NULL,
+                    PRIMARY KEY (period_path, raw_path))""")
+
+    def close(self):
+        self.connection.close()
+
+    def share(self):
+        # Fold the write-ahead log into the database and switch to a rollback 
+        # journal so it can be read from other hosts. The next writable open 
+        # switches back.
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+
+    def add_paths(self, period_path, raw_paths):
+        # Add raw frame paths to a period. Paths already in the period are
+        # ignored. The period is added even if raw_paths is empty.
+        self.add_periods({period_path : raw_paths})
+
+    def add_periods(self, period_dict):
+        # Add {period path : [raw paths]} in one transaction
+        with self.connection:
+            for period_path, raw_paths in period_dict.items():
+                self.connection.execute(
+                        "INSERT OR IGNORE INTO periods VALUES (?)",
+                        (period_path,))
+                self.connection.executemany(
+                        "INSERT OR IGNORE INTO raw_files VALUES (?, ?, ?)",
+                        [(period_path, p, Qs_file_num(p)) for p in raw_paths])
+
+    def replace_paths(self, path_map):
+        # Point raw paths at new files, eg. after a storage format migration
+        pairs = [(new, old) for old, new in path_map.items()]
+        with self.connection:
+            self.connection.executemany(
+                    "UPDATE raw_files SET raw_path = ? WHERE raw_path = ?",
+                    pairs)
+            self.connection.executemany(
+                    "UPDATE raw_links SET raw_path = ? WHERE raw_path = ?",
+                    pairs)
+            self.connection.executemany(
+                    "UPDATE raw_links SET original_path = ? " +
+                    "WHERE original_path = ?", pairs)
+
+    def set_links(self, link_dict):
+        # {period path : link or None}. A link is (raw_path, original_path,
+        # kind, diff_rows). Replaces the period's old links, None just
+        # removes them.
+        import numpy as np # not imported up front, see Qs_cli.py
+        with self.connection:
+            for period_path, link in link_dict.items():
+                self.connection.execute(
+                        "DELETE FROM raw_links WHERE period_path = ?",
+                        (period_path,))
+                if link is None:
+                    continue
+                raw_path, original_path, kind, diff_rows = link
+                self.connection.execute(
+                        "INSERT INTO raw_links VALUES (?, ?, ?, ?, ?)",
+                        (period_path, raw_path, original_path, kind,
+                         np.asarray(diff_rows, dtype='<i8').tobytes()))
+
+    def links(self, period_path):
+        # {raw path : (original path, kind, diff rows)} for a period
+        import numpy as np
+        rows = self.connection.execute("""SELECT raw_path, original_path,
+                kind, diff_rows FROM raw_links WHERE period_path = ?""",
+                (period_path,))
+        return {raw_path : (original_path, kind,
+                            np.frombuffer(diff_rows, dtype='<i8').copy())
+                for raw_path, original_path, kind, diff_rows in rows}
+
+    def periods(self):
+        rows = self.connection.execute(
+                "SELECT period_path FROM periods ORDER BY rowid")
+        return [row[0] for row in rows]
+
+    def __getitem__(self, period_path):
+        rows = self.connection.execute("""SELECT raw_path FROM raw_files
+                WHERE period_path = ? ORDER BY file_num, raw_path""",
+                (period_path,)).fetchall()
+        if not rows and period_path not in self:
+            raise KeyError(period_path)
+        return [row[0] for row in rows]
+
+    def __contains__(self, period_path):
+        row = self.connection.execute(
+                "SELECT 1 FROM periods WHERE period_path = ?",
+                (period_path,)).fetchone()
+        return row is not None
+
+    def __iter__(self):
+        return iter(self.periods())
+
+    def __len__(self):
+        return self.connection.execute(
+                "SELECT COUNT(*) FROM periods").fetchone()[0]
+
+
+def open_metastore(db_path, metapickle_path=None, read_only=False):
+    # Open the MetaStore. If it is new and an old metapickle exists, the old
+    # mapping is copied into it (not when read only).
+    if read_only:
+        return MetaStore(db_path, read_only=True)
+    store = MetaStore(db_path)
+    if metapickle_path is not None and os.path.isfile(metapickle_path) \
+            and len(store) == 0:
+        with open(metapickle_path, 'rb') as metapickle_file:
+            store.add_periods(pickle.load(metapickle_file))
+    return store
+
+def share_metastore(db_path):
+    # Get a metastore ready for the nodes of a sharded run
+    store = MetaStore(db_path)
+    try:
+        store.share()
+    finally:
+        store.close()
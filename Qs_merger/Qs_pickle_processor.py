@@ -2,8 +2,11 @@
 
 # Qs# pickles are panda dataframes directly translated from the raw txt files
 
-import matplotlib.pyplot as plt
+import copy
+import os
 from os.path import join as pjoin
+import types
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from time import asctime
@@ -12,11 +15,24 @@ from time import sleep
 
 # From Helpyr
 from helpyr import data_loading
-from helpyr import logger
 from helpyr import helpyr_misc as hm
 
 import settings
-import Qs_extractor
+from Qs_log_buffer import LogRecorder, replay_records
+import Qs_logging
+import Qs_storage
+import Qs_combine
+import Qs_clean
+import Qs_manifest
+from Qs_stream import StreamingMerge
+import Qs_stats
+import Qs_profiler
+import Qs_metastore
+import Qs_diff
+import Qs_txt_writer
+import Qs_dtypes
+import Qs_pipeline
+import Qs_shard
 
 
 # Primary Pickle Processor takes raw Qs and Qsn pickles and condenses them into 
@@ -44,152 +60,772 @@ class QsPickleProcessor:
             'CQF' : "Conflicting Qs files",
             'NDF' : "No Data Found",
             'MMD' : "Mismatched Data",
+            'PSF' : "Period Stage Failed",
             }
 
-    def __init__(self, output_txt=False, metapickle_path=None):
+    def __init__(self, output_txt=False, metapickle_path=None,
+            max_workers=None, logger=None, pipeline=None, frame_cache=None,
+            shard_queue=None, manifest=None):
+        # Sharded runs claim periods from a Qs_shard.LeaseQueue shared with 
+        # other nodes. Each node gets its own log file and run report.
+        self.shard_queue = shard_queue
+        component = 'QsPickleProcessor'
+        if shard_queue is not None:
+            component = f"{component}-{shard_queue.node_id}"
+
         # File locations
         self.root_dir = settings.root_dir
         self.pickle_source = settings.Qs_raw_pickles_dir
         self.pickle_destination = settings.Qs_merged_pickles_dir
         self.txt_destination = settings.Qs_merged_txt_dir
-        self.log_filepath = pjoin(settings.root_dir, 'log-files', 'QsPickleProcessor.txt')
+        self.log_filepath = pjoin(settings.root_dir, 'log-files', f'{component}.txt')
         self.metapickle_path = metapickle_path
-        self.statspickle_name = "Qs_summary_stats"
+        self.metapickle = None # opened by open_metapickle
+        self.statspickle_name = settings.statspickle_name
         self.output_txt = output_txt
+
+        # Number of worker processes for processing periods. None or 1 runs 
+        # every period in this process.
+        self.max_workers = max_workers
+
+        # Overlap loading the next period and writing the last one with 
+        # merging the current one. None uses settings.py. See Qs_pipeline.py
+        if pipeline is None:
+            pipeline = settings.pipeline_periods
+        self.pipeline = pipeline
+
+        # Raw frames handed over by the extractor in the same run. Frames 
+        # that aren't in it are loaded from the store. Worker processes 
+        # don't get it. See Qs_frame_cache.py
+        self.frame_cache = frame_cache
         
         # tolerance for difference between files
         # This value is more to highlight very different dataframes than have 
         # any physical meaning.
         self.difference_tolerance = 0.02
 
+        # How the Qs# chunks are combined. See Qs_combine.py
+        self.combine_engine = settings.combine_engine
+
+        # How the final frame is cleaned and the cutoff for each column. See 
+        # Qs_clean.py
+        self.clean_engine = settings.clean_engine
+        self.column_cutoffs = settings.column_cutoffs
+
+        # Rows per block for the streaming merge. None merges whole periods 
+        # in memory. See Qs_stream.py
+        self.stream_block_rows = settings.stream_block_rows
+        self.mmap_raw = False
+
+        # float64 or compact dtypes. Raw frames stored in the other mode are 
+        # converted when loaded. See Qs_dtypes.py
+        self.dtype_policy = Qs_dtypes.DtypePolicy.from_settings(settings)
+
         # Start up logger
-        self.logger = logger.Logger(self.log_filepath, default_verbose=True)
+        # Worker processes pass in a LogRecorder instead of using the log file. 
+        # See Qs_logging.py for the log modes and levels.
+        if logger is None:
+            logger = Qs_logging.make_logger(self.log_filepath,
+                    settings.log_mode, settings.log_level)
+        self.logger = logger
         hm.ensure_dir_exists(self.pickle_destination, self.logger)
+        if self.output_txt:
+            hm.ensure_dir_exists(self.txt_destination, self.logger)
         self.logger.write(["Begin Qs Pickle Processor output", asctime()])
 
         # Start up loader
         self.loader = data_loading.DataLoader(self.pickle_source, 
                 self.pickle_destination, self.logger)
 
+        # Storage backend for the merged Qs frames. Raw frames are loaded in 
+        # whatever format the metastore points at. The summary stats are 
+        # always pickles.
+        self.store = Qs_storage.make_store(settings.storage_format,
+                self.pickle_destination, self.loader, self.logger)
+
+        # The build manifest records what each merged period was built from 
+        # so only periods with changed inputs are rebuilt. Worker processes 
+        # get a period's part of it with each period instead.
+        if manifest is None:
+            manifest = Qs_manifest.BuildManifest(
+                    pjoin(self.pickle_source, settings.manifest_name))
+        self.manifest = manifest
+
+        # Summary stats are either one pickle that is rewritten every run, or 
+        # an append-only log where each run only writes its new rows
+        self.stats_log = None
+        if settings.stats_storage == 'append':
+            self.stats_log = Qs_stats.StatsLog(pjoin(self.pickle_destination,
+                    f"{self.statspickle_name}-log"))
+
+        # Time and memory records for every stage of every period. Written 
+        # to a run report next to the log file. See Qs_profiler.py
+        self.profiler = Qs_profiler.StageProfiler(component,
+                enabled=settings.profile_stages, stage_memory=not pipeline)
+        self.pkl_name = None
+        self.report_dir = os.path.dirname(self.log_filepath)
+
     def run(self):
         self.logger.write(["Running pickle processor..."])
-        indent_function = self.logger.run_indented_function
+        self.open_metapickle()
+        self.start_run()
 
-        # Load Qs_metapickle
-        if self.metapickle_path is None:
-            self.metapickle = self.loader.load_pickle(settings.metapickle_name)
+        if self.shard_queue is not None:
+            # The reduce step does the summary stats and manifest
+            self.run_sharded_periods()
+            self.end_run()
+            return
+        elif self.max_workers is not None and self.max_workers > 1:
+            self.run_parallel_periods()
+        elif self.pipeline:
+            self.run_pipelined_periods()
         else:
-            self.metapickle = self.loader.load_pickle(self.metapickle_path, 
+            for period_path in self.metapickle:
+                self.run_period(period_path)
+
+        self.finish_summary_stats()
+        self.manifest.save()
+        self.end_run()
+
+    def open_metapickle(self):
+        # Open the Qs metastore. It acts like the old metapickle dict but only 
+        # reads a period's paths when they are needed. Old metapickles can 
+        # still be given by path. Shard nodes (and the reduce) only read it, 
+        # possibly from another host, so it is opened read only. See 
+        # Qs_metastore.py
+        metapickle_path = self.metapickle_path
+        if metapickle_path is None:
+            metapickle_path = pjoin(self.pickle_source,
+                    settings.metastore_name)
+        if metapickle_path.endswith(Qs_storage.pickle_extension):
+            self.metapickle = self.loader.load_pickle(metapickle_path, 
                     add_path=False)
+        else:
+            legacy_path = pjoin(self.pickle_source,
+                    f"{settings.metapickle_name}{Qs_storage.pickle_extension}")
+            self.metapickle = Qs_metastore.open_metastore(metapickle_path,
+                    legacy_path, read_only=self.shard_queue is not None)
+
+    def close_metapickle(self):
+        # Old metapickle dicts have nothing to close
+        if hasattr(self.metapickle, 'close'):
+            self.metapickle.close()
 
+    def start_run(self):
         self.raw_file_counter = 0
         self.combined_file_counter = 0
-        self.summary_stats = {} # (pkl_name, stat_type) : stat_row}
+        # (pkl_name, stat_type) : stat_row
+        self.summary_stats = Qs_stats.StatsTable()
         self.pd_summary_stats = None
+        # pkl_names of the periods that weren't current. Their old stats 
+        # rows are replaced, even if they have no new ones.
+        self.rebuilt_periods = set()
 
-        for period_path in self.metapickle:
-            # attribute data to be reset every period
-            self.lingering_errors = [] # error for secondary check to look at
-            self.Qs_path_list = [] # list of Qs#.txt file paths
-            self.Qs0_data = None # data for Qs.txt
-            self.Qsn_data = [] # data for Qs#.txt
-            self.Qsn_names = [] # Names of Qs# files
-            self.current_period_path = period_path # is also the metapickle key
-            self.combined_Qs = None
-            self.accumulating_overlap = None
-
-            # Get meta info
-            period_name = hm.nsplit(self.current_period_path, 1)[1]
-            period_name = period_name.replace('results-', '')
-            msg = f"Processing {period_name}..."
-            self.pkl_name = '_'.join(['Qs', period_name])
-
-            indent_function(self.process_period, before_msg=msg)
+    def finish_summary_stats(self):
+        run_stage = self.run_stage
 
         # Make a summary stats dataframe
-        self.pd_summary_stats = pd.DataFrame.from_dict(
-                self.summary_stats, orient='index')
+        self.pkl_name = None # the rest of the stages are not per period
+        self.pd_summary_stats = self.summary_stats.to_frame()
         self.update_summary_stats()
 
         # Save summary stats pickle/txt files
-        indent_function(self.produce_stats_pickle, 
-                before_msg="Producing statistics pickle",
-                after_msg="Statistics pickle produced!")
+        if self.stats_log is None:
+            run_stage(self.produce_stats_pickle, 
+                    before_msg="Producing statistics pickle",
+                    after_msg="Statistics pickle produced!")
         if self.output_txt:
-            indent_function(self.write_stats_txt, 
+            run_stage(self.write_stats_txt, 
                     before_msg="Writing statistics txt",
                     after_msg="Done!")
 
+    def end_run(self):
+        self.close_metapickle()
+        if self.frame_cache is not None:
+            self.logger.write(self.frame_cache.summary())
+            self.frame_cache.clear()
+
+        self.write_run_report()
+
         self.logger.write([f"{self.raw_file_counter} raw pickles processed",
                            f"{self.combined_file_counter} combined pickles produced"])
         self.logger.end_output()
 
 
-    def process_period(self):
+    def run_period(self, period_path, period_links=None):
+        msg = self.start_period(period_path)
+        if period_links is None:
+            period_links = self.read_period_links(period_path)
+        self.period_links = period_links
+        self.logger.run_indented_function(self.process_period, before_msg=msg)
+        self.logger.write_period_record(self.period_summary())
+        self.note_period_status(self.pkl_name, self.period_status)
+
+        if self.period_record is not None:
+            self.manifest.update_period(period_path, *self.period_record)
+
+    def note_period_status(self, pkl_name, status):
+        if status != 'current':
+            self.rebuilt_periods.add(pkl_name)
+
+    def start_period(self, period_path):
+        # attribute data to be reset every period
+        self.lingering_errors = [] # error for secondary check to look at
+        self.Qs_path_list = [] # list of Qs#.txt file paths
+        self.Qs0_data = None # data for Qs.txt
+        self.Qs0_is_shared = False # Qs0_data is a memory map or cached frame
+        self.Qs0_link = None # (Qs1 path, kind, diff rows) if Qs.txt copies Qs1
+        self.period_links = {} # raw path : link, see Qs_fingerprint.py
+        self.Qsn_paths = [] # raw paths of Qsn_data
+        self.Qsn_data = [] # data for Qs#.txt
+        self.Qsn_names = [] # Names of Qs# files
+        self.current_period_path = period_path # is also the metapickle key
+        self.combined_Qs = None
+        self.combined_values = None # array combined_Qs was built on, if any
+        self.accumulating_overlap = None
+        self.final_output = None
+        self.output_paths = [] # files written for this period
+        self.period_record = None # (record, signatures) for the manifest
+        self.pkl_name = None
+
+        # For the period record in the log. See Qs_logging.py
+        self.period_status = 'failed' # until it gets through
+        self.period_errors = [] # error codes
+        self.period_counts = {'rows' : None, 'diff_rows' : 0,
+                              'overlap_rows' : 0, 'trimmed_rows' : 0}
+        self.period_streamed = False
+
+        # Get meta info
+        period_name = self.get_period_name(period_path)
+        msg = f"Processing {period_name}..."
+        self.pkl_name = '_'.join(['Qs', period_name])
+        return msg
+
+    @staticmethod
+    def get_period_name(period_path):
+        period_name = hm.nsplit(period_path, 1)[1]
+        return period_name.replace('results-', '')
+
+    def read_period_links(self, period_path):
+        # Qs.txt frames that copy the Qs1.txt frame. Old metapickle dicts 
+        # don't have any.
+        links = getattr(self.metapickle, 'links', None)
+        return {} if links is None else links(period_path)
+
+    def run_parallel_periods(self):
+        # Hand the periods out to a pool of worker processes. Periods do not 
+        # share anything except the counters, summary stats, and log, so each 
+        # worker returns those and they are merged here in metapickle order. 
+        # The output is the same as a serial run.
+        #
+        # Each worker makes one processor when it starts, with this process's 
+        # settings passed in (spawned workers would otherwise import the 
+        # defaults). Each period only comes with its part of the manifest.
+        period_paths = list(self.metapickle.keys())
+        path_lists = [self.metapickle[path] for path in period_paths]
+        link_dicts = [self.read_period_links(path) for path in period_paths]
+        manifests = [self.manifest.period_manifest(path, path_list)
+                     for path, path_list in zip(period_paths, path_lists)]
+
+        self.logger.write(f"Processing {len(period_paths)} periods with " +
+                          f"{self.max_workers} workers")
+        with ProcessPoolExecutor(max_workers=self.max_workers,
+                initializer=_init_period_worker,
+                initargs=(settings_values(), self.output_txt)) as executor:
+            # executor.map yields results in submission order
+            results = executor.map(_process_period_worker,
+                    period_paths, path_lists, link_dicts, manifests)
+
+            for result in results:
+                replay_records(self.logger, result['log_records'])
+                self.add_period_result(result)
+
+    def add_period_result(self, result):
+        # Merge the results of a period run by a worker or the pipeline
+        self.summary_stats.extend(result['summary_stats'])
+        self.note_period_status(result['pkl_name'], result['period_status'])
+        self.raw_file_counter += result['raw_file_counter']
+        self.combined_file_counter += result['combined_file_counter']
+        self.profiler.extend(result['stage_records'])
+        if result['period_record'] is not None:
+            self.manifest.update_period(result['period_path'],
+                    *result['period_record'])
+
+    def run_pipelined_periods(self):
+        # Each period runs on its own copy of the processor so the read, 
+        # merge, and write stages of neighbouring periods don't share any 
+        # attribute data. Log calls are recorded and replayed in period order 
+        # once a period is written, so the log reads like a serial run.
+        pipeline = Qs_pipeline.PeriodPipeline(
+                read=lambda period: period.read_period(),
+                merge=lambda period: period.merge_period(),
+                write=lambda period: period.write_period(),
+                prefetch=settings.pipeline_prefetch,
+                pending_writes=settings.pipeline_pending_writes)
+        self.logger.write("Processing periods in a pipeline (prefetching " +
+                          f"{pipeline.prefetch}, {pipeline.pending_writes} " +
+                          "pending writes)")
+
+        # The metastore's sqlite connection can only be used by this thread
+        path_lists = {path : self.metapickle[path]
+                      for path in self.metapickle.keys()}
+        link_dicts = {path : self.read_period_links(path)
+                      for path in path_lists}
+        periods = (self._make_period_processor(path, path_lists[path],
+                                               link_dicts[path])
+                   for path in path_lists)
+        for period, failure in pipeline.run(periods):
+            replay_records(self.logger, period.logger.pop_records())
+            if failure is not None:
+                # Nothing from a failed period is kept
+                error_msg = period.flag_error('PSF')
+                self.logger.warning([error_msg,
+                    f"{period.pkl_name} was not processed"] + failure.lines())
+                period.summary_stats = Qs_stats.StatsTable()
+                period.period_record = None
+                period.period_status = 'failed'
+            self.logger.write_period_record(period.period_summary())
+            self.logger.decrease_global_indent()
+            self.add_period_result(_period_result(period))
+
+    def _make_period_processor(self, period_path, Qs_path_list,
+            period_links):
+        # Shallow copy with its own logger, loader, store, profiler, stats, 
+        # and counters. The manifest is only read.
+        recorder = LogRecorder(settings.log_level)
+        period = copy.copy(self)
+        period.metapickle = {period_path : Qs_path_list}
+        period.logger = recorder
+        period.loader = data_loading.DataLoader(self.pickle_source,
+                self.pickle_destination, recorder)
+        period.store = Qs_storage.make_store(settings.storage_format,
+                self.pickle_destination, period.loader, recorder)
+        period.profiler = Qs_profiler.StageProfiler('QsPickleProcessor',
+                enabled=settings.profile_stages, stage_memory=False)
+        period.summary_stats = Qs_stats.StatsTable()
+        period.raw_file_counter = 0
+        period.combined_file_counter = 0
+        recorder.clear()
+
+        msg = period.start_period(period_path)
+        period.period_links = period_links
+        recorder.write(msg)
+        recorder.increase_global_indent()
+        return period
+
+    def run_periods(self, period_paths):
+        # Merge only these periods and add their rows to the summary stats. 
+        # Used by watch mode, which calls start_run once and end_run when it 
+        # stops, so the counters cover the whole watch. See Qs_watch.py
+        self.open_metapickle()
+        self.summary_stats = Qs_stats.StatsTable()
+        self.rebuilt_periods = set()
+        try:
+            for period_path in period_paths:
+                self.run_period(period_path)
+            self.finish_summary_stats()
+            self.manifest.save()
+        finally:
+            # Don't hold the metastore open between batches
+            self.close_metapickle()
+
+    def run_sharded_periods(self):
+        # Claim periods from the work queue shared with the other nodes until 
+        # every period is done. Each period's stats rows and build record go 
+        # to the queue for the reduce step. See Qs_shard.py
+        queue = self.shard_queue
+        self.logger.write(f"Claiming periods as node {queue.node_id}")
+        period_paths = list(self.metapickle.keys())
+        for period_path in queue.claim_items(period_paths):
+            # Only this period's rows
+            self.summary_stats = Qs_stats.StatsTable()
+            counters = (self.raw_file_counter, self.combined_file_counter)
+            with queue.hold(period_path) as heartbeat:
+                try:
+                    self.run_period(period_path)
+                except Exception as error:
+                    # Nothing from a failed period is kept
+                    failure = Qs_pipeline.StageFailure('period', error)
+                    error_msg = self.flag_error('PSF')
+                    self.logger.warning([error_msg,
+                        f"{self.pkl_name} was not processed"] + failure.lines())
+                    self.summary_stats = Qs_stats.StatsTable()
+                    self.period_record = None
+                    self.period_status = 'failed'
+                    self.logger.write_period_record(self.period_summary())
+
+            if heartbeat.lost is not None:
+                self.logger.warning([str(heartbeat.lost),
+                    "The other node's results are kept"])
+                continue
+            self.save_shard_result(period_path,
+                    self.raw_file_counter - counters[0],
+                    self.combined_file_counter - counters[1])
+
+    def save_shard_result(self, period_path, raw_files, combined_files):
+        # The partial stats go next to the done record. The temp file is this 
+        # node's own in case another node is saving the same period.
+        queue = self.shard_queue
+        stats_path = queue.stats_path(period_path)
+        tmp_path = f"{stats_path}.{Qs_shard.item_key(queue.node_id)}.tmp"
+        self.summary_stats.to_frame().to_pickle(tmp_path)
+        os.replace(tmp_path, stats_path)
+        queue.complete(period_path, self.period_status, {
+                'period_record'         : self.period_record,
+                'raw_file_counter'      : raw_files,
+                'combined_file_counter' : combined_files,
+                })
+
+    def reduce_shards(self):
+        # Combine the partial stats and build records of a sharded run into 
+        # the summary stats and the build manifest. Returns False (and 
+        # changes nothing) if some periods aren't done yet.
+        self.logger.write(["Reducing the sharded run..."])
+        self.open_metapickle()
+        self.start_run()
+        queue = self.shard_queue
+        period_paths = list(self.metapickle.keys())
+        states = queue.status(period_paths)
+
+        unfinished = [path for path in period_paths
+                      if not isinstance(states[path], dict)]
+        if unfinished:
+            self.logger.warning([f"{len(unfinished)} periods are not done. " +
+                    "Not reducing yet."] + [
+                    f"{path} ({states[path] or 'not started'})"
+                    for path in unfinished])
+            self.close_metapickle()
+            self.logger.end_output()
+            return False
+
+        # Periods are added in metapickle order like a serial run
+        statuses = {}
+        for period_path in period_paths:
+            done = states[period_path]
+            statuses.setdefault(done['status'], []).append(period_path)
+            stats = pd.read_pickle(queue.stats_path(period_path))
+            for key, row in stats.iterrows():
+                self.summary_stats.add(key, row)
+            pkl_name = '_'.join(['Qs', self.get_period_name(period_path)])
+            self.note_period_status(pkl_name, done['status'])
+            record = done['record']
+            self.raw_file_counter += record['raw_file_counter']
+            self.combined_file_counter += record['combined_file_counter']
+            if record['period_record'] is not None:
+                self.manifest.update_period(period_path,
+                        *record['period_record'])
+        self.logger.write([f"{len(paths)} periods {status}"
+                           for status, paths in statuses.items()])
+        if 'failed' in statuses:
+            self.logger.warning(["These periods failed:"] + statuses['failed'])
+
+        self.finish_summary_stats()
+        self.manifest.save()
+        queue.clear()
+        self.end_run()
+        return True
 
-        if self.loader.is_pickled(self.pkl_name):
+    def process_period(self):
+        if self.read_period():
+            self.merge_period()
+            self.write_period()
+
+    def read_period(self):
+        # Returns False if the period is done after this (up to date or 
+        # streamed)
+        with self.profiler.stage('is_period_current', self.pkl_name):
+            is_current = self.is_period_current()
+        if is_current:
             self.logger.write(["Nothing to do"])
-            return
+            self.period_status = 'current'
+            return False
+
+        run_stage = self.run_stage
+        if self.is_streamable():
+            self.period_streamed = True
+            self.process_period_streaming()
+            self.period_status = 'merged'
+            return False
 
-        indent_function = self.logger.run_indented_function
         # Load data
-        indent_function(self.load_data,
-                        before_msg="Loading data...",
-                        after_msg="Finished loading data!")
+        run_stage(self.load_data,
+                  before_msg="Loading data...",
+                  after_msg="Finished loading data!")
+        return True
+
+    def merge_period(self):
+        run_stage = self.run_stage
 
         # Primary Error Checks
-        indent_function(self.primary_error_check,
-                        before_msg="Running primary error checks...",
-                        after_msg="Finished primary error checks!")
+        run_stage(self.primary_error_check,
+                  before_msg="Running primary error checks...",
+                  after_msg="Finished primary error checks!")
 
         # Combining Qsn chunks
-        indent_function(self.combine_Qsn_chunks,
-                        before_msg="Combining Qs chunks...",
-                        after_msg="Finished combining Qs chunks!")
+        run_stage(self.combine_Qsn_chunks,
+                  before_msg="Combining Qs chunks...",
+                  after_msg="Finished combining Qs chunks!")
 
         # Secondary Error Checks
-        indent_function(self.secondary_error_check,
-                        before_msg="Running secondary error checks...",
-                        after_msg="Finished secondary error checks!")
+        run_stage(self.secondary_error_check,
+                  before_msg="Running secondary error checks...",
+                  after_msg="Finished secondary error checks!")
 
         # Calc summary stats
-        indent_function(self.calculate_stats,
-                        before_msg="Calculating summary stats...",
-                        after_msg="Summary stats calculated!")
+        run_stage(self.calculate_stats,
+                  before_msg="Calculating summary stats...",
+                  after_msg="Summary stats calculated!")
+
+    def write_period(self):
+        run_stage = self.run_stage
 
         # Write to pickle
-        indent_function(self.produce_processed_pickle,
-                        before_msg="Producing processed pickles...",
-                        after_msg="Processed pickles produced!")
+        run_stage(self.produce_processed_pickle,
+                  before_msg="Producing processed pickles...",
+                  after_msg="Processed pickles produced!")
 
         # Write a combined Qs txt file
         if self.output_txt:
-                indent_function(self.write_combined_txt,
+                run_stage(self.write_combined_txt,
                         before_msg="Writing combined txt file...",
                         after_msg="Done writing file!")
 
+        # Record what this period was built from
+        input_paths = self.metapickle[self.current_period_path]
+        self.period_record = self.manifest.make_period_record(
+                input_paths, self.output_paths)
+        self.period_status = 'merged'
+
+    def flag_error(self, code):
+        # Note the error code for the period record and return its message
+        if code not in self.period_errors:
+            self.period_errors.append(code)
+        return QsPickleProcessor.error_codes[code]
+
+    def period_summary(self):
+        # Machine readable record of the period for the log. See 
+        # Qs_logging.py
+        if self.final_output is not None:
+            self.period_counts['rows'] = len(self.final_output)
+        return {'period'    : self.current_period_path,
+                'name'      : self.pkl_name,
+                'status'    : self.period_status,
+                'errors'    : list(self.period_errors),
+                'raw_files' : len(self.metapickle[self.current_period_path]),
+                'streamed'  : self.period_streamed,
+                **self.period_counts,
+                }
+
+    def run_stage(self, function, before_msg=None, after_msg=None):
+        # Run a stage with indented logging, recording its time, memory, and 
+        # how much data it handled
+        stage = function.__name__
+        n_outputs = len(self.output_paths) if self.pkl_name is not None else 0
+        with self.profiler.stage(stage, self.pkl_name) as record:
+            output = self.logger.run_indented_function(function,
+                    before_msg=before_msg, after_msg=after_msg)
+            if self.profiler.enabled and self.pkl_name is not None:
+                record['rows'], record['bytes'] = \
+                        self._stage_sizes(stage, n_outputs)
+        return output
+
+    def _stage_sizes(self, stage, n_outputs):
+        # Returns (rows, bytes) for a period stage. Stages that write files 
+        # count the bytes written. Others count the data they leave in memory.
+        raw_frames = [self.Qs0_data] + self.Qsn_data
+        if stage in ['load_data', 'primary_error_check']:
+            return Qs_profiler.frame_sizes(raw_frames)
+
+        current = self.final_output if self.final_output is not None \
+                else self.combined_Qs
+        rows, nbytes = Qs_profiler.frame_sizes([current])
+        if rows is None:
+            rows = Qs_profiler.frame_sizes(raw_frames)[0]
+        new_paths = self.output_paths[n_outputs:]
+        if new_paths:
+            nbytes = Qs_profiler.path_sizes(new_paths)
+        return rows, nbytes
+
+    def write_run_report(self):
+        if not self.profiler.enabled:
+            return
+        self.logger.write(self.profiler.summary_lines())
+        report_paths = self.profiler.write_report(self.report_dir)
+        self.logger.write(["Run report written to"] + list(report_paths))
+
+    def is_streamable(self):
+        # The streaming merge needs memory mapped raw data (npy or mmap) and 
+        # writes the output one block at a time to the npy store.
+        if self.stream_block_rows is None:
+            return False
+        paths = self.metapickle[self.current_period_path]
+        is_mappable = lambda p: Qs_storage.path_format(p) in ['npy', 'mmap']
+        if not isinstance(self.store, Qs_storage.NpyStore) or \
+                not all(is_mappable(p) for p in paths):
+            self.logger.write("Streaming merge needs the npy storage " +
+                              "format. Merging in memory.")
+            return False
+
+        Qs0_shape, Qsn_shapes = None, []
+        for path in paths:
+            shape = Qs_storage.read_shape(path)
+            is_Qs0 = path.split('_')[-1].split('.')[0] == 'Qs'
+            if is_Qs0:
+                Qs0_shape = shape
+            else:
+                Qsn_shapes.append(shape)
+        if not StreamingMerge.can_stream(Qs0_shape, Qsn_shapes):
+            self.logger.write("Qs files have different shapes. " +
+                              "Merging in memory.")
+            return False
+        return True
+
+    def process_period_streaming(self):
+        run_stage = self.run_stage
+
+        # Load data as memory maps
+        self.mmap_raw = True
+        run_stage(self.load_data,
+                  before_msg="Loading memory mapped data...",
+                  after_msg="Finished loading data!")
+        self.mmap_raw = False
+
+        # Primary Error Checks
+        run_stage(self.primary_error_check,
+                  before_msg="Running primary error checks...",
+                  after_msg="Finished primary error checks!")
+
+        # Combine, check, clean, calc stats, and write in blocks of rows
+        run_stage(self.stream_merge,
+                  before_msg=f"Merging in blocks of {self.stream_block_rows} rows...",
+                  after_msg="Finished streaming merge!")
+
+        # Record what this period was built from
+        input_paths = self.metapickle[self.current_period_path]
+        self.period_record = self.manifest.make_period_record(
+                input_paths, self.output_paths)
+
+    def stream_merge(self):
+        if self.Qs0_data is None and not self.Qsn_data:
+            error_msg = self.flag_error('NDF')
+            self.logger.warning([error_msg,
+                "Both the raw Qs pickle and combined Qs df are missing.",
+                f"Pickle not created for {self.pkl_name}"])
+            return
+
+        merger = StreamingMerge(self.Qs0_data, self.Qsn_data,
+                self.stream_block_rows, self.column_cutoffs,
+                max_diff_rows=settings.max_logged_diff_rows)
+        self.period_counts['rows'] = merger.n_rows
+
+        writer = Qs_storage.NpyFrameWriter(self.store.path(self.pkl_name),
+                merger.columns, merger.n_rows, dtypes=merger.dtypes)
+        block_writers = [writer.write_block]
+
+        txt_writer = None
+        if self.output_txt:
+            # Same as DataLoader.save_txt (DataFrame.to_csv), one block at a 
+            # time. Only the first block has a header.
+            txt_path = pjoin(self.txt_destination, f"{self.pkl_name}.txt")
+            txt_writer = Qs_txt_writer.QsTxtWriter(txt_path,
+                    precision=settings.txt_precision,
+                    compression=settings.txt_compression)
+            block_writers.append(lambda start, block: txt_writer.write(block))
+
+        try:
+            merger.run(block_writers)
+        finally:
+            if txt_writer is not None:
+                txt_writer.close()
+        self.output_paths.append(writer.close())
+        if txt_writer is not None:
+            self.output_paths.append(txt_writer.path)
+        self.combined_file_counter += 1
+
+        # Log the results like the in-memory merge
+        if merger.has_combined:
+            self.logger.write(f"Combined {len(self.Qsn_data)} chunks " +
+                              f"({merger.overlap_count} overlapping rows)")
+        if merger.has_raw and merger.has_combined:
+            if merger.diff_rows_count > 0:
+                diff_raw_Qs, diff_combined = merger.get_diff_frames()
+                self._log_difference(merger.diff_rows_count, merger.n_rows,
+                        diff_raw_Qs, diff_combined)
+            else:
+                self._log_no_difference()
+        else:
+            using = "raw Qs" if merger.has_raw else "combined Qs"
+            self.logger.write(f"Only {using} found." +
+                              "No difference check needed.")
+        self._log_trimmed(merger.cleaning)
+        if merger.overlap_count > 0:
+            self._log_overlap(merger.overlap_times)
+
+        for stat, row in merger.get_stats().items():
+            self.summary_stats.add((self.pkl_name, stat), row)
+
+    def is_period_current(self):
+        # Check if the merged output exists and was built from the current 
+        # raw data
+        if not self.store.is_stored(self.pkl_name):
+            return False
+
+        input_paths = self.metapickle[self.current_period_path]
+        is_current = self.manifest.is_period_current(
+                self.current_period_path, input_paths)
+        if is_current is None:
+            # Merged before there was a manifest. Assume it's current and 
+            # start tracking its inputs.
+            self.period_record = self.manifest.make_period_record(
+                    input_paths, [])
+            return True
+        elif not is_current:
+            self.logger.write("Raw data changed since the last merge. Rebuilding.")
+        return is_current
+
 
     def load_data(self):
         # Load the sorted list of paths for this period
         self.Qs_path_list = self.metapickle[self.current_period_path]
         # Load the associated data
 
-        Qs_period_data = self.loader.load_pickles(self.Qs_path_list, add_path=False)
+        # mmap format frames are always memory mapped. The merge reads them 
+        # straight from the page cache.
+        is_shared = {path : self.mmap_raw or
+                            Qs_storage.path_format(path) == 'mmap'
+                     for path in self.Qs_path_list}
+        Qs_period_data = {path : self.load_raw_frame(path, is_shared)
+                          for path in self.Qs_path_list}
 
         for Qs_path in self.Qs_path_list:
             pkl_name = hm.nsplit(Qs_path, 1)[1]
             stripped_name = pkl_name.split('.')[0]
             Qs_name = stripped_name.split('_')[-1]
-            bedload_data = Qs_period_data[Qs_path]
+            bedload_data = self.dtype_policy.conform(Qs_period_data[Qs_path])
             self.raw_file_counter += 1
 
             if Qs_name == 'Qs':
                 assert(self.Qs0_data is None)
                 self.Qs0_data = bedload_data
+                self.Qs0_is_shared = bedload_data is Qs_period_data[Qs_path] \
+                        and is_shared[Qs_path]
+                self.Qs0_link = self.period_links.get(Qs_path)
             else:
                 assert(Qs_name[2:].isdigit())
                 self.Qsn_data.append(bedload_data)
                 self.Qsn_names.append(Qs_name)
+                self.Qsn_paths.append(Qs_path)
+
+    def load_raw_frame(self, path, is_shared):
+        # Take the frame from the frame cache if the extractor just made it, 
+        # otherwise load it from the store. Cached frames are marked shared 
+        # since a linked Qs.txt frame is the same object as the Qs1.txt one.
+        if self.frame_cache is not None:
+            data = self.frame_cache.take(path)
+            if data is not None:
+                is_shared[path] = True
+                return data
+        return Qs_storage.load_frame(path, self.loader, mmap=is_shared[path])
 
 
     def primary_error_check(self):
@@ -198,7 +834,7 @@ class QsPickleProcessor:
 
         if self.Qs0_data is not None and self.Qsn_data:
             name_list = ', '.join(self.Qsn_names)
-            error_msg = QsPickleProcessor.error_codes['CQF']
+            error_msg = self.flag_error('CQF')
             self.logger.warning([error_msg,
                 "Qs.txt and Qs#.txt files both exist",
                f"Qs#.txt: {name_list}"])
@@ -210,67 +846,20 @@ class QsPickleProcessor:
         # The data is split up into multiple chunks (each Qs# file is a chunk).  
         # This functions assembles them into a complete Qs dataframe.  
         # Overlapping rows are converted to nan because I can't see any way to 
-        # choose which one to keep.
+        # choose which one to keep. See Qs_combine.py for the engines.
         if not self.Qsn_data:
             self.logger.write("No chunks to combine.")
             return
 
-        combined = self._make_like_df(self.Qsn_data[0], ['timestamp'])
-        accumulating_overlap = None
-
-        exclude_cols = ['timestamp', 'missing ratio', 'vel', 'sd vel', 'number vel']
-        target_cols = hm.exclude_df_cols(combined, exclude_cols)
-
-        # Set up a few lambda functions
-        get_num = lambda s: int(s[2:]) # get the file number from the name
-        get_target_subset = lambda c: c.loc[:, target_cols]
-        # Find rows with data. Should remove meta columns beforehand
-        # Will select rows with non-null values (selects zero rows)
-        find_data_rows = lambda df: df.notnull().all(axis=1)
-
-        for raw_chunk, name in zip(self.Qsn_data, self.Qsn_names):
-            # Each raw dataframe contains only a chunk of the overall data.  
-            # However they contain zero values for all times outside of the 
-            # valid chunk time. Some chunks overlap too. 
-            ch_num, max_num = get_num(name), get_num(self.Qsn_names[-1])
-            self.logger.write(f"Processing chunk {ch_num} of {max_num}")
-
-            # Get bedload subsets
-            bedload_chunk = get_target_subset(raw_chunk)
-            bedload_combined = get_target_subset(combined)
-
-            # Find rows with data
-            chunk_rows = find_data_rows(bedload_chunk)
-            combined_rows = find_data_rows(bedload_combined)
-
-            # Find overlap
-            overlap_rows = chunk_rows & combined_rows
-
-            # Add chunk to combined array
-            combined.loc[chunk_rows, 1:] = raw_chunk[chunk_rows]
-            combined.loc[overlap_rows, 1:] = np.nan
-
-            # Keep track of overlap rows
-            if accumulating_overlap is None:
-                accumulating_overlap = overlap_rows
-            else:
-                accumulating_overlap = accumulating_overlap | overlap_rows
-
-        self.combined_Qs = combined
-        self.accumulating_overlap = accumulating_overlap
+        self.combined_Qs, self.accumulating_overlap, self.combined_values = \
+                Qs_combine.combine_chunks(self.Qsn_data, self.Qsn_names,
+                        engine=self.combine_engine, logger=self.logger,
+                        with_values=True)
 
     def _make_like_df(self, like_df, columns_to_copy=[], fill_val=np.nan):
         # Make a dataframe like the Qs data with a few columns copied and the 
         # rest filled with a default value
-
-        np_like = np.empty_like(like_df.values)
-        np_like.fill(fill_val)
-        pd_like = pd.DataFrame(np_like,
-                columns=like_df.columns, index=like_df.index)
-
-        for column in columns_to_copy:
-            pd_like.loc[:, column] = like_df.loc[:, column]
-        return pd_like
+        return Qs_combine.make_like_df(like_df, columns_to_copy, fill_val)
 
 
     def secondary_error_check(self):
@@ -281,36 +870,49 @@ class QsPickleProcessor:
         ## Check for diff between raw_Qs and Qs_combined
         self._check_diff_raw_combined()
 
-        ## Set rows with any Nan values to entirely Nan values
-        nan_rows = self.final_output.isnull().any(axis=1)
-        self.final_output.loc[nan_rows, 'missing ratio':] = np.nan
+        ## Set rows with any Nan values to entirely Nan values, set outliers 
+        ## to Nan, and find the overlapped rows. See Qs_clean.py
+        combined_exists = self.combined_Qs is not None
+        overlap = self.accumulating_overlap if combined_exists else None
+        # The combined frame's array isn't shared, so it is cleaned in place
+        is_combined = self.final_output is self.combined_Qs
+        values = self.combined_values if is_combined else None
+        self.final_output, cleaning = Qs_clean.clean_frame(self.final_output,
+                self.column_cutoffs, overlap, engine=self.clean_engine,
+                values=values)
+        if is_combined:
+            self.combined_Qs = self.final_output
+
+        #import matplotlib.pyplot as plt
+        #self.final_output.hist(column='Bedload all', bins=50)
+        #plt.show()
+        self._log_trimmed(cleaning)
 
-        ## Set outliers to Nan
-        max_threshold = settings.lighttable_bedload_cutoff
-        trim_rows = self.final_output['Bedload all'] > max_threshold
-        trim_count = np.sum(trim_rows)
+        ## Check for accumulated overlap
+        self._check_accumulated_overlap(cleaning)
+
+    def _log_trimmed(self, cleaning):
+        trim_vals = cleaning.get_trim_vals()
+        total_sum = cleaning.total_bedload
+        trim_count = len(trim_vals)
+        self.period_counts['trimmed_rows'] = trim_count
         if trim_count > 0:
-            trim_vals = self.final_output.loc[trim_rows, 'Bedload all']
-            str_trim_vals = [f'{v:0.2f}' for v in np.sort(trim_vals.values)]
+            max_threshold = Qs_clean.describe_cutoffs(cleaning.cutoffs)
             trim_sum = np.sum(trim_vals)
-            total_sum = np.sum(self.final_output['Bedload all'])
-
-            self.final_output.loc[trim_rows, 'missing ratio':] = np.nan
-
-            self.logger.write([
+            self.logger.write(
                     f"{trim_count} points are above the cutoff value of {max_threshold}" +
                     f" ({trim_sum/1000:0.3f} kg of {total_sum/1000:0.3f} kg; " +
-                    f"{trim_sum/total_sum:0.2%} )",
-                    f"{list(str_trim_vals)}"])
-
-            #self.final_output.hist(column='Bedload all', bins=50)
-            #plt.show()
+                    f"{trim_sum/total_sum:0.2%} )")
+            if self.logger.is_enabled('debug'):
+                str_trim_vals = [f'{v:0.2f}' for v in np.sort(trim_vals)]
+                self.logger.debug(f"{list(str_trim_vals)}")
+            if len(cleaning.cutoffs) > 1:
+                self.logger.write("Points above each cutoff: " + ', '.join(
+                        f"{column} {count}" for column, count
+                        in cleaning.trim_counts.items()), local_indent=1)
         else:
             self.logger.write("No values needed to be trimmed")
 
-        ## Check for accumulated overlap
-        self._check_accumulated_overlap()
-
     def _check_diff_raw_combined(self):
         # Check for diff between raw_Qs and Qs_combined
         raw_Qs = self.Qs0_data
@@ -320,12 +922,15 @@ class QsPickleProcessor:
         if raw_exists and combined_exists:
             self._difference_check()
         elif not(raw_exists or combined_exists):
-            error_msg = QsPickleProcessor.error_codes['NDF']
+            error_msg = self.flag_error('NDF')
             self.logger.warning([error_msg,
                 "Both the raw Qs pickle and combined Qs df are missing."])
         else:
             using = "raw Qs" if raw_exists else "combined Qs"
             self.final_output = raw_Qs if raw_exists else combined_Qs
+            if raw_exists and self.Qs0_is_shared:
+                # The cleaning below writes to the final output
+                self.final_output = raw_Qs.copy()
             self.logger.write(f"Only {using} found." +
                               "No difference check needed.")
 
@@ -334,48 +939,35 @@ class QsPickleProcessor:
         raw_Qs = self.Qs0_data
         combined_Qs = self.combined_Qs
 
-        # Element-wise bool difference between dataframes
-        Qs_diff = (combined_Qs != raw_Qs)
+        # Element-wise difference between the two arrays
         # Rows that have Nan values in both dataframes will be thrown out and 
         # should not count towards the difference.
         # Rows that started with a value and ended with Nan should count. (such 
         # as overlap rows)
-        Qs_both_nan = combined_Qs.isnull() & raw_Qs.isnull()
-        both_nan_rows = Qs_both_nan.any(axis=1)
-        Qs_diff.loc[both_nan_rows, :] = False
-
         # Ignore columns that are likely to be different and don't seem to have 
         # any practical value. (I think....?)
-        exclude_cols = ['missing ratio', 'vel', 'sd vel', 'number vel']
-        Qs_diff.loc[:, exclude_cols] = False
-
-        # Isolate the rows and columns where values are different
-        #Qs_diff.loc[0,:] = False # ignore first row
-        diff_rows = Qs_diff.any(axis=1)
-        diff_cols = Qs_diff.any(axis=0)
-        any_diff = diff_rows.any()
+        # See Qs_diff.py
+        if self._can_diff_linked_rows():
+            Qs1_path, kind, diff_rows = self.Qs0_link
+            kind = 'an exact' if kind == 'exact' else 'a near'
+            self.logger.write(f"Qs.txt is {kind} copy of Qs1.txt. Only " +
+                    f"comparing the {len(diff_rows)} rows that differ.")
+            diff = Qs_diff.diff_frames_at(raw_Qs, combined_Qs, diff_rows)
+        else:
+            diff = Qs_diff.diff_frames(raw_Qs, combined_Qs)
 
-        if any_diff:
+        if diff.any():
             # Get some metrics on difference
-            diff_rows_count = diff_rows.sum()
-            rows_count = diff_rows.shape[0]
-            diff_ratio = diff_rows_count / rows_count
-            tolerance = self.difference_tolerance
-
-            is_tolerant = '' if diff_ratio < tolerance else ' NOT'
-            error_msg = QsPickleProcessor.error_codes['MMD']
-            msgs = [error_msg,
-                    f"Difference ratio of {diff_ratio:.3f} is{is_tolerant} within tolerance of {tolerance}.",
-                    f"{diff_rows_count} conflicting rows found out of {rows_count}",
-                    f"Using combined Qs data",
-                    ]
-            self.logger.warning(msgs)
-
-            # Write differing rows/cols to log
-            diff_raw_Qs = raw_Qs.loc[diff_rows, diff_cols]
-            diff_combined = combined_Qs.loc[diff_rows, diff_cols]
-            self.logger.write_dataframe(diff_raw_Qs, "Raw Qs")
-            self.logger.write_dataframe(diff_combined, "Combined Qs")
+            diff_rows_count = diff.n_diff_rows
+            rows_count = diff.n_rows
+
+            # Differing rows/cols for the log. Only the first few rows are 
+            # copied so a badly mismatched period can't flood the log.
+            max_rows = settings.max_logged_diff_rows
+            diff_raw_Qs = Qs_diff.get_diff_block(raw_Qs, diff, max_rows)
+            diff_combined = Qs_diff.get_diff_block(combined_Qs, diff, max_rows)
+            self._log_difference(diff_rows_count, rows_count,
+                    diff_raw_Qs, diff_combined)
 
             #if diff_ratio < diff_tolerance:
             #    raise NotImplementedError
@@ -384,47 +976,93 @@ class QsPickleProcessor:
             # default to using the combined output
 
         else:
-            self.logger.write(["Qs.txt matches combined Qs chunk data",
-                              "(Excluding velocity columns and missing ratio)"])
+            self._log_no_difference()
             self.final_output = combined_Qs
 
-    def _check_accumulated_overlap(self):
-        # Check for accumulated overlap
-        combined_exists = self.combined_Qs is not None
-        overlap = self.accumulating_overlap
-        if combined_exists and overlap.any():
-            overlap_times = self.combined_Qs.loc[overlap,'timestamp']
-            str_overlap_times = overlap_times.to_string(float_format="%f")
+    def _can_diff_linked_rows(self):
+        # The recorded rows are enough if Qs.txt copies Qs1.txt and Qs1.txt 
+        # is the only chunk. See Qs_fingerprint.py
+        link = self.Qs0_link
+        if link is None or self.Qsn_paths != [link[0]]:
+            return False
+        n_rows = len(self.Qs0_data)
+        return len(self.Qsn_data[0]) == n_rows and \
+                bool(np.all(link[2] < n_rows))
+
+    def _log_difference(self, diff_rows_count, rows_count, diff_raw_Qs,
+            diff_combined):
+        diff_ratio = diff_rows_count / rows_count
+        tolerance = self.difference_tolerance
+
+        is_tolerant = '' if diff_ratio < tolerance else ' NOT'
+        error_msg = self.flag_error('MMD')
+        msgs = [error_msg,
+                f"Difference ratio of {diff_ratio:.3f} is{is_tolerant} within tolerance of {tolerance}.",
+                f"{diff_rows_count} conflicting rows found out of {rows_count}",
+                f"Using combined Qs data",
+                ]
+        if len(diff_raw_Qs) < diff_rows_count:
+            msgs.append(f"Showing the first {len(diff_raw_Qs)} conflicting rows")
+        self.logger.warning(msgs)
+        self.period_counts['diff_rows'] = int(diff_rows_count)
+
+        # Write the full differing rows/cols when debugging, or just the rows 
+        # as ranges
+        if self.logger.is_enabled('debug'):
+            self.logger.debug_dataframe(diff_raw_Qs, "Raw Qs")
+            self.logger.debug_dataframe(diff_combined, "Combined Qs")
+        else:
+            self.logger.write("Conflicting rows: " + self._format_ranges(
+                    diff_raw_Qs.index), local_indent=1)
+
+    def _log_no_difference(self):
+        self.logger.write(["Qs.txt matches combined Qs chunk data",
+                          "(Excluding velocity columns and missing ratio)"])
+
+    def _check_accumulated_overlap(self, cleaning):
+        # Check for accumulated overlap. The cleaning found the rows.
+        overlap_rows = cleaning.get_overlap_rows()
+        if len(overlap_rows) > 0:
+            overlap_times = self.combined_Qs['timestamp'].iloc[overlap_rows]
+            self._log_overlap(overlap_times)
+
+    def _log_overlap(self, overlap_times):
+        self.period_counts['overlap_rows'] = len(overlap_times)
+        if not self.logger.is_enabled('debug'):
+            self.logger.write(f"{len(overlap_times)} timestamps were " +
+                    "overlapped: " + self._format_ranges(overlap_times.index,
+                                                         overlap_times.to_numpy()))
+            return
+        str_overlap_times = overlap_times.to_string(float_format="%f")
 
-            self.logger.write(["The following timestamps were overlapped: "])
-            self.logger.write(str_overlap_times.split('\n'), local_indent=1)
+        self.logger.debug(["The following timestamps were overlapped: "])
+        self.logger.debug(str_overlap_times.split('\n'), local_indent=1)
+
+    def _format_ranges(self, index, times=None):
+        # Row labels as ranges. See Qs_logging.format_ranges
+        if not pd.api.types.is_integer_dtype(index):
+            return f"{len(index)} rows"
+        return Qs_logging.format_ranges(index.to_numpy(), times,
+                settings.max_logged_ranges)
 
 
     def calculate_stats(self):
-        # Calc column averages and sums
+        # Calc column averages, sums, and nan counts a few columns at a time
         name = self.pkl_name
         data = self.final_output
-        av = data.mean(axis=0)
-        sum = data.sum(axis=0)
-        nans = data.isnull().sum(axis=0)
-
-        for stat, row in zip(['av', 'sum', 'nans'],[av, sum, nans]):
-            key = (name, stat)
-            # Add the series data to the summary stats dict
-            # The dict will be converted into a multiindexed dataframe later
-            self.summary_stats[key] = row
-            #row_str = row.to_string()
-            #msg = f"Stats for {key} : {row_str}"
-            #self.logger.write(msg)
+        av, sum, nans = Qs_stats.column_stats(data)
+
+        # Add the rows to the summary stats table
+        # The table will be converted into a multiindexed dataframe later
+        self.summary_stats.add_period(name, av, sum, nans, data.columns)
 
     def produce_processed_pickle(self):
         if self.final_output is not None:
-            prepickles = {self.pkl_name : self.final_output}
-            # prepickles is a dictionary of {'pickle name':data}
-            self.loader.produce_pickles(prepickles)
+            self.output_paths += self.store.save(self.pkl_name,
+                    self.final_output, overwrite=True)
             self.combined_file_counter += 1
         else:
-            error_msg = QsPickleProcessor.error_codes['NDF']
+            error_msg = self.flag_error('NDF')
             self.logger.warning([error_msg,
                 f"Pickle not created for {self.pkl_name}"])
 
@@ -433,25 +1071,71 @@ class QsPickleProcessor:
         filepath = pjoin(self.txt_destination, filename)
         data = self.final_output
         
+        filepath = self.save_txt(data, filepath)
+        self.output_paths.append(filepath)
+
+    def save_txt(self, data, filepath):
+        # Write a frame as csv text. The fast writer (opt in) gives the same 
+        # output as DataLoader.save_txt (DataFrame.to_csv). Returns the path 
+        # written, which has an extra extension if compressed. See 
+        # Qs_txt_writer.py
+        if settings.fast_txt_writer:
+            return Qs_txt_writer.write_txt(data, filepath,
+                    precision=settings.txt_precision,
+                    compression=settings.txt_compression)
         self.loader.save_txt(data, filepath, is_path=True)
+        return filepath
 
 
     def update_summary_stats(self):
         summary_stats = self.pd_summary_stats
         pkl_name = self.statspickle_name 
 
-        if summary_stats.empty:
+        # Rebuilt periods that have no new rows (eg. they failed or had no 
+        # data) lose their old rows too
+        new_names = set() if summary_stats.empty else \
+                set(summary_stats.index.get_level_values(0))
+        emptied = sorted(self.rebuilt_periods - new_names)
+
+        if self.stats_log is not None:
+            if emptied and self.stats_log.drop_periods(emptied):
+                self.logger.write(["Dropped the stats rows of"] + emptied)
+            # Only the new rows are written
+            if summary_stats.empty:
+                self.logger.write(["No new stats. Nothing to do."])
+            else:
+                part_path = self.stats_log.append(summary_stats)
+                self.logger.write([f"Appended {len(summary_stats)} stats rows to",
+                                   part_path])
+            if self.stats_log.compact_if_needed():
+                self.logger.write(["Compacted the stats log"])
+            return
+
+        if summary_stats.empty and not (emptied and
+                self.loader.is_pickled(pkl_name)):
             self.logger.write(["No new stats. Nothing to do."])
+            if self.loader.is_pickled(pkl_name):
+                # Keep the old stats so they aren't overwritten with nothing
+                self.pd_summary_stats = self.loader.load_pickle(
+                        pkl_name, use_source=False)
             return
 
         if self.loader.is_pickled(pkl_name):
             self.logger.write(["Stats pickle already exists. Updating..."])
             old_stats = self.loader.load_pickle(pkl_name, use_source=False)
-            unchanged_indices = ~old_stats.index.isin(summary_stats)
-            new_indices_strs = summary_stats.index.levels[0].__str__().split('\n')
-            summary_stats = pd.concat([old_stats[unchanged_indices],
-                                       summary_stats])
-            self.logger.write(["Updated index values are:"] + new_indices_strs)
+            # Rebuilt periods replace their old rows
+            old_names = old_stats.index.get_level_values(0)
+            unchanged_indices = ~old_stats.index.isin(summary_stats.index) & \
+                    ~old_names.isin(emptied)
+            if summary_stats.empty:
+                summary_stats = old_stats[unchanged_indices]
+            else:
+                new_indices_strs = summary_stats.index.levels[0].__str__().split('\n')
+                summary_stats = pd.concat([old_stats[unchanged_indices],
+                                           summary_stats])
+                self.logger.write(["Updated index values are:"] + new_indices_strs)
+            if emptied:
+                self.logger.write(["Dropped the stats rows of"] + emptied)
         else:
             self.logger.write(["Making new stats pickle. Updating..."])
             # prepickles is a dictionary of {'pickle name':data}
@@ -463,30 +1147,70 @@ class QsPickleProcessor:
         pkl_name = self.statspickle_name 
 
         prepickles = {pkl_name : summary_stats}
-        self.loader.produce_pickles(prepickles)
+        self.loader.produce_pickles(prepickles, overwrite=True)
         #self.combined_file_counter += 1
 
     def write_stats_txt(self):
         filename = f"{self.statspickle_name}.txt"
         filepath = pjoin(self.txt_destination, filename)
         data = self.pd_summary_stats
+        if self.stats_log is not None:
+            # Needs all the stats, not just this run's
+            data = self.stats_log.load()
         
-        kwargs = {'index'  : True,
-                  'header' : True,
-                  }
-        self.loader.save_txt(data, filepath, kwargs=kwargs, is_path=True)
-
+        # With the index and header, like the save_txt defaults
+        self.save_txt(data, filepath)
+
+
+def settings_values():
+    # The settings.py values, for worker processes
+    return {name : value for name, value in vars(settings).items()
+            if not name.startswith('_') and not callable(value) and
+            not isinstance(value, types.ModuleType)}
+
+# The worker process's processor, made by _init_period_worker
+_worker_processor = None
+
+def _init_period_worker(setting_values, output_txt):
+    # Runs once in each worker process. Log calls are recorded rather than 
+    # written so the parent can replay them in order.
+    global _worker_processor
+    vars(settings).update(setting_values)
+    recorder = LogRecorder(settings.log_level)
+    _worker_processor = QsPickleProcessor(output_txt=output_txt,
+            logger=recorder, manifest=Qs_manifest.BuildManifest())
+
+def _process_period_worker(period_path, Qs_path_list, period_links,
+        manifest):
+    # Process one period in a worker process
+    processor = _worker_processor
+    processor.logger.clear()
+    processor.profiler.pop_records()
+    processor.manifest = manifest
+    processor.metapickle = {period_path : Qs_path_list}
+    processor.raw_file_counter = 0
+    processor.combined_file_counter = 0
+    processor.summary_stats = Qs_stats.StatsTable()
+    processor.rebuilt_periods = set()
+    processor.run_period(period_path, period_links)
+    return _period_result(processor)
+
+def _period_result(processor):
+    # What the parent needs from a period run by a worker or the pipeline
+    return {'period_path'           : processor.current_period_path,
+            'pkl_name'              : processor.pkl_name,
+            'period_status'         : processor.period_status,
+            'period_record'         : processor.period_record,
+            'log_records'           : processor.logger.pop_records(),
+            'summary_stats'         : processor.summary_stats,
+            'raw_file_counter'      : processor.raw_file_counter,
+            'combined_file_counter' : processor.combined_file_counter,
+            'stage_records'         : processor.profiler.pop_records(),
+            }
 
 
 if __name__ == "__main__":
-    # Run the extraction crawler
-    crawler = Qs_extractor.QsExtractor(
-            root_dir = settings.root_dir,
-            output_dir = settings.Qs_raw_pickles_dir,
-            )
-    metapickle_path = crawler.run()
-
-    # Run the script
-    merger = QsPickleProcessor(output_txt=True, 
-            metapickle_path=metapickle_path)
-    merger.run()
+    # The command line lives in Qs_cli.py (also the Qs-merger console script)
+    import sys
+    import Qs_cli
+    sys.exit(Qs_cli.main())
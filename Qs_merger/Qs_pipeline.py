@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Pipelined period processing. Every period goes through three stages:
+#   read  : the up to date check and loading the raw frames (prefetch thread)
+#   merge : error checks, combining, cleaning, and stats (calling thread)
+#   write : the merged pickle, the txt file, and the build record (writer
+#           thread)
+# So while period N is merging, period N+1 is being loaded and period N-1 is
+# being written. Loading and writing are mostly waiting on the disk (or NFS),
+# which releases the GIL, so the merge gets the CPU to itself.
+#
+# The stages are joined by bounded queues. A stage that gets ahead blocks
+# until the next stage catches up (backpressure), so at most
+#   prefetch + pending_writes + 3
+# periods are in memory at once (one in each stage plus the queued ones).
+#
+# An exception in a stage only fails that period. The period skips its
+# remaining stages and comes out of the pipeline with a StageFailure, and the
+# other periods carry on. Anything else that goes wrong (eg. Ctrl-C, or the
+# period list itself failing) stops every stage and is raised by run().
+#
+# Periods come out of run() in the order they went in, once their write is
+# done (or they failed).
+
+import queue
+import threading
+import traceback
+
+# Marks the end of a queue
+_end = object()
+
+
+class StageFailure:
+    # Why a period failed: the stage, the exception, and its traceback
+
+    def __init__(self, stage, error):
+        self.stage = stage
+        self.error = error
+        self.traceback = traceback.format_exception(
+                type(error), error, error.__traceback__)
+
+    def lines(self):
+        # For the log
+        return [f"{self.stage} stage failed: {self.error!r}"] + \
+               ''.join(self.traceback).rstrip().split('\n')
+
+
+class PeriodPipeline:
+
+    def __init__(self, read, merge, write, prefetch=1, pending_writes=1,
+            poll_interval=0.1):
+        # read(item) returns False if the item needs no merge or write (eg.
+        # it is up to date). merge(item) and write(item) return nothing.
+        self.read = read
+        self.merge = merge
+        self.write = write
+        self.prefetch = max(1, prefetch)
+        self.pending_writes = max(1, pending_writes)
+        self.poll_interval = poll_interval
+
+    def run(self, items):
+        # Yields (item, StageFailure or None) in item order
+        stop = threading.Event()
+        fatal = []
+        read_queue = queue.Queue(maxsize=self.prefetch)
+        write_queue = queue.Queue(maxsize=self.pending_writes)
+        done_queue = queue.Queue()
+
+        def put(to_queue, entry):
+            # Wait for space, unless the pipeline is stopping
+            while not stop.is_set():
+                try:
+                    to_queue.put(entry, timeout=self.poll_interval)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(from_queue):
+            while not stop.is_set():
+                try:
+                    return from_queue.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    pass
+            return _end
+
+        def read_loop():
+            try:
+                for item in items:
+                    failure, more = None, False
+                    try:
+                        more = self.read(item)
+                    except Exception as error:
+                        failure = StageFailure('read', error)
+                    if not put(read_queue, (item, more, failure)):
+                        return
+            except BaseException as error:
+                fatal.append(error)
+            finally:
+                put(read_queue, _end)
+
+        def write_loop():
+            try:
+                while True:
+                    entry = get(write_queue)
+                    if entry is _end:
+                        break
+                    item, more, failure = entry
+                    if more and failure is None:
+                        try:
+                            self.write(item)
+                        except Exception as error:
+                            failure = StageFailure('write', error)
+                    done_queue.put((item, failure))
+            except BaseException as error:
+                fatal.append(error)
+                stop.set()
+            finally:
+                done_queue.put(_end)
+
+        threads = [threading.Thread(target=read_loop, name='Qs-prefetch',
+                                    daemon=True),
+                   threading.Thread(target=write_loop, name='Qs-writer',
+                                    daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            writer_done = False
+            while True:
+                entry = get(read_queue)
+                if entry is _end:
+                    break
+                item, more, failure = entry
+                if more and failure is None:
+                    try:
+                        self.merge(item)
+                    except Exception as error:
+                        failure = StageFailure('merge', error)
+                if not put(write_queue, (item, more, failure)):
+                    break
+
+                # Hand back whatever has been written so far
+                while True:
+                    try:
+                        done = done_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if done is _end:
+                        writer_done = True
+                        break
+                    yield done
+                if writer_done:
+                    break
+
+            # Wait for the rest of the writes
+            put(write_queue, _end)
+            while not writer_done:
+                done = done_queue.get()
+                if done is _end:
+                    break
+                yield done
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        if fatal:
+            raise fatal[0]
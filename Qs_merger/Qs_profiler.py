@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Per-stage timing and memory records for the extractor and pickle processor.
+#
+# Every stage of a run is wrapped in StageProfiler.stage, which keeps one
+# record per (period, stage):
+#   wall_s      : wall clock time
+#   cpu_s       : cpu time of this process (user + system)
+#   rows        : rows of data the stage handled (files for file discovery)
+#   bytes       : bytes of data the stage loaded, made, or wrote
+#   peak_rss_mb : peak resident memory
+#   peak_rss_scope : 'stage' or 'process', what peak_rss_mb covers
+#
+# On Linux the peak rss is reset at the start of each stage so it is the peak
+# for that stage. Elsewhere it is the peak of the process so far. Stages that
+# run at the same time in threads (the period pipeline, see Qs_pipeline.py)
+# share one process peak, so a profiler made with stage_memory=False never
+# resets it and its readings are the process peak so far. Worker processes
+# keep their own records and send them back to the parent.
+#
+# At the end of a run the records are written to a json and a csv report next
+# to the log files, and the slowest periods are summarized in the log.
+
+import csv
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from os.path import join as pjoin
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+report_fields = ['component', 'period', 'stage', 'wall_s', 'cpu_s', 'rows',
+                 'bytes', 'peak_rss_mb', 'peak_rss_scope']
+
+_proc_status = '/proc/self/status'
+_proc_clear_refs = '/proc/self/clear_refs'
+_can_reset_peak = None
+
+
+def reset_peak_rss():
+    # Reset the kernel's peak rss (VmHWM) for this process. Linux only.
+    # Returns True if it worked.
+    global _can_reset_peak
+    if _can_reset_peak is False:
+        return False
+    try:
+        with open(_proc_clear_refs, 'w') as clear_refs:
+            clear_refs.write('5')
+        _can_reset_peak = True
+    except OSError:
+        _can_reset_peak = False
+    return _can_reset_peak
+
+def get_peak_rss_mb():
+    # Peak resident memory in MB, or None if it can't be found
+    if _can_reset_peak:
+        try:
+            with open(_proc_status, 'r') as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB everywhere else
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 1024
+
+def frame_sizes(frames):
+    # Returns (rows, bytes) for a list of dataframes (None entries are skipped)
+    frames = [f for f in frames if f is not None]
+    if not frames:
+        return None, None
+    rows = max(f.shape[0] for f in frames)
+    nbytes = sum(int(f.memory_usage(index=True).sum()) for f in frames)
+    return rows, nbytes
+
+def path_sizes(paths):
+    # Total size of files (or npy store directories) in bytes
+    total = 0
+    for path in paths:
+        if os.path.isdir(path):
+            total += sum(os.path.getsize(pjoin(path, f))
+                         for f in os.listdir(path))
+        elif os.path.isfile(path):
+            total += os.path.getsize(path)
+    return total
+
+
+class StageProfiler:
+
+    def __init__(self, component, enabled=True, stage_memory=True):
+        self.component = component
+        self.enabled = enabled
+        self.stage_memory = stage_memory
+        self.records = []
+        self._depth = 0
+
+    @contextmanager
+    def stage(self, stage, period=None):
+        # Time the code in the with block. Yields the record so the stage can
+        # fill in 'rows' and 'bytes'.
+        record = {'component' : self.component,
+                  'period'    : period,
+                  'stage'     : stage,
+                  'rows'      : None,
+                  'bytes'     : None,
+                  }
+        if not self.enabled:
+            yield record
+            return
+
+        # Nested stages would wipe out the outer stage's peak
+        if self._depth == 0 and self.stage_memory:
+            reset_peak_rss()
+        self._depth += 1
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - wall_start
+            record['cpu_s'] = time.process_time() - cpu_start
+            record['peak_rss_mb'] = get_peak_rss_mb()
+            record['peak_rss_scope'] = 'stage' if self.stage_memory and \
+                    _can_reset_peak else 'process'
+            self._depth -= 1
+            self.records.append(record)
+
+    def extend(self, records):
+        # Add records from a worker process
+        self.records.extend(records)
+
+    def pop_records(self):
+        records = self.records
+        self.records = []
+        return records
+
+    def to_frame(self):
+        return pd.DataFrame(self.records, columns=report_fields)
+
+    def period_totals(self):
+        # Total time and max peak memory for each period, slowest first
+        records = self.to_frame().dropna(subset=['period'])
+        if records.empty:
+            return records
+        totals = records.groupby('period').agg(
+                wall_s=('wall_s', 'sum'),
+                cpu_s=('cpu_s', 'sum'),
+                peak_rss_mb=('peak_rss_mb', 'max'),
+                slowest_stage=('wall_s', lambda s: records.loc[s.idxmax(), 'stage']),
+                )
+        return totals.sort_values('wall_s', ascending=False)
+
+    def summary_lines(self, n_periods=10):
+        # Lines for the log: total time per stage and the slowest periods
+        records = self.to_frame()
+        if records.empty:
+            return ["No stages were profiled"]
+
+        lines = ["Time per stage (wall s, cpu s):"]
+        stage_totals = records.groupby('stage', sort=False)[['wall_s', 'cpu_s']].sum()
+        for stage, row in stage_totals.iterrows():
+            lines.append(f"  {stage:28s} {row['wall_s']:10.3f} {row['cpu_s']:10.3f}")
+
+        totals = self.period_totals()
+        if not totals.empty:
+            is_stage_peak = (records['peak_rss_scope'] == 'stage').all()
+            rss = "peak rss MB" if is_stage_peak else "process peak rss MB"
+            lines.append(f"Slowest {min(n_periods, len(totals))} of " +
+                         f"{len(totals)} periods (wall s, {rss}, slowest stage):")
+            for period, row in totals.head(n_periods).iterrows():
+                lines.append(f"  {period:28s} {row['wall_s']:10.3f} " +
+                             f"{row['peak_rss_mb']:10.1f}  {row['slowest_stage']}")
+        return lines
+
+    def write_report(self, report_dir):
+        # Write the records as json and csv. Returns the two paths. The names 
+        # have the time and pid, plus a count if this process already wrote 
+        # a report that second.
+        os.makedirs(report_dir, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        name = f"{self.component}-report-{stamp}-{os.getpid()}"
+        base_path = pjoin(report_dir, name)
+        count = 1
+        while os.path.exists(f"{base_path}.json"):
+            count += 1
+            base_path = pjoin(report_dir, f"{name}-{count}")
+
+        json_path = f"{base_path}.json"
+        with open(json_path, 'w') as json_file:
+            json.dump({'component' : self.component,
+                       'time'      : time.asctime(),
+                       'pid'       : os.getpid(),
+                       'records'   : self.records,
+                       }, json_file, indent=1)
+
+        csv_path = f"{base_path}.csv"
+        with open(csv_path, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=report_fields)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+        return json_path, csv_path
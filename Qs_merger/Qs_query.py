@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+# Queries across the merged Qs frames of many periods.
+#
+# The processor only makes the summary stats. For anything else (a bedload
+# time series for a whole experiment, grain size fractions per step, ...)
+# QsQuery picks out the periods, columns, and times you want from the merged
+# store and streams them:
+#   periods     : fnmatch patterns for the period names (eg. 't20*'). The
+#                 names are the merged frame names without the Qs_ prefix.
+#   fields      : {field : value or list of values} matched against the
+#                 directories above each period directory (see
+#                 period_path_fields in settings.py). The period directories
+#                 come from the metastore (period_dirs).
+#   columns     : columns to read. The npy, feather, and mmap stores only read
+#                 those columns.
+#   start, stop : only rows with start <= timestamp < stop
+#
+# Periods are loaded by a pool of threads a few at a time, in period name
+# order, so only max_in_flight periods are ever in memory. Each period is
+# trimmed to the query before it is handed on. Results can be:
+#   to_frame()  : one DataFrame indexed by (period, row)
+#   to_array()  : one 2D float array
+#   reduce(by)  : stats per period, per path field, or over everything, in the
+#                 same (group, stat) layout as the summary stats
+#
+# Example:
+#   query = query_from_settings(fields={'step' : 'rising-50L'},
+#           columns=['timestamp', 'Bedload all'])
+#   rates = query.to_frame()
+#
+# From the command line:
+#   python Qs_query.py --fields experiment=1A --columns 'Bedload all' \
+#           --reduce step --output 1A_stats.csv
+
+import argparse
+import fnmatch
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join as pjoin
+import numpy as np
+import pandas as pd
+
+import Qs_storage
+from Qs_stats import ColumnStatsAccumulator
+
+stored_extensions = [Qs_storage.mmap_extension, Qs_storage.npy_extension,
+                     Qs_storage.feather_extension, Qs_storage.pickle_extension]
+period_prefix = 'Qs_'
+default_path_fields = ['experiment', 'step']
+query_stat_names = ['av', 'sum', 'nans', 'count', 'min', 'max']
+
+
+def period_name(period_path):
+    # Merged frame name of a period without the Qs_ prefix, like the
+    # processor makes it, eg. '.../1A/rising-50L/results-t20' -> 't20'
+    name = os.path.basename(os.path.normpath(period_path))
+    return name.replace('results-', '')
+
+def parse_period_path(period_path, path_fields=default_path_fields):
+    # Name the directories above a period directory, outermost first, eg.
+    # '.../1A/rising-50L/results-t20' -> {'experiment' : '1A',
+    # 'step' : 'rising-50L'}. Missing parts are None.
+    parents = os.path.dirname(os.path.normpath(period_path))
+    parents = [part for part in parents.split(os.sep) if part]
+    n_fields = len(path_fields)
+    parts = parents[-n_fields:] if n_fields else []
+    parts = [None] * (n_fields - len(parts)) + parts
+    return dict(zip(path_fields, parts))
+
+def find_merged_periods(merged_dir, skip_names=[]):
+    # {period name : merged frame path} for every merged frame in the store.
+    # If a period is stored in several formats (eg. halfway through a
+    # migration), the columnar formats are used.
+    found = {}
+    for fname in sorted(os.listdir(merged_dir)):
+        if not fname.startswith(period_prefix):
+            continue
+        for rank, extension in enumerate(stored_extensions):
+            if not fname.endswith(extension):
+                continue
+            stem = fname[:-len(extension)]
+            if stem in skip_names:
+                break
+            name = stem[len(period_prefix):]
+            if name not in found or rank < found[name][0]:
+                found[name] = (rank, pjoin(merged_dir, fname))
+            break
+    return {name : found[name][1] for name in sorted(found)}
+
+
+class QueryAccumulator (ColumnStatsAccumulator):
+    # Adds counts, mins, and maxes to the summary stats for one group
+
+    def __init__(self, n_cols):
+        ColumnStatsAccumulator.__init__(self, n_cols)
+        self.mins = np.full(n_cols, np.inf)
+        self.maxs = np.full(n_cols, -np.inf)
+
+    def add(self, values):
+        # values is a 2D (rows, columns) block
+        ColumnStatsAccumulator.add(self, values)
+        if values.shape[0]:
+            # fmin/fmax ignore the nans
+            self.mins = np.fmin(self.mins, np.fmin.reduce(values, axis=0))
+            self.maxs = np.fmax(self.maxs, np.fmax.reduce(values, axis=0))
+
+    def get_stats(self):
+        # Rows in query_stat_names order
+        av, sums, nans = ColumnStatsAccumulator.get_stats(self)
+        has_data = self.counts > 0
+        return [av, sums, nans, self.counts.copy(),
+                np.where(has_data, self.mins, np.nan),
+                np.where(has_data, self.maxs, np.nan)]
+
+
+class QsQuery:
+
+    def __init__(self, merged_dir, periods=None, fields=None, columns=None,
+            start=None, stop=None, time_column='timestamp', period_dirs=None,
+            path_fields=default_path_fields, max_workers=4,
+            max_in_flight=None, skip_names=['Qs_summary_stats']):
+        # period_dirs are the period directories (eg. the metastore's period 
+        # paths). Only needed to filter or group by path fields.
+        self.merged_dir = merged_dir
+        self.period_patterns = periods
+        self.fields = {} if fields is None else fields
+        self.columns = None if columns is None else list(columns)
+        self.start = start
+        self.stop = stop
+        self.time_column = time_column
+        self.path_fields = list(path_fields)
+        self.period_parts = None
+        if period_dirs is not None:
+            self.period_parts = {period_name(path) :
+                    parse_period_path(path, self.path_fields)
+                    for path in period_dirs}
+        self.max_workers = max(1, max_workers or 1)
+        if max_in_flight is None:
+            max_in_flight = 2 * self.max_workers
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1, " +
+                             f"not {max_in_flight}")
+        self.max_in_flight = max_in_flight
+        self.skip_names = skip_names
+
+        for field in self.fields:
+            self.check_field(field)
+
+    def check_field(self, field):
+        if field not in self.path_fields:
+            raise ValueError(f"Unknown period path field {field}. " +
+                             f"Choose from {self.path_fields}")
+        if self.period_parts is None:
+            raise ValueError(f"Can't use the {field} field without " +
+                             "period_dirs")
+
+    def field_value(self, name, field):
+        # None if the period's directory isn't known
+        return self.period_parts.get(name, {}).get(field)
+
+    def has_window(self):
+        return self.start is not None or self.stop is not None
+
+    def matches(self, name):
+        if self.period_patterns is not None and not any(
+                fnmatch.fnmatchcase(name, p) for p in self.period_patterns):
+            return False
+        for field, wanted in self.fields.items():
+            wanted = [wanted] if isinstance(wanted, str) else wanted
+            if self.field_value(name, field) not in wanted:
+                return False
+        return True
+
+    def period_paths(self):
+        # {period name : path} of the periods matching the filters
+        stored = find_merged_periods(self.merged_dir, self.skip_names)
+        return {name : path for name, path in stored.items()
+                if self.matches(name)}
+
+    def load_period(self, path):
+        # Load the queried columns and rows of one period. Columnar stores are
+        # memory mapped so only the needed columns and rows are read.
+        load_columns = self.columns
+        drop_time = False
+        if self.has_window() and load_columns is not None and \
+                self.time_column not in load_columns:
+            load_columns = load_columns + [self.time_column]
+            drop_time = True
+
+        data = Qs_storage.load_frame(path, None, load_columns, mmap=True)
+        is_mapped = Qs_storage.path_format(path) != 'pickle'
+        if self.has_window():
+            times = data[self.time_column].to_numpy(dtype=np.float64)
+            rows = ~np.isnan(times)
+            if self.start is not None:
+                rows &= times >= self.start
+            if self.stop is not None:
+                rows &= times < self.stop
+            data = data.loc[rows]
+            is_mapped = False
+        if drop_time:
+            data = data.drop(columns=self.time_column)
+        # Copy out of the memory maps so the files can be let go
+        return data.copy() if is_mapped else data
+
+    def iter_periods(self):
+        # Yields (period name, frame) in period name order. Empty periods
+        # (eg. outside the time window) are skipped.
+        paths = self.period_paths()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = deque()
+            names = iter(paths)
+            while True:
+                # Keep up to max_in_flight periods loading ahead
+                while len(in_flight) < self.max_in_flight:
+                    name = next(names, None)
+                    if name is None:
+                        break
+                    in_flight.append((name,
+                            executor.submit(self.load_period, paths[name])))
+                if not in_flight:
+                    break
+
+                name, future = in_flight.popleft()
+                data = future.result()
+                if len(data):
+                    yield name, data
+
+    def to_frame(self):
+        # All the queried rows in one frame indexed by (period, row)
+        names, frames = [], []
+        for name, data in self.iter_periods():
+            names.append(name)
+            frames.append(data)
+        if not frames:
+            return pd.DataFrame(columns=self.columns)
+        return pd.concat(frames, keys=names, names=['period', None])
+
+    def to_array(self):
+        # All the queried rows as one 2D float array
+        blocks = [data.to_numpy(dtype=np.float64)
+                  for _, data in self.iter_periods()]
+        if not blocks:
+            n_cols = 0 if self.columns is None else len(self.columns)
+            return np.empty((0, n_cols))
+        return np.concatenate(blocks)
+
+    def reduce(self, by='period'):
+        # Stats of the queried rows. by is 'period', one of the period path
+        # fields, or None for one group with everything. Returns a frame
+        # indexed by (group, stat) like the summary stats.
+        if by is not None and by != 'period':
+            if by not in self.path_fields:
+                raise ValueError(f"Can't group by {by}. Choose from " +
+                                 f"{['period', None] + self.path_fields}")
+            self.check_field(by)
+        groups = {}
+        columns = None
+        for name, data in self.iter_periods():
+            if columns is None:
+                columns = data.columns
+            if by is None:
+                group = 'all'
+            elif by == 'period':
+                group = name
+            else:
+                group = self.field_value(name, by)
+            if group not in groups:
+                groups[group] = QueryAccumulator(len(columns))
+            groups[group].add(data.to_numpy(dtype=np.float64))
+
+        if not groups:
+            return pd.DataFrame()
+        keys, rows = [], []
+        for group, accumulator in groups.items():
+            for stat, row in zip(query_stat_names, accumulator.get_stats()):
+                keys.append((group, stat))
+                rows.append(row)
+        return pd.DataFrame(np.array(rows, dtype=np.float64),
+                index=pd.MultiIndex.from_tuples(keys), columns=columns)
+
+
+def query_from_settings(**kwargs):
+    # QsQuery over the merged store in settings.py, with the period 
+    # directories from the metastore
+    import settings
+    import Qs_metastore
+    metastore_path = pjoin(settings.Qs_raw_pickles_dir,
+            settings.metastore_name)
+    if 'period_dirs' not in kwargs and os.path.isfile(metastore_path):
+        metastore = Qs_metastore.MetaStore(metastore_path)
+        try:
+            kwargs['period_dirs'] = metastore.periods()
+        finally:
+            metastore.close()
+    kwargs.setdefault('path_fields', settings.period_path_fields)
+    kwargs.setdefault('skip_names', [settings.statspickle_name])
+    return QsQuery(settings.Qs_merged_pickles_dir, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Query the merged Qs frames across periods")
+    parser.add_argument('--periods', nargs='+', default=None,
+            help="Period name patterns, eg. 't20*'")
+    parser.add_argument('--fields', nargs='+', default=[],
+            help="Period path fields, eg. experiment=1A step=rising-50L")
+    parser.add_argument('--columns', nargs='+', default=None)
+    parser.add_argument('--start', type=float, default=None)
+    parser.add_argument('--stop', type=float, default=None)
+    parser.add_argument('--reduce', dest='by', default=None,
+            help="Write stats grouped by 'period', a path field, or 'all'")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--output', required=True, help="csv file to write")
+    args = parser.parse_args()
+
+    fields = {}
+    for field in args.fields:
+        key, value = field.split('=', 1)
+        fields.setdefault(key, []).append(value)
+
+    query = query_from_settings(periods=args.periods, fields=fields,
+            columns=args.columns, start=args.start, stop=args.stop,
+            max_workers=args.workers)
+    if args.by is None:
+        result = query.to_frame()
+    else:
+        result = query.reduce(None if args.by == 'all' else args.by)
+    result.to_csv(args.output)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Fast reader for the fixed light table Qs#.txt layout. The generic loader 
+# sends every file through pandas' text reader with type inference, but the Qs 
+# files are always the same 44 tab separated float columns. This reader parses 
+# with an explicit float64 schema (pyarrow's multithreaded csv parser), copies 
+# the columns into one preallocated float64 block, and wraps the block as a 
+# DataFrame without copying it again. Anything unexpected makes it return None 
+# so the caller can fall back to the generic loader.
+#
+# pyarrow is optional. Without it, is_available() is False and the extractor 
+# uses the generic loader for everything.
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+
+from Qs_schema import Qs_column_names
+
+
+def is_available():
+    return pa is not None
+
+def read_Qs_txt(filepath, column_names=Qs_column_names, use_threads=True):
+    # Returns a DataFrame, or None if the file does not look clean.
+    if pa is None:
+        return None
+
+    read_options = pa_csv.ReadOptions(
+            column_names=column_names, use_threads=use_threads)
+    parse_options = pa_csv.ParseOptions(delimiter='\t')
+    # Only 'NaN' counts as missing. Empty fields or stray text are errors 
+    # rather than silently becoming NaN.
+    convert_options = pa_csv.ConvertOptions(
+            column_types={name : pa.float64() for name in column_names},
+            null_values=['NaN'],
+            strings_can_be_null=False)
+
+    try:
+        table = pa_csv.read_csv(filepath, read_options=read_options,
+                parse_options=parse_options, convert_options=convert_options)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+
+    return _table_to_df(table, column_names)
+
+def _table_to_df(table, column_names):
+    # Copy the arrow columns into one (n_cols, n_rows) block. Pandas stores a 
+    # single dtype frame as exactly that shape, so wrapping block.T does not 
+    # make another copy.
+    block = np.empty((len(column_names), table.num_rows), dtype=np.float64)
+    for i, column in enumerate(table.columns):
+        start = 0
+        for chunk in column.chunks:
+            stop = start + len(chunk)
+            # Nulls come out as NaN
+            block[i, start:stop] = chunk.to_numpy(zero_copy_only=False)
+            start = stop
+
+    return pd.DataFrame(block.T, columns=column_names, copy=False)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+# Column layout of the light table Qs#.txt files. Every Qs file has these 44 
+# numeric columns in this order with no header row.
+
+meta_column_names = [
+        # Timing and meta data
+        #'elapsed-time sec', <- Calculate this column later
+        'timestamp', 'missing ratio', 'vel', 'sd vel', 'number vel',
+        ]
+bedload_column_names = [
+        # Bedload transport masses (g)
+        'Bedload all', 'Bedload 0.5', 'Bedload 0.71', 'Bedload 1',
+        'Bedload 1.4', 'Bedload 2', 'Bedload 2.8', 'Bedload 4',
+        'Bedload 5.6', 'Bedload 8', 'Bedload 11.2', 'Bedload 16',
+        'Bedload 22', 'Bedload 32', 'Bedload 45',
+        ]
+count_column_names = [
+        # Grain counts
+        'Count all', 'Count 0.5', 'Count 0.71', 'Count 1', 'Count 1.4',
+        'Count 2', 'Count 2.8', 'Count 4', 'Count 5.6', 'Count 8',
+        'Count 11.2', 'Count 16', 'Count 22', 'Count 32', 'Count 45',
+        ]
+stats_column_names = [
+        # Statistics
+        'D10', 'D16', 'D25', 'D50', 'D75', 'D84', 'D90', 'D95', 'Dmax'
+        ]
+
+Qs_column_names = (meta_column_names + bedload_column_names +
+                   count_column_names + stats_column_names)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# Work queue for merging the periods on several nodes at once.
+#
+# The queue is a directory on the shared filesystem next to the metastore.
+# Nothing runs the queue: every node (a QsPickleProcessor started with
+# Qs-merger --shard) walks the period list and claims the periods nobody else
+# has. Each period has up to two files in the queue directory:
+#   <key>.lease : the period is being merged. Json with the node, host, pid,
+#                 and when the lease expires. Made with O_EXCL, so only one
+#                 node can get it.
+#   <key>.done  : the period is finished. Json with the node, the status
+#                 ('merged', 'current', or 'failed'), and the period's build
+#                 manifest record. The period's summary stats rows are next to
+#                 it in <key>.stats.pkl.
+# So every node writes its own merged outputs and partial stats, and nothing
+# shared (the stats pickle, the build manifest) is written until the reduce
+# step (Qs-merger --reduce) combines the done records once every period is
+# finished. The reduce clears the queue for the next run.
+#
+# A node renews its lease from a heartbeat thread while it merges. If a node
+# dies, its lease stops being renewed and another node takes the period over
+# once the lease expires (lease_seconds). A lease held by a dead process on
+# the same host is taken over right away. Taking over renames the old lease
+# out of the way first, which only one node can do. The node then checks that
+# the file it moved is the lease it saw expire. If another node took the
+# period over in between, the moved file is that node's new lease, so it is
+# put back and the period is left alone. Lease times come from
+# each node's clock, so the nodes' clocks need to roughly agree (eg. NTP);
+# keep lease_seconds well above any clock difference.
+#
+# Nodes keep polling until every period is done, so the periods of a node
+# that died are picked up by the ones that are left.
+
+import hashlib
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from os.path import join as pjoin
+
+lease_extension = '.lease'
+done_extension = '.done'
+stats_extension = '.stats.pkl'
+
+
+class LeaseLost (Exception):
+    # Another node took over a lease
+    pass
+
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def item_key(item):
+    # File name safe key for a period path. The name part is just to make the
+    # queue directory readable.
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', os.path.basename(item))[-40:]
+    digest = hashlib.sha1(item.encode('utf-8')).hexdigest()[:16]
+    return f"{name}-{digest}"
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # someone else's process
+    return True
+
+def write_json(path, data):
+    # Write to a temp file first so readers never see half a file
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(tmp_path, path)
+
+def read_json(path):
+    # None if the file is gone (or being replaced)
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class LeaseQueue:
+
+    def __init__(self, queue_dir, node_id=None, lease_seconds=600,
+            poll_interval=5):
+        self.queue_dir = queue_dir
+        self.node_id = default_node_id() if node_id is None else node_id
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.host = socket.gethostname()
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def lease_path(self, item):
+        return pjoin(self.queue_dir, f"{item_key(item)}{lease_extension}")
+
+    def done_path(self, item):
+        return pjoin(self.queue_dir, f"{item_key(item)}{done_extension}")
+
+    def stats_path(self, item):
+        return pjoin(self.queue_dir, f"{item_key(item)}{stats_extension}")
+
+    def make_lease(self, item):
+        return {'item' : item, 'node' : self.node_id, 'host' : self.host,
+                'pid' : os.getpid(),
+                'expires' : time.time() + self.lease_seconds}
+
+    ## Claiming
+
+    def is_done(self, item):
+        return os.path.exists(self.done_path(item))
+
+    def is_expired(self, lease):
+        if lease['host'] == self.host and not is_process_alive(lease['pid']):
+            return True
+        return time.time() > lease['expires']
+
+    def claim(self, item):
+        # Returns True if this node now holds the lease
+        if self.is_done(item):
+            return False
+        path = self.lease_path(item)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                lease = read_json(path)
+                if lease is None or not self.is_expired(lease):
+                    return False
+                if not self._break_lease(path, lease):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as lease_file:
+                json.dump(self.make_lease(item), lease_file)
+            # It might have been finished between the done check and now
+            if self.is_done(item):
+                self.release(item)
+                return False
+            return True
+        return False
+
+    def _break_lease(self, path, expired):
+        # Move an expired lease out of the way. Only one node's rename can
+        # succeed, but the file it moves might not be the lease that was read
+        # as expired (another node might have broken that one and claimed the
+        # item since). So the moved lease is compared with the expired one and
+        # put back if it is different.
+        stale_path = f"{path}.stale-{uuid.uuid4().hex}"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return False
+        if read_json(stale_path) != expired:
+            # Someone else's live lease (or one still being written). A hard
+            # link puts it back without replacing a newer lease.
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return True
+
+    def renew(self, item):
+        # Push the lease expiry back. Raises LeaseLost if it isn't ours any
+        # more.
+        path = self.lease_path(item)
+        lease = read_json(path)
+        if lease is None or lease['node'] != self.node_id:
+            raise LeaseLost(f"{self.node_id} lost the lease on {item}")
+        write_json(path, self.make_lease(item))
+
+    def release(self, item):
+        # Give up a lease without finishing (someone else can claim it)
+        path = self.lease_path(item)
+        lease = read_json(path)
+        if lease is not None and lease['node'] == self.node_id:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def complete(self, item, status, record=None):
+        # Mark the item done. record is anything json can store.
+        write_json(self.done_path(item), {'item' : item,
+                'node' : self.node_id, 'status' : status, 'record' : record})
+        self.release(item)
+
+    def hold(self, item):
+        # Context manager that renews the lease in the background
+        return Heartbeat(self, item)
+
+    def claim_items(self, items):
+        # Yields the items this node claims, in order. Items held by other
+        # nodes are checked again every poll_interval until they are done or
+        # their lease expires, so this only ends once everything is done.
+        items = list(items)
+        while True:
+            waiting = False
+            for item in items:
+                if self.is_done(item):
+                    continue
+                if self.claim(item):
+                    yield item
+                elif not self.is_done(item):
+                    waiting = True
+            if not waiting:
+                return
+            time.sleep(self.poll_interval)
+
+    ## Reduce
+
+    def status(self, items):
+        # {item : done record, 'leased', or None}
+        states = {}
+        for item in items:
+            done = read_json(self.done_path(item))
+            if done is not None:
+                states[item] = done
+            elif os.path.exists(self.lease_path(item)):
+                states[item] = 'leased'
+            else:
+                states[item] = None
+        return states
+
+    def clear(self):
+        # Remove every done, stats, and lease file
+        for fname in os.listdir(self.queue_dir):
+            os.remove(pjoin(self.queue_dir, fname))
+
+
+class Heartbeat:
+    # Renews a lease every third of the lease time while the item is worked on
+
+    def __init__(self, queue, item):
+        self.queue = queue
+        self.item = item
+        self.stop = threading.Event()
+        self.lost = None
+        self.thread = threading.Thread(target=self._beat,
+                name='Qs-lease-heartbeat', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.thread.join()
+        return False
+
+    def _beat(self):
+        interval = max(self.queue.lease_seconds / 3, 0.01)
+        while not self.stop.wait(interval):
+            try:
+                self.queue.renew(self.item)
+            except LeaseLost as error:
+                self.lost = error
+                return
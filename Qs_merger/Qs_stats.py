@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# Summary stats for the merged Qs data.
+#
+# column_stats finds the column means, sums, and nan counts a few columns at a
+# time, so the nan mask and the nan filled copy are only block sized instead
+# of frame sized (DataFrame.mean, .sum, and .isnull().sum() each make both).
+# ColumnStatsAccumulator does the same thing a block of rows at a time (used
+# by the streaming merge).
+#
+# StatsTable collects the (pkl_name, stat) rows for a run in a preallocated
+# array instead of a dict of Series.
+#
+# StatsLog is an append-only store for the summary stats. Each run writes only
+# its new rows as a small part file, so the whole stats table never has to be
+# loaded and rewritten. Reading combines the parts, with later rows replacing
+# earlier rows for the same (pkl_name, stat). Watch mode appends a part for
+# every batch, so the parts are compacted into one once there are more than
+# StatsLog.max_parts of them.
+
+import os
+import time
+from os.path import join as pjoin
+import numpy as np
+import pandas as pd
+
+stat_names = ['av', 'sum', 'nans']
+
+# Values per column block in column_stats. 2**18 float64s is 2 MiB.
+default_block_values = 2**18
+
+
+def column_stats(data, block_values=default_block_values):
+    # Returns (av, sum, nans) arrays matching DataFrame.mean, DataFrame.sum,
+    # and DataFrame.isnull().sum() for a float frame or 2D array.
+    #
+    # Pandas keeps a float frame as a (columns, rows) block and sums each 
+    # column's contiguous row of it, so do the same here to get exactly the 
+    # same floating point sums. Each column is still summed in one go, only 
+    # the columns are split into blocks.
+    values = data.to_numpy(dtype=np.float64) if isinstance(data, pd.DataFrame) \
+            else np.asarray(data, dtype=np.float64)
+    values_T = values.T
+    n_cols, n_rows = values_T.shape
+    block_cols = max(1, block_values // max(n_rows, 1))
+
+    sums = np.zeros(n_cols)
+    nans = np.zeros(n_cols, dtype=np.int64)
+    for start in range(0, n_cols, block_cols):
+        block = np.ascontiguousarray(values_T[start:start + block_cols])
+        is_nan = np.isnan(block)
+        nans[start:start + block_cols] = is_nan.sum(axis=1)
+        sums[start:start + block_cols] = \
+                np.where(is_nan, 0.0, block).sum(axis=1)
+    counts = n_rows - nans
+    with np.errstate(invalid='ignore', divide='ignore'):
+        av = np.where(counts > 0, sums / counts, np.nan)
+    return av, sums, nans
+
+
+class ColumnStatsAccumulator:
+    # Accumulates column sums and nan counts block by block
+
+    def __init__(self, n_cols):
+        self.sums = np.zeros(n_cols)
+        self.counts = np.zeros(n_cols, dtype=np.int64)
+        self.nans = np.zeros(n_cols, dtype=np.int64)
+
+    def add(self, values):
+        # values is a 2D (rows, columns) block
+        is_nan = np.isnan(values)
+        nans = is_nan.sum(axis=0)
+        self.nans += nans
+        self.counts += values.shape[0] - nans
+        self.sums += np.where(is_nan, 0.0, values).sum(axis=0)
+
+    def get_stats(self):
+        # Returns (av, sum, nans)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            av = np.where(self.counts > 0, self.sums / self.counts, np.nan)
+        return av, self.sums.copy(), self.nans.copy()
+
+
+class StatsTable:
+    # Array backed table of summary stat rows keyed by (pkl_name, stat)
+
+    def __init__(self, columns=None, capacity=64):
+        self.columns = None if columns is None else list(columns)
+        self.keys = []
+        self.key_rows = {}
+        self.values = None
+        self.capacity = capacity
+
+    def __len__(self):
+        return len(self.keys)
+
+    def is_empty(self):
+        return len(self.keys) == 0
+
+    def add(self, key, row, columns=None):
+        # row is a Series (indexed by column) or a 1D array in column order.
+        # Adding an existing key replaces its row.
+        if isinstance(row, pd.Series):
+            columns, row = row.index, row.to_numpy(dtype=np.float64)
+        if self.columns is None:
+            if columns is None:
+                raise ValueError("StatsTable needs column names")
+            self.columns = list(columns)
+            self.values = np.empty((self.capacity, len(self.columns)))
+
+        if key in self.key_rows:
+            self.values[self.key_rows[key]] = row
+            return
+
+        n_rows = len(self.keys)
+        if n_rows == self.values.shape[0]:
+            # Grow by doubling
+            grown = np.empty((2 * n_rows, len(self.columns)))
+            grown[:n_rows] = self.values
+            self.values = grown
+        self.values[n_rows] = row
+        self.key_rows[key] = n_rows
+        self.keys.append(key)
+
+    def add_period(self, pkl_name, av, sums, nans, columns=None):
+        for stat, row in zip(stat_names, [av, sums, nans]):
+            self.add((pkl_name, stat), row, columns)
+
+    def extend(self, other):
+        for key, row in other.items():
+            self.add(key, row, other.columns)
+
+    def items(self):
+        for i, key in enumerate(self.keys):
+            yield key, self.values[i]
+
+    def to_frame(self):
+        # Same layout as pd.DataFrame.from_dict(stats_dict, orient='index')
+        if self.is_empty():
+            return pd.DataFrame()
+        index = pd.MultiIndex.from_tuples(self.keys)
+        return pd.DataFrame(self.values[:len(self.keys)].copy(), index=index,
+                columns=self.columns)
+
+    def __getstate__(self):
+        # Only send the used rows between processes
+        state = self.__dict__.copy()
+        if self.values is not None:
+            state['values'] = self.values[:max(len(self.keys), 1)].copy()
+        return state
+
+
+class StatsLog:
+    # Append-only summary stats store. A directory of small pickled frames.
+
+    part_prefix = 'part-'
+    part_extension = '.pkl'
+
+    # More parts than this are compacted by compact_if_needed
+    max_parts = 16
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def part_paths(self):
+        return [pjoin(self.directory, f) for f in sorted(os.listdir(self.directory))
+                if f.startswith(self.part_prefix) and f.endswith(self.part_extension)]
+
+    def append(self, stats_frame):
+        # Write new rows as a new part. The name sorts by time so later parts
+        # win, and includes the pid so concurrent runs don't collide.
+        name = f"{self.part_prefix}{time.time_ns():020d}-{os.getpid()}"
+        path = pjoin(self.directory, f"{name}{self.part_extension}")
+        tmp_path = f"{path}.tmp"
+        stats_frame.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def load(self):
+        parts = [pd.read_pickle(path) for path in self.part_paths()]
+        if not parts:
+            return pd.DataFrame()
+        stats = pd.concat(parts)
+        return stats[~stats.index.duplicated(keep='last')]
+
+    def drop_periods(self, pkl_names):
+        # Remove every row of these periods by rewriting the log as one part.
+        # Returns whether there were any.
+        old_paths = self.part_paths()
+        stats = self.load()
+        if stats.empty:
+            return False
+        is_dropped = stats.index.get_level_values(0).isin(pkl_names)
+        if not is_dropped.any():
+            return False
+        self.append(stats[~is_dropped])
+        for path in old_paths:
+            os.remove(path)
+        return True
+
+    def compact(self):
+        # Combine all the parts into one
+        old_paths = self.part_paths()
+        if len(old_paths) <= 1:
+            return
+        stats = self.load()
+        self.append(stats)
+        for path in old_paths:
+            os.remove(path)
+
+    def compact_if_needed(self):
+        # Compact if there are too many parts. Returns whether it did.
+        if len(self.part_paths()) <= self.max_parts:
+            return False
+        self.compact()
+        return True
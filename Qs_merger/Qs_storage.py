@@ -0,0 +1,651 @@
+#!/usr/bin/env python3
+
+# Storage backends for the raw Qs# frames and the merged Qs frames.
+#
+# Pickles are the default. They are simple, but reading one column across all
+# the periods means unpickling every full frame. The columnar stores save each
+# column separately so a subset of columns can be read without touching the
+# rest, and the columns can be memory mapped instead of read into memory.
+#
+# Formats:
+#   'pickle'  : Whole dataframe pickles through the helpyr DataLoader
+#   'npy'     : A directory per frame with one .npy file per column and a json
+#               header. No extra dependencies.
+#   'feather' : Uncompressed Arrow/Feather files. Needs pyarrow.
+#   'mmap'    : One file per frame: a small json header with the column names,
+#               dtypes, and offsets, then each column's raw bytes one after
+#               another. Opened as read only memory maps, so loading reads
+#               nothing until the data is used. A float64 frame's columns are
+#               back to back, which is exactly a column major 2D array, so the
+#               whole frame is one zero copy view (to_numpy gives the mapped
+#               array itself). Processes reading the same file share the
+#               pages in the OS page cache. No extra dependencies.
+#
+# The metastore stores full paths, so frames are loaded by path and the format
+# is found from the file extension. A metastore can point at a mix of formats
+# (eg. halfway through a migration).
+#
+# Migrating existing pickle trees:
+#   python Qs_storage.py --to npy [--delete]
+# Pickles that are hard links of each other (see link_frame) are converted
+# once and stay linked. The metastore and the build manifest are pointed at
+# the new files, so the migration doesn't make every period rebuild.
+
+import argparse
+import json
+import os
+import shutil
+from os.path import join as pjoin
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather as pa_feather
+except ImportError:
+    pa = None
+
+
+storage_formats = ['pickle', 'npy', 'feather', 'mmap']
+pickle_extension = '.pkl'
+npy_extension = '.npyd'
+feather_extension = '.feather'
+mmap_extension = '.qsmap'
+
+
+class PickleStore:
+    # Whole dataframe pickles. Goes through the helpyr DataLoader so the
+    # pickles are exactly the same as before.
+    format_name = 'pickle'
+    extension = pickle_extension
+
+    def __init__(self, directory, loader):
+        self.directory = directory
+        self.loader = loader
+
+    def path(self, name):
+        return pjoin(self.directory, f"{name}{self.extension}")
+
+    def is_stored(self, name):
+        return self.loader.is_pickled(name)
+
+    def save(self, name, data, overwrite=False):
+        # Returns a list of paths like DataLoader.produce_pickles
+        return self.loader.produce_pickles({name : data}, overwrite=overwrite)
+
+    def load(self, path, columns=None, mmap=False):
+        # Pickles can't be memory mapped. Columns are selected after loading
+        # the full frame.
+        data = self.loader.load_pickle(path, add_path=False)
+        return data if columns is None else data.loc[:, columns]
+
+
+class NpyStore:
+    # One directory per frame:
+    #   header.json : column names, dtypes, number of rows, index type
+    #   c###.npy    : one array per column
+    #   c###.mask.npy : missing value mask of nullable int columns (compact
+    #                 dtypes, see Qs_dtypes.py)
+    #   index.npy   : only if the index is not a default RangeIndex
+    format_name = 'npy'
+    extension = npy_extension
+    header_name = 'header.json'
+
+    def __init__(self, directory, logger=None):
+        self.directory = directory
+        self.logger = logger
+
+    def path(self, name):
+        return pjoin(self.directory, f"{name}{self.extension}")
+
+    def is_stored(self, name):
+        return os.path.isfile(pjoin(self.path(name), self.header_name))
+
+    def save(self, name, data, overwrite=False):
+        path = self.path(name)
+        if self.is_stored(name) and not overwrite:
+            self._write_log(f"{name} is already stored. Not overwriting.")
+            return []
+
+        self._write_log(f"Saving {name} to {path}")
+        write_npy_frame(path, data)
+        return [path]
+
+    @staticmethod
+    def load(path, columns=None, mmap=False):
+        return read_npy_frame(path, columns, mmap)
+
+    def _write_log(self, msg):
+        if self.logger is not None:
+            self.logger.write(msg)
+
+
+class FeatherStore:
+    # Uncompressed feather files so they can be memory mapped
+    format_name = 'feather'
+    extension = feather_extension
+
+    def __init__(self, directory, logger=None):
+        if pa is None:
+            raise ImportError("The feather storage format needs pyarrow")
+        self.directory = directory
+        self.logger = logger
+
+    def path(self, name):
+        return pjoin(self.directory, f"{name}{self.extension}")
+
+    def is_stored(self, name):
+        return os.path.isfile(self.path(name))
+
+    def save(self, name, data, overwrite=False):
+        path = self.path(name)
+        if self.is_stored(name) and not overwrite:
+            self._write_log(f"{name} is already stored. Not overwriting.")
+            return []
+
+        self._write_log(f"Saving {name} to {path}")
+        tmp_path = f"{path}.tmp"
+        pa_feather.write_feather(data, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+        return [path]
+
+    @staticmethod
+    def load(path, columns=None, mmap=False):
+        table = pa_feather.read_table(path, columns=columns, memory_map=mmap)
+        # Converts a column at a time, freeing each Arrow column once it is 
+        # converted, instead of holding both copies of the whole frame
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+
+    def _write_log(self, msg):
+        if self.logger is not None:
+            self.logger.write(msg)
+
+
+class MmapStore:
+    # One memory mappable file per frame. See write_mmap_frame for the layout.
+    format_name = 'mmap'
+    extension = mmap_extension
+
+    def __init__(self, directory, logger=None):
+        self.directory = directory
+        self.logger = logger
+
+    def path(self, name):
+        return pjoin(self.directory, f"{name}{self.extension}")
+
+    def is_stored(self, name):
+        return os.path.isfile(self.path(name))
+
+    def save(self, name, data, overwrite=False):
+        path = self.path(name)
+        if self.is_stored(name) and not overwrite:
+            self._write_log(f"{name} is already stored. Not overwriting.")
+            return []
+
+        self._write_log(f"Saving {name} to {path}")
+        write_mmap_frame(path, data)
+        return [path]
+
+    @staticmethod
+    def load(path, columns=None, mmap=False):
+        return read_mmap_frame(path, columns, mmap)
+
+    def _write_log(self, msg):
+        if self.logger is not None:
+            self.logger.write(msg)
+
+
+def make_store(storage_format, directory, loader, logger=None):
+    # loader is the helpyr DataLoader whose destination is directory
+    if storage_format == 'pickle':
+        return PickleStore(directory, loader)
+    elif storage_format == 'npy':
+        return NpyStore(directory, logger)
+    elif storage_format == 'feather':
+        return FeatherStore(directory, logger)
+    elif storage_format == 'mmap':
+        return MmapStore(directory, logger)
+    else:
+        raise ValueError(f"Unknown storage format {storage_format}. " +
+                         f"Choose from {storage_formats}")
+
+def path_format(path):
+    # Find the storage format of a stored frame from its path
+    if path.endswith(npy_extension):
+        return 'npy'
+    elif path.endswith(feather_extension):
+        return 'feather'
+    elif path.endswith(mmap_extension):
+        return 'mmap'
+    else:
+        return 'pickle'
+
+def load_frame(path, loader, columns=None, mmap=False):
+    # Load a stored frame of any format. loader is only used for pickles. 
+    # Without a loader, pickles are read with pandas.
+    storage_format = path_format(path)
+    if storage_format == 'npy':
+        return NpyStore.load(path, columns, mmap)
+    elif storage_format == 'feather':
+        return FeatherStore.load(path, columns, mmap)
+    elif storage_format == 'mmap':
+        return MmapStore.load(path, columns, mmap)
+    else:
+        if loader is None:
+            data = pd.read_pickle(path)
+        else:
+            data = loader.load_pickle(path, add_path=False)
+        return data if columns is None else data.loc[:, columns]
+
+
+def write_npy_frame(path, data):
+    # Write into a temporary directory first so a crash never leaves a half
+    # written frame that looks complete.
+    tmp_path = f"{path}.tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    index = data.index
+    is_range_index = (isinstance(index, pd.RangeIndex)
+                      and index.start == 0 and index.step == 1)
+    header = {
+            'columns' : [str(c) for c in data.columns],
+            'dtypes'  : [str(data[c].dtype) for c in data.columns],
+            'n_rows'  : len(data),
+            'index'   : 'range' if is_range_index else 'index.npy',
+            'files'   : [f"c{i:03d}.npy" for i in range(len(data.columns))],
+            }
+
+    for column, fname in zip(data.columns, header['files']):
+        save_npy_column(pjoin(tmp_path, fname), data[column].array)
+    if not is_range_index:
+        np.save(pjoin(tmp_path, 'index.npy'), index.to_numpy())
+
+    with open(pjoin(tmp_path, NpyStore.header_name), 'w') as header_file:
+        json.dump(header, header_file, indent=1)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+def mask_path(path):
+    # c###.npy -> c###.mask.npy
+    return f"{path[:-len('.npy')]}.mask.npy"
+
+def save_npy_column(path, array):
+    # Nullable int columns are saved as the values and a separate mask
+    if isinstance(array, pd.arrays.IntegerArray):
+        np.save(path, array.to_numpy(dtype=array.dtype.numpy_dtype,
+                na_value=0))
+        np.save(mask_path(path), array.isna())
+    else:
+        np.save(path, np.asarray(array))
+
+def load_npy_column(path, dtype, mmap_mode=None):
+    values = np.load(path, mmap_mode=mmap_mode)
+    if dtype in ['UInt16', 'Int32']:
+        # IntegerArray needs writeable arrays, so these are read in full
+        mask = np.load(mask_path(path))
+        return pd.arrays.IntegerArray(np.array(values), mask)
+    return values
+
+class NpyFrameWriter:
+    # Writes an npy store frame one block of rows at a time. The column files
+    # are preallocated as memory mapped arrays, so the whole frame never has
+    # to be in memory. Used by the streaming merge. dtypes (a list of numpy or
+    # compact dtype names) defaults to float64 for every column.
+
+    def __init__(self, path, columns, n_rows, dtypes=None):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        if os.path.isdir(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        if dtypes is None:
+            dtypes = ['float64'] * len(columns)
+        self.header = {
+                'columns' : [str(c) for c in columns],
+                'dtypes'  : [str(d) for d in dtypes],
+                'n_rows'  : n_rows,
+                'index'   : 'range',
+                'files'   : [f"c{i:03d}.npy" for i in range(len(columns))],
+                }
+
+        self.arrays = []
+        self.masks = []
+        for fname, dtype in zip(self.header['files'], self.header['dtypes']):
+            fpath = pjoin(self.tmp_path, fname)
+            is_nullable = dtype in ['UInt16', 'Int32']
+            self.arrays.append(np.lib.format.open_memmap(fpath, mode='w+',
+                    dtype=dtype.lower() if is_nullable else dtype,
+                    shape=(n_rows,)))
+            self.masks.append(np.lib.format.open_memmap(mask_path(fpath),
+                    mode='w+', dtype=bool, shape=(n_rows,))
+                    if is_nullable else None)
+
+    def write_block(self, start, block):
+        values = block.to_numpy(dtype=np.float64, copy=False, na_value=np.nan)
+        stop = start + values.shape[0]
+        for i, (array, mask) in enumerate(zip(self.arrays, self.masks)):
+            if mask is None:
+                array[start:stop] = values[:, i]
+            else:
+                is_nan = np.isnan(values[:, i])
+                mask[start:stop] = is_nan
+                array[start:stop] = np.where(is_nan, 0, values[:, i])
+
+    def close(self):
+        for array in self.arrays + self.masks:
+            if array is not None:
+                array.flush()
+        self.arrays = []
+        self.masks = []
+
+        with open(pjoin(self.tmp_path, NpyStore.header_name), 'w') as header_file:
+            json.dump(self.header, header_file, indent=1)
+
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+def read_npy_header(path):
+    with open(pjoin(path, NpyStore.header_name), 'r') as header_file:
+        return json.load(header_file)
+
+def read_npy_frame(path, columns=None, mmap=False):
+    # Read all or some of the columns. With mmap=True the columns are read only
+    # views of the files, so nothing is read until it is used.
+    header = read_npy_header(path)
+    file_map = dict(zip(header['columns'], header['files']))
+    if columns is None:
+        columns = header['columns']
+
+    dtype_map = dict(zip(header['columns'], header['dtypes']))
+    mmap_mode = 'r' if mmap else None
+    arrays = {}
+    for column in columns:
+        arrays[column] = load_npy_column(pjoin(path, file_map[column]),
+                dtype_map[column], mmap_mode)
+
+    if header['index'] == 'range':
+        index = pd.RangeIndex(header['n_rows'])
+    else:
+        index = pd.Index(np.load(pjoin(path, header['index'])))
+
+    # copy=False keeps the (possibly memory mapped) arrays as they are
+    return pd.DataFrame(arrays, index=index, columns=columns, copy=False)
+
+
+# mmap format layout:
+#   magic (8 bytes), data start and header length (little endian uint64s),
+#   json header, padding up to the data start (a multiple of 64 bytes), then
+#   each column's values (and the mask of nullable int columns), each padded
+#   to 8 bytes. The header has the column names, dtypes, number of rows, and
+#   the byte offset of every array from the data start. A non default index
+#   is stored the same way as one more array.
+mmap_magic = b'QSMAP001'
+_mmap_preamble = np.dtype([('magic', 'S8'), ('data_start', '<u8'),
+                           ('header_len', '<u8')])
+_mmap_alignment = 64
+
+def _pad(n_bytes, alignment=8):
+    return -n_bytes % alignment
+
+def write_mmap_frame(path, data):
+    index = data.index
+    is_range_index = (isinstance(index, pd.RangeIndex)
+                      and index.start == 0 and index.step == 1)
+    if not is_range_index and index.dtype.kind not in 'fiub':
+        raise ValueError("The mmap storage format needs a numeric index")
+
+    # Lay out the arrays
+    arrays = []
+    offsets = []
+    masks = []
+    position = 0
+    def add_array(values):
+        nonlocal position
+        values = np.ascontiguousarray(values)
+        arrays.append(values)
+        offset = position
+        position += values.nbytes + _pad(values.nbytes)
+        return offset
+
+    for column in data.columns:
+        array = data[column].array
+        if isinstance(array, pd.arrays.IntegerArray):
+            offsets.append(add_array(array.to_numpy(
+                    dtype=array.dtype.numpy_dtype, na_value=0)))
+            masks.append(add_array(array.isna()))
+        else:
+            offsets.append(add_array(np.asarray(array)))
+            masks.append(None)
+    index_offset = None if is_range_index else add_array(index.to_numpy())
+
+    header = json.dumps({
+            'columns' : [str(c) for c in data.columns],
+            'dtypes'  : [str(data[c].dtype) for c in data.columns],
+            'n_rows'  : len(data),
+            'offsets' : offsets,
+            'masks'   : masks,
+            'index'   : 'range' if is_range_index else
+                        {'dtype' : str(index.dtype), 'offset' : index_offset},
+            }).encode()
+    header_end = _mmap_preamble.itemsize + len(header)
+    data_start = header_end + _pad(header_end, _mmap_alignment)
+    preamble = np.array([(mmap_magic, data_start, len(header))],
+            dtype=_mmap_preamble)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as mmap_file:
+        mmap_file.write(preamble.tobytes())
+        mmap_file.write(header)
+        mmap_file.write(bytes(data_start - header_end))
+        for values in arrays:
+            mmap_file.write(values.data if values.size else b'')
+            mmap_file.write(bytes(_pad(values.nbytes)))
+    os.replace(tmp_path, path)
+
+def read_mmap_header(path):
+    # Returns (header, data start)
+    with open(path, 'rb') as mmap_file:
+        preamble = np.frombuffer(mmap_file.read(_mmap_preamble.itemsize),
+                dtype=_mmap_preamble)[0]
+        if preamble['magic'] != mmap_magic:
+            raise ValueError(f"{path} is not an mmap format frame")
+        header = json.loads(mmap_file.read(int(preamble['header_len'])))
+    return header, int(preamble['data_start'])
+
+def read_mmap_frame(path, columns=None, mmap=True):
+    # With mmap=True every column is a read only view of the file. Otherwise
+    # the file is read into memory.
+    header, data_start = read_mmap_header(path)
+    if mmap:
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+        buffer = np.fromfile(path, dtype=np.uint8)
+    n_rows = header['n_rows']
+
+    def get_array(offset, dtype):
+        dtype = np.dtype(dtype)
+        start = data_start + offset
+        return buffer[start:start + n_rows * dtype.itemsize].view(dtype)
+
+    if header['index'] == 'range':
+        index = pd.RangeIndex(n_rows)
+    else:
+        index = pd.Index(get_array(header['index']['offset'],
+                header['index']['dtype']))
+
+    all_columns = header['columns']
+    dtypes = header['dtypes']
+    offsets = header['offsets']
+    is_float_block = all(d == 'float64' for d in dtypes) and all(
+            offsets[i] == i * n_rows * 8 for i in range(len(offsets)))
+    if columns is None and is_float_block:
+        # The columns are back to back, so the whole frame is one column
+        # major 2D view
+        n_bytes = n_rows * len(all_columns) * 8
+        values = buffer[data_start:data_start + n_bytes].view(np.float64)
+        values = values.reshape((n_rows, len(all_columns)), order='F')
+        return pd.DataFrame(values, index=index, columns=all_columns,
+                copy=False)
+
+    if columns is None:
+        columns = all_columns
+    positions = {c : i for i, c in enumerate(all_columns)}
+    arrays = {}
+    for column in columns:
+        i = positions[column]
+        dtype = dtypes[i]
+        if header['masks'][i] is not None:
+            # IntegerArray needs writeable arrays, so these are copied
+            numpy_dtype = dtype.lower()
+            arrays[column] = pd.arrays.IntegerArray(
+                    np.array(get_array(offsets[i], numpy_dtype)),
+                    np.array(get_array(header['masks'][i], bool)))
+        else:
+            arrays[column] = get_array(offsets[i], dtype)
+    return pd.DataFrame(arrays, index=index, columns=columns, copy=False)
+
+def read_shape(path):
+    # (rows, columns) of a stored npy or mmap frame without loading it
+    if path_format(path) == 'mmap':
+        header = read_mmap_header(path)[0]
+    else:
+        header = read_npy_header(path)
+    return header['n_rows'], len(header['columns'])
+
+def _link_file(src_path, dst_path):
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        # Eg. a filesystem without hard links
+        shutil.copy2(src_path, dst_path)
+
+def link_frame(src_path, dst_path):
+    # Store a frame under a second path without writing it again. The files
+    # are hard linked (copied where that isn't possible). Returns [dst_path].
+    remove_frame(dst_path)
+    if os.path.isdir(src_path):
+        tmp_path = f"{dst_path}.tmp"
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for fname in os.listdir(src_path):
+            _link_file(pjoin(src_path, fname), pjoin(tmp_path, fname))
+        os.replace(tmp_path, dst_path)
+    else:
+        _link_file(src_path, dst_path)
+    return [dst_path]
+
+def remove_frame(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def is_linked(path):
+    # True if a stored frame shares its files with another one (see
+    # link_frame). Frames have to be removed before they are overwritten, or
+    # the other frame would change too.
+    if os.path.isdir(path):
+        return any(os.stat(pjoin(path, f)).st_nlink > 1
+                   for f in os.listdir(path))
+    return os.path.isfile(path) and os.stat(path).st_nlink > 1
+
+
+def migrate_pickle_tree(storage_format, delete_pickles=False):
+    # Convert the raw and merged pickles to another storage format and point
+    # the metastore (and old metapickle) at the new files. The summary stats
+    # stay pickles.
+    import settings
+    import Qs_manifest
+    import Qs_metastore
+    from helpyr import data_loading
+    from helpyr import logger as hlp_logger
+
+    log_filepath = pjoin(settings.root_dir, 'log-files', 'QsStorage.txt')
+    logger = hlp_logger.Logger(log_filepath, default_verbose=True)
+    logger.write(f"Migrating pickles to {storage_format}")
+    logger.increase_global_indent()
+
+    skip_names = [settings.metapickle_name, settings.statspickle_name]
+    path_map = {}
+    # (device, inode) : new path of the first pickle with those files
+    migrated_files = {}
+    for directory in [settings.Qs_raw_pickles_dir,
+                      settings.Qs_merged_pickles_dir]:
+        loader = data_loading.DataLoader(directory, directory, logger)
+        store = make_store(storage_format, directory, loader, logger)
+
+        for fname in sorted(os.listdir(directory)):
+            if not fname.endswith(pickle_extension):
+                continue
+            name = fname[:-len(pickle_extension)]
+            if name in skip_names:
+                continue
+
+            old_path = pjoin(directory, fname)
+            stat = os.stat(old_path)
+            file_id = (stat.st_dev, stat.st_ino)
+            if file_id in migrated_files:
+                logger.write(f"Linking {name} to {migrated_files[file_id]}")
+                new_path = link_frame(migrated_files[file_id],
+                        store.path(name))[0]
+            else:
+                data = loader.load_pickle(old_path, add_path=False)
+                new_path = store.save(name, data, overwrite=True)[0]
+                if stat.st_nlink > 1:
+                    migrated_files[file_id] = new_path
+            path_map[old_path] = new_path
+
+    # Update the metapickle
+    raw_dir = settings.Qs_raw_pickles_dir
+    loader = data_loading.DataLoader(raw_dir, raw_dir, logger)
+    if loader.is_pickled(settings.metapickle_name):
+        logger.write(f"Updating {settings.metapickle_name}")
+        metapickle = loader.load_pickle(settings.metapickle_name,
+                use_source=False)
+        for period_path, paths in metapickle.items():
+            metapickle[period_path] = [path_map.get(p, p) for p in paths]
+        loader.produce_pickles({settings.metapickle_name : metapickle},
+                overwrite=True)
+
+    metastore_path = pjoin(raw_dir, settings.metastore_name)
+    if os.path.isfile(metastore_path):
+        logger.write(f"Updating {settings.metastore_name}")
+        metastore = Qs_metastore.MetaStore(metastore_path)
+        metastore.replace_paths(path_map)
+        metastore.close()
+
+    manifest_path = pjoin(raw_dir, settings.manifest_name)
+    if os.path.isfile(manifest_path):
+        logger.write(f"Updating {settings.manifest_name}")
+        manifest = Qs_manifest.BuildManifest(manifest_path)
+        manifest.replace_paths(path_map)
+        manifest.save()
+
+    if delete_pickles:
+        logger.write(f"Deleting {len(path_map)} migrated pickles")
+        for old_path in path_map:
+            os.remove(old_path)
+
+    logger.decrease_global_indent()
+    logger.write(f"Migrated {len(path_map)} pickles")
+    logger.end_output()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Convert raw and merged Qs pickles to another format")
+    parser.add_argument('--to', dest='storage_format', required=True,
+            choices=[f for f in storage_formats if f != 'pickle'])
+    parser.add_argument('--delete', action='store_true',
+            help="Delete the pickles after converting them")
+    args = parser.parse_args()
+
+    migrate_pickle_tree(args.storage_format, args.delete)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Streaming merge for periods that are too big to hold in memory.
+#
+# The normal merge loads every Qs# frame for a period, builds a full size
+# combined copy, and then makes several full size boolean frames for the
+# difference check. Here the raw frames are memory mapped (npy store) and the
+# period is processed in blocks of rows. Every step of the merge only looks at
+# one row at a time (chunk coverage, difference check, nan rows, cutoff
+# trimming, stats), so each block is combined, checked, cleaned, and written
+# out before the next block is read. Memory use depends on the block size
+# rather than the period length.
+#
+# Only the small results are kept for the whole period: row counts, the
+# differing columns, a capped number of differing rows, the trimmed values,
+# the overlapped timestamps, and the column sums/counts for the stats.
+
+import numpy as np
+import pandas as pd
+
+import Qs_clean
+import Qs_combine
+import Qs_diff
+import Qs_dtypes
+from Qs_stats import ColumnStatsAccumulator
+
+
+class StreamingMerge:
+
+    def __init__(self, Qs0_data, Qsn_data, block_rows, cutoffs,
+            max_diff_rows=1000):
+        # Qs0_data is the Qs.txt frame or None. Qsn_data is the list of Qs#
+        # frames. Both are normally memory mapped. cutoffs is {column : max}
+        # or just the 'Bedload all' cutoff (see Qs_clean.py).
+        self.Qs0_data = Qs0_data
+        self.Qsn_data = Qsn_data
+        self.block_rows = block_rows
+        self.cutoffs = Qs_clean.make_cutoffs(cutoffs)
+        self.max_diff_rows = max_diff_rows
+
+        like = Qsn_data[0] if Qsn_data else Qs0_data
+        self.columns = like.columns
+        self.n_rows = like.shape[0]
+        self.has_raw = Qs0_data is not None
+        self.has_combined = bool(Qsn_data)
+        # Blocks are merged as float64 and written out in the dtypes of the
+        # final frame's sources (see Qs_dtypes.py)
+        sources = Qsn_data if self.has_combined else [Qs0_data]
+        self.dtypes = Qs_dtypes.align_dtypes(
+                [s.iloc[:0] for s in sources])[0].dtypes
+
+    @staticmethod
+    def can_stream(Qs0_shape, Qsn_shapes):
+        # Every frame needs the same rows and columns so blocks line up
+        shapes = ([Qs0_shape] if Qs0_shape is not None else []) + Qsn_shapes
+        return len(shapes) > 0 and all(s == shapes[0] for s in shapes)
+
+    def run(self, block_writers=[]):
+        # block_writers are functions taking (start_row, final block df). They
+        # are called in row order.
+        columns = self.columns
+        n_cols = len(columns)
+        cutoff_idx, bedload_idx, first_idx = Qs_clean.column_indices(
+                columns, self.cutoffs)
+        exclude_idx = [columns.get_loc(c) for c in Qs_diff.diff_exclude_cols]
+        target_idx = [columns.get_loc(c)
+                      for c in Qs_combine.get_target_cols(columns)]
+
+        # Whole period results
+        self.overlap_count = 0
+        self.overlap_times = []
+        self.diff_rows_count = 0
+        self.diff_cols = np.zeros(n_cols, dtype=bool)
+        self.diff_raw_rows = []
+        self.diff_combined_rows = []
+        self.diff_row_labels = []
+        self.cleaning = Qs_clean.CleaningResult(self.cutoffs)
+        self.stats = ColumnStatsAccumulator(n_cols)
+
+        for start in range(0, self.n_rows, self.block_rows):
+            stop = min(start + self.block_rows, self.n_rows)
+            index = self._block_index(start, stop)
+
+            # Combine the chunks for this block
+            combined = None
+            if self.has_combined:
+                chunk_blocks = [c.iloc[start:stop].to_numpy(dtype=np.float64)
+                                for c in self.Qsn_data]
+                combined, overlap = Qs_combine.combine_chunk_arrays(
+                        chunk_blocks, target_idx)
+                self.overlap_count += int(overlap.sum())
+                self.overlap_times.append(pd.Series(combined[overlap, 0],
+                        index=index[overlap], name='timestamp'))
+
+            raw = None
+            if self.has_raw:
+                raw = self.Qs0_data.iloc[start:stop].to_numpy(
+                        dtype=np.float64, copy=True)
+
+            if self.has_raw and self.has_combined:
+                self._diff_block(raw, combined, index, exclude_idx)
+
+            # Combined data is used whenever it exists
+            final = combined if self.has_combined else raw
+            Qs_clean.clean_block(final, self.cleaning, cutoff_idx,
+                    bedload_idx, first_idx)
+            self.stats.add(final)
+
+            final_df = pd.DataFrame(final, columns=columns, index=index,
+                    copy=False)
+            final_df = Qs_dtypes.restore_dtypes(final_df, self.dtypes)
+            for write_block in block_writers:
+                write_block(start, final_df)
+
+        self.overlap_times = pd.concat(self.overlap_times) \
+                if self.overlap_times else pd.Series([], dtype=np.float64)
+
+    def _block_index(self, start, stop):
+        like = self.Qsn_data[0] if self.has_combined else self.Qs0_data
+        return like.index[start:stop]
+
+    def _diff_block(self, raw, combined, index, exclude_idx):
+        # Same rules as QsPickleProcessor._difference_check, one block at a
+        # time. See Qs_diff.py
+        diff = Qs_diff.diff_arrays(raw, combined, exclude_idx,
+                block_rows=raw.shape[0])
+        if not diff.any():
+            return
+        self.diff_rows_count += diff.n_diff_rows
+        self.diff_cols |= diff.diff_cols
+
+        # Keep a limited number of differing rows for the log
+        room = self.max_diff_rows - len(self.diff_row_labels)
+        if room > 0:
+            rows = diff.row_indices(room)
+            self.diff_raw_rows.append(raw[rows])
+            self.diff_combined_rows.append(combined[rows])
+            self.diff_row_labels.extend(index[rows])
+
+    def get_trim_vals(self):
+        return self.cleaning.get_trim_vals()
+
+    def get_diff_frames(self):
+        # Returns the logged differing rows of (raw, combined) limited to the
+        # columns that differ anywhere in the period
+        columns = self.columns[self.diff_cols]
+        frames = []
+        for rows in [self.diff_raw_rows, self.diff_combined_rows]:
+            values = np.concatenate(rows)[:, self.diff_cols]
+            frames.append(pd.DataFrame(values, columns=columns,
+                    index=self.diff_row_labels))
+        return frames
+
+    def get_stats(self):
+        # Same as mean/sum/isnull().sum() over the whole final output (up to 
+        # floating point summation order). Returns {stat : Series}
+        av, sums, nans = self.stats.get_stats()
+        return {'av'   : pd.Series(av, index=self.columns),
+                'sum'  : pd.Series(sums, index=self.columns),
+                'nans' : pd.Series(nans, index=self.columns),
+                }
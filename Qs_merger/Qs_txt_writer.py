@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+# Fast txt writer for the merged Qs frames and the summary stats.
+#
+# DataLoader.save_txt uses DataFrame.to_csv, which formats every float one at a
+# time. The Qs data almost always has at most 3 decimals, so here floats are
+# formatted in bulk instead: a value v that equals round(v, 3) exactly is
+# written as its integer part plus a lookup table of the 1000 possible
+# decimal endings. That is exactly what to_csv (the shortest round trip repr)
+# writes for those values. Anything else (more decimals, huge values, inf) is
+# formatted the same way to_csv does it, one value at a time. So with the
+# default settings the output is byte for byte the same as today's files.
+# Lines end with os.linesep, like to_csv writing to a path.
+#
+# Options:
+#   precision   : None for the same output as to_csv. An int writes every
+#                 float with that many decimals (like float_format='%.3f').
+#   compression : None, 'gzip', or 'zstd' (needs the zstandard package). The
+#                 file extension (.gz or .zst) is added to the path.
+#   compress_level : None for the defaults below. gzip's own default (9) is
+#                 several times slower than 6 for a slightly smaller file.
+#   block_rows  : rows formatted and written at a time
+#
+# Frames with columns or indexes that aren't numbers (other than a MultiIndex
+# of strings, like the summary stats) are passed to to_csv unchanged. Compact
+# frames (float32 and nullable int columns, see Qs_dtypes.py) are written the
+# way to_csv writes them too: float32 values with the shortest float32 repr
+# and missing counts as empty fields.
+
+import gzip
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compressions = [None, 'gzip', 'zstd']
+compression_extensions = {None : '', 'gzip' : '.gz', 'zstd' : '.zst'}
+default_compress_levels = {'gzip' : 6, 'zstd' : 3}
+
+# Floats bigger than this fall back to the slow path. Below it, the spacing
+# between doubles is smaller than 0.001 so a 3 decimal string is the
+# shortest repr.
+_max_fast_value = 2.0**40
+# Same for float32
+_max_fast_single = 2.0**13
+_n_decimals = 3
+_scale = 10**_n_decimals
+
+# b'.5', b'.25', b'.125', ... for every possible 3 decimal ending. b'.0' for 0.
+_endings = np.array([b'.0'] + [(f".{i:03d}").rstrip('0').encode()
+                               for i in range(1, _scale)])
+
+_zero = ord('0')
+
+
+def quote_fields(values, sep=','):
+    # csv.QUOTE_MINIMAL quoting for an array of strings
+    values = np.asarray(values, dtype=str)
+    needs_quotes = np.zeros(values.shape, dtype=bool)
+    for special in [sep, '"', '\n', '\r']:
+        needs_quotes |= np.char.find(values, special) >= 0
+    if needs_quotes.any():
+        values = values.astype(object)
+        for i in np.flatnonzero(needs_quotes):
+            values[i] = '"' + values[i].replace('"', '""') + '"'
+        values = values.astype(str)
+    return values
+
+
+# The text of a block of rows is built from segments. Each segment is a uint8
+# byte matrix with one row per value. Unused bytes are 0 (NUL), which never
+# shows up in the text. All the segments and separators are stacked side by
+# side and the NUL bytes are dropped, which leaves the rows of text one after
+# another. This is a handful of numpy operations per column instead of
+# formatting and joining strings one value at a time.
+
+def bytes_segment(strings):
+    # Segment from an array of byte strings. Numpy pads them with NULs.
+    strings = np.asarray(strings, dtype=bytes)
+    width = max(strings.dtype.itemsize, 1)
+    return np.frombuffer(strings.astype(f'S{width}').tobytes(),
+            dtype=np.uint8).reshape(len(strings), width)
+
+def digits_segment(values, include):
+    # Segment for the decimal digits of non-negative ints. Values where
+    # include is False are left out.
+    values = np.where(include, values, 0)
+    n_digits = len(str(int(values.max()))) if len(values) else 1
+    powers = 10**np.arange(n_digits - 1, -1, -1, dtype=np.int64)
+    digits = (values[:, None] // powers) % 10 + _zero
+    # Drop leading zeros, but keep the last digit so 0 is written as '0'
+    is_used = values[:, None] >= powers
+    is_used[:, -1] = True
+    is_used &= include[:, None]
+    return np.where(is_used, digits, 0).astype(np.uint8)
+
+def sign_segment(is_negative):
+    return np.where(is_negative, ord('-'), 0).astype(np.uint8)[:, None]
+
+def float_segments(values, precision=None, na_rep=''):
+    # Segments for a 1D float array, formatted like to_csv. float32 arrays
+    # are formatted like float32 values.
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        values = values.astype(np.float64, copy=False)
+    is_single = values.dtype == np.float32
+    wide = values.astype(np.float64)
+    is_nan = np.isnan(wide)
+
+    if precision is None:
+        max_fast = _max_fast_single if is_single else _max_fast_value
+        with np.errstate(invalid='ignore', over='ignore'):
+            scaled = np.round(wide * _scale)
+            is_fast = (np.abs(wide) < max_fast) & \
+                    ((scaled / _scale).astype(values.dtype) == values)
+        scale = _scale
+    else:
+        # '%.{precision}f' rounds the exact binary value. Values too close to
+        # a rounding tie to be sure of np.round go the slow way.
+        scale = 10**precision
+        with np.errstate(invalid='ignore', over='ignore'):
+            shifted = np.abs(wide) * scale
+            scaled = np.round(wide * scale)
+            frac = shifted - np.floor(shifted)
+            is_fast = (np.abs(wide) < _max_fast_value / scale) & \
+                    (np.abs(frac - 0.5) > 1e-6)
+
+    int_abs = np.where(is_fast, np.abs(scaled), 0).astype(np.int64)
+    whole = int_abs // scale
+    part = int_abs % scale
+
+    segments = []
+    # -0.0 is written as '-0.0' like repr
+    is_negative = is_fast & np.signbit(values)
+    if is_negative.any():
+        segments.append(sign_segment(is_negative))
+    segments.append(digits_segment(whole, is_fast))
+    if precision is None:
+        endings = np.where(is_fast, _endings[part], b'')
+        segments.append(bytes_segment(endings))
+    elif precision > 0:
+        point = np.where(is_fast, ord('.'), 0)[:, None]
+        powers = 10**np.arange(precision - 1, -1, -1, dtype=np.int64)
+        digits = (part[:, None] // powers) % 10 + _zero
+        digits = np.where(is_fast[:, None], digits, 0)
+        segments.append(np.hstack([point, digits]).astype(np.uint8))
+
+    # Everything else, one value at a time
+    is_slow = ~is_fast & ~is_nan
+    if is_slow.any() or (is_nan.any() and na_rep):
+        other = np.full(len(values), b'', dtype=object)
+        slow = values[is_slow]
+        if precision is None:
+            # Same as to_csv without a float_format
+            other[is_slow] = np.char.encode(slow.astype(str))
+        else:
+            other[is_slow] = [f"{v:.{precision}f}".encode() for v in slow]
+        other[is_nan] = na_rep.encode()
+        segments.append(bytes_segment(other.astype(bytes)))
+    return segments
+
+def int_segments(values, include=None, na_rep=''):
+    # include is False for missing values (nullable int columns)
+    values = np.asarray(values, dtype=np.int64)
+    if include is None:
+        include = np.ones(len(values), dtype=bool)
+    segments = [digits_segment(np.abs(values), include)]
+    is_negative = include & (values < 0)
+    if is_negative.any():
+        segments.insert(0, sign_segment(is_negative))
+    if na_rep and not include.all():
+        segments.append(bytes_segment(np.where(include, b'', na_rep.encode())))
+    return segments
+
+def column_segments(values, precision=None, na_rep='', sep=','):
+    if isinstance(values, pd.arrays.IntegerArray):
+        is_na = values.isna()
+        return int_segments(values.to_numpy(dtype=np.int64, na_value=0),
+                ~is_na, na_rep)
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        return float_segments(values, precision, na_rep)
+    elif values.dtype.kind in 'iu':
+        return int_segments(values)
+    strings = quote_fields(values.astype(str), sep)
+    return [bytes_segment(np.char.encode(strings, 'utf-8'))]
+
+def join_segments(columns, n_rows, sep=',', line_end='\n'):
+    # Stack the segments of every column with sep between columns and
+    # line_end after each row, then drop the NUL padding. Returns bytes.
+    sep_bytes = np.frombuffer(sep.encode(), dtype=np.uint8)
+    end_bytes = np.frombuffer(line_end.encode(), dtype=np.uint8)
+    sep_segment = np.broadcast_to(sep_bytes, (n_rows, len(sep_bytes)))
+    end_segment = np.broadcast_to(end_bytes, (n_rows, len(end_bytes)))
+
+    stacked = []
+    for i, segments in enumerate(columns):
+        stacked += segments
+        stacked.append(sep_segment if i < len(columns) - 1 else end_segment)
+    text = np.hstack(stacked)
+    return text[text != 0].tobytes()
+
+def can_write_fast(data):
+    # Only number columns, and a number index or a MultiIndex
+    if not all(dtype.kind in 'fiu' for dtype in data.dtypes):
+        return False
+    if isinstance(data.index, pd.MultiIndex):
+        return all(level.dtype.kind in 'fiuO' for level in data.index.levels)
+    return data.index.dtype.kind in 'fiu'
+
+
+class QsTxtWriter:
+    # Writes a frame (or a sequence of row blocks from the same frame) as
+    # csv text in the same layout as DataFrame.to_csv(path)
+
+    def __init__(self, path, precision=None, compression=None, header=True,
+            index=True, sep=',', block_rows=2**14, compress_level=None):
+        if compression not in compressions:
+            raise ValueError(f"Unknown compression {compression}. " +
+                             f"Choose from {compressions}")
+        self.path = path + compression_extensions[compression]
+        self.precision = precision
+        self.compression = compression
+        self.compress_level = compress_level if compress_level is not None \
+                else default_compress_levels.get(compression)
+        self.header = header
+        self.index = index
+        self.sep = sep
+        self.block_rows = block_rows
+        self.line_end = os.linesep
+        self.wrote_header = False
+        self.file = self._open()
+
+    def _open(self):
+        if self.compression == 'gzip':
+            return gzip.open(self.path, 'wb', compresslevel=self.compress_level)
+        elif self.compression == 'zstd':
+            if zstandard is None:
+                raise ImportError("zstd compression needs the zstandard package")
+            self._raw_file = open(self.path, 'wb')
+            compressor = zstandard.ZstdCompressor(level=self.compress_level)
+            return compressor.stream_writer(self._raw_file)
+        return open(self.path, 'wb', buffering=2**20)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        if self.compression == 'zstd':
+            self._raw_file.close()
+        self.file = None
+
+    def write(self, data):
+        # Write a frame. Frames written one after another are treated as row
+        # blocks of one frame (only the first one gets a header).
+        if self.header and not self.wrote_header:
+            self._write_text(self._header_line(data))
+        self.wrote_header = True
+
+        if not can_write_fast(data):
+            text = data.to_csv(None, header=False, index=self.index,
+                    sep=self.sep, lineterminator=self.line_end,
+                    float_format=None if self.precision is None
+                    else f"%.{self.precision}f")
+            self._write_text(text)
+            return
+
+        for start in range(0, len(data), self.block_rows):
+            block = data.iloc[start:start + self.block_rows]
+            self.file.write(self._format_block(block))
+
+    def _write_text(self, text):
+        self.file.write(text.encode())
+
+    def _header_line(self, data):
+        fields = []
+        if self.index:
+            n_levels = data.index.nlevels
+            names = [n if n is not None else '' for n in data.index.names]
+            fields += names if any(names) else [''] * n_levels
+        fields += list(data.columns.astype(str))
+        return self.sep.join(quote_fields(fields, self.sep)) + self.line_end
+
+    def _format_block(self, block):
+        # Returns the bytes of a block of rows
+        columns = []
+        if self.index:
+            index = block.index
+            for i in range(index.nlevels):
+                columns.append(column_segments(
+                        index.get_level_values(i).to_numpy(),
+                        self.precision, sep=self.sep))
+
+        # One 2D array if every column is a float64, otherwise column by
+        # column so ints and float32s keep their dtype
+        is_float_block = all(dtype == np.float64 for dtype in block.dtypes)
+        values = block.to_numpy() if is_float_block else None
+        for i, column in enumerate(block.columns):
+            column_values = values[:, i] if is_float_block \
+                    else block[column].array
+            columns.append(column_segments(column_values, self.precision,
+                    sep=self.sep))
+        return join_segments(columns, len(block), self.sep, self.line_end)
+
+
+def write_txt(data, path, precision=None, compression=None, **kwargs):
+    # Write a whole frame. Returns the path written (with any compression
+    # extension).
+    with QsTxtWriter(path, precision, compression, **kwargs) as writer:
+        writer.write(data)
+    return writer.path
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+# Watch mode: keep running during an experiment and merge each period soon
+# after its Qs files land, instead of rerunning the whole crawl.
+#
+# Every watch_poll_interval seconds QsWatcher asks a change detector which Qs
+# files are new or changed:
+#   poll     : PollingDetector rescans the tree with the discovery index (see
+#              Qs_discovery.py), so only directories whose mtime changed are
+#              listed, then stats the Qs files it found.
+#   watchdog : WatchdogDetector gets file events from the OS through the
+#              optional watchdog package and only stats the files in them.
+# Any object with poll() and close() works. poll() returns {path : (size,
+# mtime_ns)} for the files that changed since the last poll, or None for
+# files that were removed. The first poll returns every file.
+#
+# The light-table software writes the Qs files as it goes, so a changed file
+# is held by a Debouncer until its size and mtime stop changing for
+# watch_settle_seconds. Empty files were probably just created, so they have
+# to stay empty for watch_empty_settle_seconds instead (some Qs files stay
+# empty). A period is merged once all of its changed files have settled.
+# Files that match the build manifest (eg. on the first poll) are dropped, so
+# a restart only picks up what changed since the last run.
+#
+# The settled periods go through the usual extractor and processor, but only
+# those periods: QsExtractor.extract_light_table gets the period's Qs files
+# and QsPickleProcessor.run_periods merges them and updates the summary stats
+# with their rows. Both share one build manifest, so neither overwrites the
+# other's records. Removed files are ignored, like in a normal run.
+#
+# If a batch fails (eg. the data root dropped out for a moment), its periods
+# are tried again after watch_retry_seconds, doubling each time they fail up
+# to watch_max_retry_seconds. A period whose files change again is merged as
+# soon as they settle.
+
+import fnmatch
+import os
+import time
+from os.path import join as pjoin
+
+import Qs_manifest
+import Qs_pipeline
+
+
+def period_Qs_files(period_path, patterns):
+    # Every Qs file in a period directory (the extractor needs all of them)
+    return sorted(pjoin(period_path, f) for f in os.listdir(period_path)
+                  if any(fnmatch.fnmatchcase(f, p) for p in patterns))
+
+
+## Change detectors
+
+class PollingDetector:
+    # Finds changes by rescanning the tree. finder is a
+    # Qs_discovery.QsFileFinder.
+
+    def __init__(self, finder):
+        self.finder = finder
+        self.known = {} # path : (size, mtime_ns)
+
+    def poll(self):
+        # Only the in memory index is updated, the index file is left to the
+        # extractor
+        current = {}
+        for path in self.finder.find(save_index=False):
+            try:
+                current[path] = Qs_manifest.stat_path(path)
+            except OSError:
+                continue # removed since the scan
+        changes = {path : signature for path, signature in current.items()
+                   if self.known.get(path) != signature}
+        changes.update({path : None for path in self.known
+                        if path not in current})
+        self.known = current
+        return changes
+
+    def close(self):
+        pass
+
+
+class WatchdogDetector:
+    # Finds changes from OS file events (inotify, FSEvents, ...). The first
+    # poll still scans the tree to find files that changed while nothing was
+    # watching.
+
+    def __init__(self, finder):
+        # watchdog is optional, so it is only imported if this is used
+        import threading
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+
+        self.finder = finder
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.scanned = False
+
+        handler = FileSystemEventHandler()
+        handler.on_any_event = self._on_event
+        self.observer = Observer()
+        self.observer.schedule(handler, finder.root_dir, recursive=True)
+        self.observer.start()
+
+    def is_watched(self, path):
+        # A Qs file outside the pruned directories
+        if not self.finder.is_target(os.path.basename(path)):
+            return False
+        directory = os.path.dirname(path)
+        while directory != self.finder.root_dir and \
+                directory.startswith(self.finder.root_dir):
+            if self.finder.is_pruned(os.path.basename(directory), directory):
+                return False
+            directory = os.path.dirname(directory)
+        return True
+
+    def _on_event(self, event):
+        # Runs in the observer thread
+        if event.is_directory:
+            return
+        paths = [event.src_path, getattr(event, 'dest_path', None)]
+        with self.lock:
+            self.dirty.update(p for p in paths if p and self.is_watched(p))
+
+    def poll(self):
+        if not self.scanned:
+            self.scanned = True
+            paths = self.finder.find(save_index=False)
+            with self.lock:
+                self.dirty.clear()
+        else:
+            with self.lock:
+                paths, self.dirty = self.dirty, set()
+
+        changes = {}
+        for path in paths:
+            try:
+                changes[path] = Qs_manifest.stat_path(path)
+            except OSError:
+                changes[path] = None
+        return changes
+
+    def close(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+watch_detectors = {'poll' : PollingDetector, 'watchdog' : WatchdogDetector}
+
+def make_detector(name, finder):
+    if name not in watch_detectors:
+        raise ValueError(f"Unknown watch detector {name}. " +
+                         f"Choose from {list(watch_detectors)}")
+    return watch_detectors[name](finder)
+
+
+## Debouncing
+
+class Debouncer:
+    # Holds changed files until they stop changing
+
+    def __init__(self, settle_seconds, empty_settle_seconds=None):
+        self.settle_seconds = settle_seconds
+        if empty_settle_seconds is None:
+            empty_settle_seconds = 10 * settle_seconds
+        self.empty_settle_seconds = empty_settle_seconds
+        self.pending = {} # path : (signature, time of the last change)
+
+    def update(self, changes, now):
+        for path, signature in changes.items():
+            if signature is None:
+                self.pending.pop(path, None)
+                continue
+            known = self.pending.get(path)
+            if known is None or known[0] != signature:
+                self.pending[path] = (signature, now)
+
+    def is_settled(self, path, now):
+        # Empty files were probably just created, so they wait longer for 
+        # data
+        (size, _), changed = self.pending[path]
+        wait = self.settle_seconds if size > 0 else self.empty_settle_seconds
+        return now - changed >= wait
+
+    def pending_periods(self):
+        return set(os.path.dirname(path) for path in self.pending)
+
+    def pop_ready(self, now):
+        # {period path : [changed files]} for the periods whose changed files
+        # have all settled. Those files are no longer pending.
+        periods = {}
+        for path in self.pending:
+            periods.setdefault(os.path.dirname(path), []).append(path)
+
+        ready = {}
+        for period_path, paths in sorted(periods.items()):
+            if all(self.is_settled(path, now) for path in paths):
+                ready[period_path] = sorted(paths)
+                for path in paths:
+                    del self.pending[path]
+        return ready
+
+
+## Watcher
+
+class QsWatcher:
+
+    def __init__(self, extractor, processor, detector, settle_seconds=10,
+            poll_interval=2, patterns=None, empty_settle_seconds=None,
+            retry_seconds=30, max_retry_seconds=600):
+        self.extractor = extractor
+        self.processor = processor
+        self.detector = detector
+        self.debouncer = Debouncer(settle_seconds, empty_settle_seconds)
+        self.poll_interval = poll_interval
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.retries = {} # period path : (failed attempts, time to retry)
+        if patterns is None:
+            patterns = detector.finder.patterns
+        self.patterns = patterns
+        self.logger = processor.logger
+
+        # One manifest for both so the records they write don't clobber
+        # each other between batches
+        self.manifest = extractor.manifest
+        processor.manifest = self.manifest
+
+        self.batch_count = 0
+        self.stopped = False
+
+    def run(self, max_polls=None):
+        # Watch until interrupted (Ctrl-C) or stop() is called
+        self.logger.write_section_break()
+        self.logger.write([f"Watching {self.detector.finder.root_dir}",
+                f"Polling every {self.poll_interval}s, merging once files " +
+                f"settle for {self.debouncer.settle_seconds}s"])
+        self.processor.start_run()
+        n_polls = 0
+        try:
+            while not self.stopped:
+                self.poll_once()
+                n_polls += 1
+                if max_polls is not None and n_polls >= max_polls:
+                    break
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            self.logger.write("Stopped watching")
+        finally:
+            self.close()
+
+    def stop(self):
+        self.stopped = True
+
+    def poll_once(self, now=None):
+        # Returns the periods that were merged
+        if now is None:
+            now = time.monotonic()
+        self.debouncer.update(self.detector.poll(), now)
+        ready = self.debouncer.pop_ready(now)
+        period_paths = [path for path, changed in ready.items()
+                        if path in self.retries or
+                        self.needs_merge(path, changed)]
+
+        # Failed periods that are due, unless their files are changing again
+        changing = self.debouncer.pending_periods()
+        period_paths += [path for path, (_, retry_at) in self.retries.items()
+                         if retry_at <= now and path not in ready and
+                         path not in changing]
+        if not period_paths:
+            return []
+        period_paths = sorted(period_paths)
+        if not self.process_periods(period_paths):
+            self.schedule_retries(period_paths, now)
+            return []
+        for path in period_paths:
+            self.retries.pop(path, None)
+        return period_paths
+
+    def schedule_retries(self, period_paths, now):
+        # Back off exponentially for periods that keep failing
+        for path in period_paths:
+            attempts = self.retries.get(path, (0, None))[0] + 1
+            wait = min(self.retry_seconds * 2**(attempts - 1),
+                       self.max_retry_seconds)
+            self.retries[path] = (attempts, now + wait)
+        self.logger.write(f"Trying {len(period_paths)} periods again in " +
+                f"{min(self.retries[p][1] for p in period_paths) - now:.0f}s")
+
+    def needs_merge(self, period_path, changed_paths):
+        # False if every changed file matches the manifest and the period
+        # was merged before (eg. the first poll after a normal run)
+        if period_path not in self.manifest.periods:
+            return True
+        return not all(self.manifest.is_stat_unchanged(path)
+                       for path in changed_paths)
+
+    def process_periods(self, period_paths):
+        # Returns False if the batch failed
+        self.batch_count += 1
+        start = time.monotonic()
+        self.logger.write_section_break()
+        self.logger.write([f"Watch batch {self.batch_count}: " +
+                f"{len(period_paths)} changed periods"] + period_paths)
+        try:
+            txt_paths = []
+            for period_path in period_paths:
+                txt_paths.extend(period_Qs_files(period_path, self.patterns))
+            self.extractor.extract_light_table(txt_paths)
+            self.processor.run_periods(period_paths)
+        except Exception as error:
+            # Keep watching. The periods are tried again later.
+            failure = Qs_pipeline.StageFailure('watch', error)
+            self.logger.warning([f"Watch batch {self.batch_count} failed"] +
+                    failure.lines())
+            return False
+        finally:
+            frame_cache = self.processor.frame_cache
+            if frame_cache is not None:
+                frame_cache.clear()
+        self.logger.write(f"Watch batch {self.batch_count} done in " +
+                f"{time.monotonic() - start:.1f}s")
+        return True
+
+    def close(self):
+        self.detector.close()
+        self.processor.end_run()
+        self.extractor.end()
@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+
+# python -m Qs_merger runs the command line in Qs_cli.py
+
+import sys
+from Qs_merger import Qs_cli
+
+sys.exit(Qs_cli.main())
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+# Keep this file cheap to import. Nothing here should touch the filesystem or 
+# import anything big, so a run with nothing to do can exit quickly. The 
+# output directories are made by ensure_output_dirs when there is work to do.
+
 from os.path import join as pjoin
-from helpyr.helpyr_misc import ensure_dir_exists
 
 root_dir = "/home/alex/hacking/Qs_merger/tests/test_data"
 #root_dir = "E:\LT_Qs_Combine\LT_Results" # Windows style path
@@ -9,16 +12,156 @@ root_dir = "/home/alex/hacking/Qs_merger/tests/test_data"
 
 lighttable_bedload_cutoff = 800 # g/s max rate
 
+# Rows with a value above its column's cutoff are set to nan. Any column can 
+# have a cutoff. 
+column_cutoffs = {'Bedload all' : lighttable_bedload_cutoff}
+
+# How the merged frame is cleaned (nan rows, cutoffs, overlap). 'fused' does 
+# it all in one pass over the data. 'pandas' is the original. Both give the 
+# same output. See Qs_clean.py
+clean_engine = 'fused'
+
+# Max number of conflicting Qs.txt/Qs#.txt rows written to the log per period
+max_logged_diff_rows = 1000
+
+# Logging. 'text' writes every line to the log file as it is logged. 
+# 'buffered' writes the lines in batches from a background thread. log_level 
+# 'debug' logs everything, including every overlapped timestamp and the 
+# conflicting rows. 'info' logs those as short ranges of rows instead (at most 
+# max_logged_ranges). Either way, a json lines file with one record per 
+# period (status, error codes, row counts) is written next to the log. See 
+# Qs_logging.py
+log_mode = 'text'
+log_level = 'debug'
+max_logged_ranges = 20
+
+# How the Qs# chunks are combined. 'vectorized' or 'loop' (the original, 
+# slower engine). Both give the same output.
+combine_engine = 'vectorized'
+
+# Merge periods in blocks of this many rows to keep memory use down on very 
+# long periods. Needs storage_format = 'npy'. None merges whole periods at once.
+stream_block_rows = None
+
 
 output_dir = pjoin(root_dir, "Qs-merger-output")
 Qs_raw_pickles_dir = pjoin(output_dir, "raw-pickles")
 Qs_merged_pickles_dir = pjoin(output_dir, "merged-pickles")
 Qs_merged_txt_dir = pjoin(output_dir, "merged-txts")
 
-ensure_dir_exists(output_dir)
-ensure_dir_exists(Qs_raw_pickles_dir)
-ensure_dir_exists(Qs_merged_pickles_dir)
-ensure_dir_exists(Qs_merged_txt_dir)
+def ensure_output_dirs():
+    from helpyr.helpyr_misc import ensure_dir_exists
+    ensure_dir_exists(output_dir)
+    ensure_dir_exists(Qs_raw_pickles_dir)
+    ensure_dir_exists(Qs_merged_pickles_dir)
+    ensure_dir_exists(Qs_merged_txt_dir)
 
 
 metapickle_name = 'Qs_metapickle' 
+# The metapickle has been replaced by an indexed SQLite metastore. An old 
+# metapickle is copied into it the first time it is opened. See Qs_metastore.py
+metastore_name = 'Qs_metastore.sqlite'
+statspickle_name = 'Qs_summary_stats'
+
+# How the summary stats are saved. 'pickle' rewrites the whole 
+# Qs_summary_stats pickle every run. 'append' adds each run's new rows to an 
+# append-only log (Qs_summary_stats-log) instead. See Qs_stats.py
+stats_storage = 'pickle'
+
+# Build manifest for incremental reruns. Saved next to the metapickle.
+manifest_name = 'Qs_build_manifest.json'
+
+# Merged txt output. By default the files are written with helpyr's 
+# DataLoader.save_txt. fast_txt_writer writes them with a bulk writer instead, 
+# which matches DataFrame.to_csv byte for byte. txt_precision and 
+# txt_compression need the fast writer. txt_precision = None writes floats 
+# like to_csv, an int writes that many decimals. txt_compression can be None, 
+# 'gzip', or 'zstd' (needs the zstandard package). See Qs_txt_writer.py
+fast_txt_writer = False
+txt_precision = None
+txt_compression = None
+
+# Column dtypes of the raw and merged Qs frames. 'float64' is the original 
+# layout. 'compact' stores the grain counts as nullable ints and the masses, 
+# velocities, and D stats as float32, about half the memory and disk. 
+# Timestamps stay float64. Pickles made in the other mode are converted when 
+# loaded (rerun the extractor with fresh pickles to shrink them on disk).
+# validate_compact logs every raw frame column that changed by more than 
+# compact_tolerance when compacted. See Qs_dtypes.py
+Qs_dtype_mode = 'float64'
+validate_compact = False
+compact_tolerance = 5e-4
+
+# Compare Qs.txt to Qs1.txt before pickling. An exact copy is stored as a 
+# hard link to the Qs1.txt frame. A near copy (same rows, at most 
+# near_duplicate_fraction of them different) has its differing rows recorded 
+# so the processor's difference check only compares those. See 
+# Qs_fingerprint.py
+dedup_raw_files = True
+near_duplicate_fraction = 0.01
+
+# Pipeline the periods when they are run in one process (no --workers): 
+# the next period is loaded and the last one is written in background threads 
+# while the current one merges. Helps when the data root is slow (eg. NFS). 
+# pipeline_prefetch and pipeline_pending_writes are how many periods can wait 
+# between the stages. A period that fails is logged with error code PSF and 
+# the rest carry on. See Qs_pipeline.py
+pipeline_periods = False
+pipeline_prefetch = 1
+pipeline_pending_writes = 1
+
+# Memory budget in bytes for handing freshly extracted raw frames straight to 
+# the processor in a combined run (Qs-merger). The frames are still stored. 
+# Least recently used frames are dropped when it is full. 0 turns it off. 
+# It is only used when the extraction and the merging both run in one 
+# process (no --extract-workers or --workers). See Qs_frame_cache.py
+frame_cache_bytes = 2 * 2**30
+
+# Sharded runs over several nodes sharing the data root. The nodes claim 
+# periods from a work queue directory next to the metastore. A node that 
+# stops renewing its lease for shard_lease_seconds is taken to be dead and 
+# its period is merged by another node. Nodes check on periods held by others 
+# every shard_poll_interval seconds. See Qs_shard.py
+shard_queue_name = 'Qs_shard_queue'
+shard_lease_seconds = 600
+shard_poll_interval = 5
+
+# Watch mode (Qs-merger --watch) keeps running and merges periods as their Qs 
+# files land. watch_detector is how changed files are found: 'poll' rescans 
+# the tree (with the discovery index) every watch_poll_interval seconds, 
+# 'watchdog' gets file events from the OS (needs the watchdog package). A 
+# file has to stay the same size and mtime for watch_settle_seconds before 
+# its period is merged, so files still being written are left alone. Empty 
+# files wait watch_empty_settle_seconds. A batch that fails is tried again 
+# after watch_retry_seconds, doubling up to watch_max_retry_seconds. See 
+# Qs_watch.py
+watch_detector = 'poll'
+watch_poll_interval = 2
+watch_settle_seconds = 10
+watch_empty_settle_seconds = 300
+watch_retry_seconds = 30
+watch_max_retry_seconds = 600
+
+# How the raw Qs# frames and merged Qs frames are stored. 'pickle', 'npy', 
+# 'feather' (needs pyarrow), or 'mmap'. mmap frames are always opened as read 
+# only memory maps, so merging reads the raw chunks straight from the page 
+# cache and parallel workers share the pages. See Qs_storage.py
+storage_format = 'pickle'
+
+# Record the time and memory used by every stage of every period. A run report 
+# (json and csv) is written next to the log files. On Linux this resets the 
+# process's peak memory through /proc/self/clear_refs before each stage. See 
+# Qs_profiler.py
+profile_stages = False
+
+# Names of the directories above each period directory, outermost first, eg. 
+# .../1A/rising-50L/results-t20 is experiment 1A, step rising-50L. Used to 
+# filter and group periods in queries. See Qs_query.py
+period_path_fields = ['experiment', 'step']
+
+# File discovery keeps an index of the directories under root_dir so reruns 
+# only list directories that changed. Saved next to the metapickle. Set 
+# discovery_workers to scan with a pool of threads (useful for network mounted 
+# roots). See Qs_discovery.py
+discovery_index_name = 'Qs_dir_index.json'
+discovery_workers = None
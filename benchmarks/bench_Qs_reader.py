@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Benchmark the fixed schema Qs reader against the DataLoader.load_txt path 
+# used by the extractor. The sample Qs files in tests/test_data are repeated 
+# to make bigger files.
+#
+# Usage:
+#   python bench_Qs_reader.py [--scale 50] [--repeats 5]
+
+import argparse
+import os
+import sys
+import tempfile
+from os.path import join as pjoin
+from time import perf_counter
+
+import pandas as pd
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, pjoin(repo_dir, 'Qs_merger'))
+
+from helpyr import data_loading
+from helpyr import logger as hlp_logger
+
+from Qs_schema import Qs_column_names
+from Qs_reader import read_Qs_txt
+from Qs_reader import is_available as fast_reader_available
+
+sample_dir = pjoin(repo_dir, 'tests', 'test_data', 'results-K01_0100')
+sample_names = ['Qs1.txt', 'Qs2.txt', 'Qs3.txt']
+
+
+def make_scaled_files(out_dir, scale):
+    # Concatenate each sample file with itself `scale` times
+    paths = []
+    for name in sample_names:
+        with open(pjoin(sample_dir, name), 'rb') as sample_file:
+            text = sample_file.read().rstrip() + b'\n'
+        path = pjoin(out_dir, name)
+        with open(path, 'wb') as scaled_file:
+            scaled_file.write(text * scale)
+        paths.append(path)
+    return paths
+
+def time_reader(read, paths, repeats):
+    best = None
+    for _ in range(repeats):
+        start = perf_counter()
+        for path in paths:
+            read(path)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scale', type=int, default=50)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    if not fast_reader_available():
+        sys.exit("pyarrow is needed for the fast Qs reader")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = make_scaled_files(tmp_dir, args.scale)
+        logger = hlp_logger.Logger(pjoin(tmp_dir, 'bench_log.txt'),
+                default_verbose=False)
+        loader = data_loading.DataLoader(tmp_dir, tmp_dir, logger)
+        Qs_kwargs = {
+                'index_col' : None,
+                'header'    : None,
+                'names'     : Qs_column_names,
+                }
+
+        load_txt = lambda path: loader.load_txt(path, Qs_kwargs,
+                add_path=False)
+        generic = load_txt(paths[0])
+        fast = read_Qs_txt(paths[0])
+        pd.testing.assert_frame_equal(fast, generic, check_dtype=False)
+
+        n_rows = sum(len(read_Qs_txt(path)) for path in paths)
+        generic_time = time_reader(load_txt, paths, args.repeats)
+        fast_time = time_reader(read_Qs_txt, paths, args.repeats)
+
+    print(f"{len(paths)} files, {n_rows} rows, best of {args.repeats}")
+    print(f"DataLoader.load_txt : {generic_time:8.4f} s")
+    print(f"read_Qs_txt         : {fast_time:8.4f} s")
+    print(f"speedup             : {generic_time / fast_time:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
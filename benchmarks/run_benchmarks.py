@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+# Timing and peak memory benchmarks for the main pipeline stages, run on a
+# synthetic period tree (see synthetic_data.py).
+#
+# Benchmarks:
+#   extract_read_Qs_txt      : parse every Qs txt file with the fast reader
+#   extract_light_table      : QsExtractor.extract_light_table into a fresh
+#                              output directory (parse + pickle + metapickle)
+#   combine_Qsn_chunks[eng]  : QsPickleProcessor.combine_Qsn_chunks for each
+#                              combine engine
+#   clean[engine]            : Qs_clean.clean_frame (nan rows, cutoff
+#                              trimming, overlap) on a copy of every merged
+#                              frame, for each clean engine
+#   difference_check         : QsPickleProcessor._difference_check on the
+#                              periods that have both Qs.txt and Qs#.txt
+#   stats                    : column stats for every period into a StatsTable
+#   txt_output               : QsPickleProcessor.write_combined_txt
+#   txt_writer[writer]       : the merged frames written by the old to_csv
+#                              path, the fast writer, and the fast writer
+#                              with gzip
+#   startup_import[module]   : a fresh python importing Qs_cli (the console
+#                              script) or Qs_pickle_processor. [python] and
+#                              [pandas] are there for reference.
+#   startup_noop_check       : Qs_cli.pending_work on a tree where the last
+#                              run is up to date
+#   load_combine[format]     : load the stored raw Qs# chunks of a period and
+#                              combine them, for each storage format
+#
+# Each benchmark runs over every period. The time is the best of --repeats
+# runs. Peak memory is measured separately with tracemalloc (numpy and pandas
+# allocations are tracked, pyarrow's own buffers are not) so it doesn't slow
+# down the timed runs. Benchmarks whose dependencies are missing are marked as
+# skipped.
+#
+# Results are written as json so runs can be compared across commits:
+#   python run_benchmarks.py --output before.json
+#   git checkout other-branch
+#   python run_benchmarks.py --output after.json --compare before.json
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from os.path import join as pjoin
+from time import perf_counter, asctime
+
+import numpy as np
+import pandas as pd
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+Qs_merger_dir = pjoin(repo_dir, 'Qs_merger')
+sys.path.insert(0, Qs_merger_dir)
+sys.path.insert(0, bench_dir)
+
+import synthetic_data
+from Qs_schema import Qs_column_names
+from Qs_log_buffer import LogRecorder
+import Qs_clean
+import Qs_combine
+import Qs_stats
+import Qs_storage
+import Qs_txt_writer
+
+
+class BenchmarkSkipped(Exception):
+    pass
+
+
+class Period:
+    # In memory data for one synthetic period
+
+    def __init__(self, period_dir):
+        self.period_dir = period_dir
+        self.name = os.path.basename(period_dir)
+        self.txt_paths = sorted(pjoin(period_dir, f)
+                for f in os.listdir(period_dir) if f.endswith('.txt'))
+        self.Qs0_data = None
+        self.Qsn_data = []
+        self.Qsn_names = []
+        for path in self.txt_paths:
+            Qs_name = os.path.basename(path).split('.')[0]
+            data = pd.read_csv(path, sep='\t', header=None,
+                    names=Qs_column_names)
+            if Qs_name == 'Qs':
+                self.Qs0_data = data
+            else:
+                self.Qsn_data.append(data)
+                self.Qsn_names.append(Qs_name)
+
+        self.combined_Qs, self.accumulating_overlap = \
+                Qs_combine.combine_chunks(self.Qsn_data, self.Qsn_names)
+
+
+def make_bare_processor(work_dir):
+    # A QsPickleProcessor without the file system setup in __init__. Only
+    # has what the benchmarked methods use.
+    try:
+        from helpyr import data_loading
+        from Qs_pickle_processor import QsPickleProcessor
+    except ImportError as e:
+        raise BenchmarkSkipped(f"needs {e.name}")
+
+    processor = QsPickleProcessor.__new__(QsPickleProcessor)
+    processor.logger = LogRecorder()
+    processor.loader = data_loading.DataLoader(work_dir, work_dir,
+            processor.logger)
+    processor.difference_tolerance = 0.02
+    processor.txt_destination = work_dir
+    processor.output_paths = []
+    processor.period_errors = []
+    processor.period_counts = {}
+    processor.Qs0_link = None
+    return processor
+
+
+## Benchmarks
+# Each is a setup function taking (periods, work_dir) and returning the
+# function to time.
+
+def setup_read_Qs_txt(periods, work_dir):
+    from Qs_reader import read_Qs_txt
+    from Qs_reader import is_available as fast_reader_available
+    if not fast_reader_available():
+        raise BenchmarkSkipped("needs pyarrow")
+
+    paths = [path for period in periods for path in period.txt_paths]
+    def run():
+        for path in paths:
+            read_Qs_txt(path)
+    return run
+
+def setup_extract_light_table(periods, work_dir):
+    try:
+        from Qs_extractor import QsExtractor
+    except ImportError as e:
+        raise BenchmarkSkipped(f"needs {e.name}")
+
+    root_dir = os.path.dirname(periods[0].period_dir)
+    paths = [path for period in periods for path in period.txt_paths]
+    output_dir = pjoin(work_dir, 'extract-output')
+    def run():
+        # Start from scratch every time so nothing is skipped as current
+        shutil.rmtree(output_dir, ignore_errors=True)
+        extractor = QsExtractor(root_dir, output_dir)
+        extractor.extract_light_table(paths)
+    return run
+
+def make_setup_combine(engine):
+    def setup_combine(periods, work_dir):
+        processor = make_bare_processor(work_dir)
+        processor.combine_engine = engine
+        chunked = [p for p in periods if p.Qsn_data]
+        def run():
+            for period in chunked:
+                processor.Qsn_data = period.Qsn_data
+                processor.Qsn_names = period.Qsn_names
+                processor.combine_Qsn_chunks()
+                processor.logger.clear()
+        return run
+    return setup_combine
+
+def make_setup_clean(engine):
+    def setup_clean(periods, work_dir):
+        # The cleaning works in place, so every run cleans fresh copies (the
+        # time includes copying the frames)
+        cutoffs = {'Bedload all' : 800, 'Count all' : 5000}
+        def run():
+            for period in periods:
+                Qs_clean.clean_frame(period.combined_Qs.copy(), cutoffs,
+                        period.accumulating_overlap, engine=engine)
+        return run
+    return setup_clean
+
+def setup_difference_check(periods, work_dir):
+    processor = make_bare_processor(work_dir)
+    conflicted = [p for p in periods if p.Qs0_data is not None and p.Qsn_data]
+    if not conflicted:
+        raise BenchmarkSkipped("no periods with both Qs.txt and Qs#.txt")
+    def run():
+        for period in conflicted:
+            processor.Qs0_data = period.Qs0_data
+            processor.combined_Qs = period.combined_Qs
+            processor._difference_check()
+            processor.logger.clear()
+    return run
+
+def setup_stats(periods, work_dir):
+    # Same work as QsPickleProcessor.calculate_stats
+    outputs = [(p.name, p.combined_Qs) for p in periods]
+    def run():
+        summary_stats = Qs_stats.StatsTable()
+        for name, data in outputs:
+            av, sums, nans = Qs_stats.column_stats(data)
+            summary_stats.add_period(name, av, sums, nans, data.columns)
+        summary_stats.to_frame()
+    return run
+
+def setup_txt_output(periods, work_dir):
+    processor = make_bare_processor(work_dir)
+    def run():
+        for period in periods:
+            processor.pkl_name = period.name
+            processor.final_output = period.combined_Qs
+            processor.write_combined_txt()
+        processor.output_paths = []
+    return run
+
+txt_writers = ['to_csv', 'fast', 'fast_gzip']
+
+def make_setup_txt_writer(writer):
+    # Without the processor so the to_csv baseline (what DataLoader.save_txt
+    # does) doesn't need helpyr
+    def setup(periods, work_dir):
+        outputs = [(pjoin(work_dir, f"{p.name}.txt"), p.combined_Qs)
+                   for p in periods]
+        if writer == 'to_csv':
+            write = lambda data, path: data.to_csv(path)
+        else:
+            compression = 'gzip' if writer == 'fast_gzip' else None
+            write = lambda data, path: Qs_txt_writer.write_txt(data, path,
+                    compression=compression)
+        def run():
+            for path, data in outputs:
+                write(data, path)
+        return run
+    return setup
+
+startup_modules = ['python', 'pandas', 'Qs_cli', 'Qs_pickle_processor']
+
+def make_setup_startup_import(module):
+    def setup(periods, work_dir):
+        if module == 'Qs_pickle_processor' and \
+                importlib.util.find_spec('helpyr') is None:
+            raise BenchmarkSkipped("needs helpyr")
+        code = f"import sys; sys.path.insert(0, {Qs_merger_dir!r})"
+        if module != 'python':
+            code += f"; import {module}"
+        command = [sys.executable, '-c', code]
+        def run():
+            subprocess.run(command, check=True)
+        return run
+    return setup
+
+def setup_noop_check(periods, work_dir):
+    import Qs_cli
+    root_dir = os.path.dirname(periods[0].period_dir)
+    state = synthetic_data.write_last_run_state(root_dir,
+            pjoin(work_dir, 'noop-output'))
+    def run():
+        assert Qs_cli.pending_work(state) is None
+    return run
+
+def make_setup_load_combine(storage_format):
+    # Raw chunks saved once in the format, then loaded (memory mapped for
+    # 'mmap') and combined by the vectorized engine every run. Pickles are
+    # written with pandas so the helpyr loader isn't needed.
+    def setup(periods, work_dir):
+        if storage_format == 'feather' and \
+                importlib.util.find_spec('pyarrow') is None:
+            raise BenchmarkSkipped("needs pyarrow")
+        store_dir = pjoin(work_dir, f'load-combine-{storage_format}')
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.makedirs(store_dir)
+        store = Qs_storage.make_store(storage_format, store_dir, None)
+        chunked = []
+        for period in periods:
+            if not period.Qsn_data:
+                continue
+            paths = []
+            for name, data in zip(period.Qsn_names, period.Qsn_data):
+                name = f"{period.name}_{name}"
+                if storage_format == 'pickle':
+                    paths.append(pjoin(store_dir, f"{name}.pkl"))
+                    data.to_pickle(paths[-1])
+                else:
+                    paths += store.save(name, data)
+            chunked.append(paths)
+        mmap = storage_format == 'mmap'
+        def run():
+            for paths in chunked:
+                chunks = [Qs_storage.load_frame(p, None, mmap=mmap)
+                          for p in paths]
+                Qs_combine.combine_chunks_vectorized(chunks)
+        return run
+    return setup
+
+benchmarks = [
+        ('extract_read_Qs_txt', setup_read_Qs_txt),
+        ('extract_light_table', setup_extract_light_table),
+        ] + [
+        (f'combine_Qsn_chunks[{engine}]', make_setup_combine(engine))
+        for engine in Qs_combine.combine_engines
+        ] + [
+        (f'clean[{engine}]', make_setup_clean(engine))
+        for engine in Qs_clean.clean_engines
+        ] + [
+        ('difference_check', setup_difference_check),
+        ('stats', setup_stats),
+        ('txt_output', setup_txt_output),
+        ] + [
+        (f'txt_writer[{writer}]', make_setup_txt_writer(writer))
+        for writer in txt_writers
+        ] + [
+        (f'startup_import[{module}]', make_setup_startup_import(module))
+        for module in startup_modules
+        ] + [
+        ('startup_noop_check', setup_noop_check),
+        ] + [
+        (f'load_combine[{storage_format}]',
+            make_setup_load_combine(storage_format))
+        for storage_format in Qs_storage.storage_formats
+        ]
+
+
+## Harness
+
+def measure(run, repeats):
+    # Returns (times, peak bytes). Output from the pipeline loggers is
+    # swallowed so it doesn't swamp the results.
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        run() # warm up
+        for _ in range(repeats):
+            start = perf_counter()
+            run()
+            times.append(perf_counter() - start)
+
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return times, peak
+
+def run_benchmarks(periods, work_dir, repeats, selected=None):
+    results = {}
+    for name, setup in benchmarks:
+        if selected and not any(s in name for s in selected):
+            continue
+        try:
+            run = setup(periods, work_dir)
+        except BenchmarkSkipped as e:
+            results[name] = {'status' : 'skipped', 'reason' : str(e)}
+            print(f"{name:32s} skipped ({e})")
+            continue
+
+        times, peak = measure(run, repeats)
+        results[name] = {
+                'status'  : 'ok',
+                'best_s'  : min(times),
+                'mean_s'  : float(np.mean(times)),
+                'repeats' : repeats,
+                'peak_mb' : peak / 2**20,
+                }
+        print(f"{name:32s} {min(times):9.4f} s  {peak / 2**20:9.1f} MB")
+    return results
+
+def get_git_commit():
+    try:
+        output = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=repo_dir, capture_output=True, text=True, check=True)
+        return output.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_meta():
+    return {
+            'commit'   : get_git_commit(),
+            'time'     : asctime(),
+            'python'   : platform.python_version(),
+            'platform' : platform.platform(),
+            'numpy'    : np.__version__,
+            'pandas'   : pd.__version__,
+            }
+
+def compare(results, base_results):
+    # Print the ratio of new/old times and memory for shared benchmarks
+    print(f"\nCompared to {base_results['meta'].get('commit')}:")
+    print(f"{'':32s} {'time':>9s}  {'memory':>9s}")
+    for name, result in results['results'].items():
+        base = base_results['results'].get(name)
+        if result['status'] != 'ok' or base is None or base['status'] != 'ok':
+            continue
+        time_ratio = result['best_s'] / base['best_s']
+        mem_ratio = result['peak_mb'] / base['peak_mb'] \
+                if base['peak_mb'] > 0 else np.nan
+        print(f"{name:32s} {time_ratio:8.2f}x  {mem_ratio:8.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Benchmark the Qs merger stages on synthetic data")
+    synthetic_data.add_arguments(parser)
+    parser.add_argument('--data-dir', default=None,
+            help="Use (or create) the synthetic tree here instead of a " +
+                 "temporary directory")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--only', nargs='*', default=None,
+            help="Only run benchmarks whose names contain these strings")
+    parser.add_argument('--output', default=None,
+            help="Write the json results here")
+    parser.add_argument('--compare', default=None,
+            help="Json results from an earlier run to compare against")
+    args = parser.parse_args()
+
+    params = {
+            'n_periods'        : args.n_periods,
+            'chunks'           : args.chunks,
+            'rows_per_chunk'   : args.rows_per_chunk,
+            'overlap_fraction' : args.overlap_fraction,
+            'conflict_rate'    : args.conflict_rate,
+            'mismatch_rate'    : args.mismatch_rate,
+            'seed'             : args.seed,
+            }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir if args.data_dir else pjoin(tmp_dir, 'data')
+        if os.path.isdir(data_dir) and os.listdir(data_dir):
+            print(f"Using existing synthetic data in {data_dir}")
+            period_dirs = sorted(pjoin(data_dir, d)
+                    for d in os.listdir(data_dir) if d.startswith('results-'))
+        else:
+            print(f"Writing synthetic data to {data_dir}")
+            period_dirs = synthetic_data.write_period_tree(data_dir, **params)
+
+        periods = [Period(d) for d in period_dirs]
+        work_dir = pjoin(tmp_dir, 'work')
+        os.makedirs(work_dir)
+
+        results = {
+                'meta'    : get_meta(),
+                'params'  : params,
+                'results' : run_benchmarks(periods, work_dir, args.repeats,
+                                           args.only),
+                }
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=1)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as base_file:
+            compare(results, json.load(base_file))
+
+
+if __name__ == "__main__":
+    main()
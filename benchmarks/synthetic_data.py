@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# Synthetic light table data for benchmarks.
+#
+# Makes periods that look like the real Qs#.txt files: 44 columns in the Qs
+# schema, one row per second, tab separated with 3 decimals and 'NaN' for
+# missing values. Each Qs# chunk has rows for the whole period, but only has
+# grain data within its own span. Outside the span the masses and counts are
+# zero and the D columns are nan, like the real files.
+#
+# Knobs:
+#   n_periods        : number of results-* directories
+#   chunks           : Qs#.txt files per period
+#   rows_per_chunk   : rows of data in each chunk
+#   overlap_fraction : fraction of a chunk's rows shared with the next chunk
+#   conflict_rate    : fraction of periods that also have a Qs.txt file
+#   mismatch_rate    : fraction of Qs.txt rows that differ from the chunks
+#
+# Usage:
+#   python synthetic_data.py OUTPUT_DIR [--n-periods 10] [--chunks 3] ...
+
+import argparse
+import os
+import sys
+from os.path import join as pjoin
+import numpy as np
+import pandas as pd
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, pjoin(os.path.dirname(bench_dir), 'Qs_merger'))
+
+from Qs_schema import Qs_column_names
+
+n_cols = len(Qs_column_names)
+n_sizes = 14 # grain size classes (0.5 to 45 mm)
+grain_sizes = np.array([0.5, 0.71, 1, 1.4, 2, 2.8, 4, 5.6, 8, 11.2, 16, 22,
+                        32, 45])
+grain_mass = 2.65e-3 * (np.pi / 6) * grain_sizes**3 # g per grain
+start_time = 3640694426.0
+
+
+def period_length(chunks, rows_per_chunk, overlap_fraction):
+    overlap = int(overlap_fraction * rows_per_chunk)
+    return rows_per_chunk + (chunks - 1) * (rows_per_chunk - overlap)
+
+def make_data_rows(n_rows, rng, empty_fraction=0.05):
+    # Grain data for n_rows seconds. Columns 5 onwards of the Qs schema.
+    counts = rng.poisson(lam=np.linspace(20, 0.5, n_sizes),
+            size=(n_rows, n_sizes)).astype(np.float64)
+
+    # Some seconds see no grains at all. Their D columns are nan.
+    empty = rng.random(n_rows) < empty_fraction
+    counts[empty] = 0
+
+    masses = np.round(counts * grain_mass * rng.uniform(0.8, 1.2,
+            size=counts.shape), 3)
+
+    d_stats = np.sort(rng.uniform(1, 12, size=(n_rows, 9)), axis=1)
+    d_stats = np.round(d_stats, 3)
+    d_stats[empty] = np.nan
+
+    return np.hstack([masses.sum(axis=1, keepdims=True), masses,
+                      counts.sum(axis=1, keepdims=True), counts, d_stats])
+
+def make_period(chunks=3, rows_per_chunk=3600, overlap_fraction=0.01,
+        with_Qs0=False, mismatch_rate=0.001, seed=0):
+    # Returns (Qs0 frame or None, list of chunk frames)
+    rng = np.random.default_rng(seed)
+    n_rows = period_length(chunks, rows_per_chunk, overlap_fraction)
+    overlap = int(overlap_fraction * rows_per_chunk)
+
+    meta = np.empty((n_rows, 5))
+    meta[:, 0] = start_time + np.arange(n_rows)
+    meta[:, 1] = 0.0
+    meta[:, 2:] = np.round(rng.uniform(0, 1500, size=(n_rows, 3)), 3)
+
+    chunk_frames = []
+    for i in range(chunks):
+        start = i * (rows_per_chunk - overlap)
+        stop = start + rows_per_chunk
+
+        values = np.zeros((n_rows, n_cols))
+        values[:, :5] = meta
+        values[:, 35:] = np.nan
+        values[start:stop, 5:] = make_data_rows(rows_per_chunk, rng)
+        chunk_frames.append(pd.DataFrame(values, columns=Qs_column_names))
+
+    Qs0 = None
+    if with_Qs0:
+        # Qs.txt is roughly the chunks laid end to end, with a few rows off
+        # by one grain like the real near duplicates
+        values = chunk_frames[0].to_numpy().copy()
+        for i, chunk in enumerate(chunk_frames[1:], start=1):
+            start = i * (rows_per_chunk - overlap)
+            values[start:] = chunk.to_numpy()[start:]
+        n_mismatch = int(mismatch_rate * n_rows)
+        rows = rng.choice(n_rows, size=n_mismatch, replace=False)
+        values[rows, 20] += 1
+        Qs0 = pd.DataFrame(values, columns=Qs_column_names)
+
+    return Qs0, chunk_frames
+
+def write_Qs_txt(data, filepath):
+    data.to_csv(filepath, sep='\t', header=False, index=False,
+            float_format='%.3f', na_rep='NaN')
+
+def write_period_tree(root_dir, n_periods=10, chunks=3, rows_per_chunk=3600,
+        overlap_fraction=0.01, conflict_rate=0.2, mismatch_rate=0.001,
+        seed=0):
+    # Write results-* directories of Qs#.txt files. Returns the list of
+    # period directories.
+    rng = np.random.default_rng(seed)
+    period_dirs = []
+    for p in range(n_periods):
+        period_dir = pjoin(root_dir, f"results-S{p // 100:02d}_{p % 100:04d}")
+        os.makedirs(period_dir, exist_ok=True)
+
+        with_Qs0 = rng.random() < conflict_rate
+        Qs0, chunk_frames = make_period(chunks, rows_per_chunk,
+                overlap_fraction, with_Qs0, mismatch_rate,
+                seed=int(rng.integers(2**31)))
+
+        for i, chunk in enumerate(chunk_frames, start=1):
+            write_Qs_txt(chunk, pjoin(period_dir, f"Qs{i}.txt"))
+        if Qs0 is not None:
+            write_Qs_txt(Qs0, pjoin(period_dir, "Qs.txt"))
+        period_dirs.append(period_dir)
+
+    return period_dirs
+
+def write_last_run_state(root_dir, output_dir):
+    # Fake the manifest, metastore, and stats of a finished run over a
+    # synthetic tree, so Qs_cli.pending_work finds nothing to do. The txt
+    # files stand in for the raw frames. Returns a settings-like namespace.
+    from types import SimpleNamespace
+    import Qs_manifest
+    import Qs_metastore
+    from Qs_discovery import make_finder
+
+    state = SimpleNamespace(root_dir=root_dir,
+            Qs_raw_pickles_dir=pjoin(output_dir, 'raw-pickles'),
+            Qs_merged_pickles_dir=pjoin(output_dir, 'merged-pickles'),
+            manifest_name='Qs_build_manifest.json',
+            metastore_name='Qs_metastore.sqlite',
+            discovery_index_name='Qs_dir_index.json', discovery_workers=None,
+            stats_storage='pickle', statspickle_name='Qs_summary_stats')
+    raw_dir = state.Qs_raw_pickles_dir
+    os.makedirs(raw_dir, exist_ok=True)
+    os.makedirs(state.Qs_merged_pickles_dir, exist_ok=True)
+    open(pjoin(state.Qs_merged_pickles_dir, 'Qs_summary_stats.pkl'), 'w').close()
+
+    finder = make_finder(root_dir, raw_dir, pjoin(root_dir, 'log-files'),
+            state.discovery_index_name)
+    period_dict = {}
+    for path in finder.find():
+        period_dict.setdefault(os.path.dirname(path), []).append(path)
+
+    manifest = Qs_manifest.BuildManifest(pjoin(raw_dir, state.manifest_name))
+    metastore = Qs_metastore.MetaStore(pjoin(raw_dir, state.metastore_name))
+    metastore.add_periods(period_dict)
+    metastore.close()
+    for period_path, paths in period_dict.items():
+        for path in paths:
+            manifest.record(path)
+        manifest.update_period(period_path,
+                *manifest.make_period_record(paths, []))
+    manifest.save()
+    return state
+
+def add_arguments(parser):
+    # Shared with run_benchmarks.py
+    parser.add_argument('--n-periods', type=int, default=10)
+    parser.add_argument('--chunks', type=int, default=3)
+    parser.add_argument('--rows-per-chunk', type=int, default=3600)
+    parser.add_argument('--overlap-fraction', type=float, default=0.01)
+    parser.add_argument('--conflict-rate', type=float, default=0.2)
+    parser.add_argument('--mismatch-rate', type=float, default=0.001)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Write a tree of synthetic light table periods")
+    parser.add_argument('output_dir')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    period_dirs = write_period_tree(args.output_dir, args.n_periods,
+            args.chunks, args.rows_per_chunk, args.overlap_fraction,
+            args.conflict_rate, args.mismatch_rate, args.seed)
+    print(f"Wrote {len(period_dirs)} periods to {args.output_dir}")
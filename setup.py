@@ -15,6 +15,13 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/alexmitchell/Qs_merger",
     packages=setuptools.find_packages(),
+    extras_require={
+        # Faster Qs#.txt reader and the feather storage format
+        'fast' : ['pyarrow'],
+    },
+    entry_points={
+        'console_scripts' : ['Qs-merger = Qs_merger.Qs_cli:main'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
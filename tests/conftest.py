@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+# The Qs_merger modules import each other as top level modules (they are run 
+# as scripts from inside the Qs_merger directory), so put that directory on 
+# the path for the tests.
+
+import os
+import sys
+
+import pytest
+
+Qs_merger_dir = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'Qs_merger')
+if Qs_merger_dir not in sys.path:
+    sys.path.insert(0, Qs_merger_dir)
+
+test_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'test_data')
+
+
+@pytest.fixture
+def run_settings(tmp_path, monkeypatch):
+    # Point settings.py at a data root and output directory in tmp_path for 
+    # tests that run the extractor or processor
+    import settings
+    root_dir = str(tmp_path / 'data')
+    output_dir = str(tmp_path / 'output')
+    paths = {'root_dir' : root_dir,
+             'output_dir' : output_dir,
+             'Qs_raw_pickles_dir' : os.path.join(output_dir, 'raw-pickles'),
+             'Qs_merged_pickles_dir' : os.path.join(output_dir, 'merged-pickles'),
+             'Qs_merged_txt_dir' : os.path.join(output_dir, 'merged-txts'),
+             }
+    for name, value in paths.items():
+        monkeypatch.setattr(settings, name, value)
+    return settings
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import Qs_clean
+import Qs_combine
+import Qs_dtypes
+from test_Qs_combine import make_chunks
+
+cutoffs = {'Bedload all' : 0.9, 'Count all' : 0.95}
+
+
+def combined_frame():
+    chunks, names = make_chunks(n_rows=5000,
+            spans=[(0, 2000), (1500, 4000), (3900, 5000)])
+    return Qs_combine.combine_chunks(chunks, names)
+
+def assert_results_match(fused, pandas):
+    np.testing.assert_array_equal(fused.get_trim_vals(),
+            pandas.get_trim_vals())
+    np.testing.assert_array_equal(fused.get_overlap_rows(),
+            pandas.get_overlap_rows())
+    assert fused.trim_counts == pandas.trim_counts
+    assert np.isclose(fused.total_bedload, pandas.total_bedload)
+
+def test_engines_match():
+    combined, overlap = combined_frame()
+    pandas_Qs, pandas_result = Qs_clean.clean_frame(combined.copy(), cutoffs,
+            overlap, engine='pandas')
+
+    fused_Qs, fused_result = Qs_clean.clean_frame(combined.copy(), cutoffs,
+            overlap, engine='fused', block_rows=777)
+    pd.testing.assert_frame_equal(fused_Qs, pandas_Qs)
+    assert_results_match(fused_result, pandas_result)
+    assert fused_result.trim_counts['Count all'] > 0
+    assert len(fused_result.get_overlap_rows()) == overlap.sum()
+
+def test_compact_frame():
+    combined, overlap = combined_frame()
+    compact = Qs_dtypes.compact_frame(combined)
+    pandas_Qs, pandas_result = Qs_clean.clean_frame(compact.copy(),
+            cutoffs['Bedload all'], overlap, engine='pandas')
+    fused_Qs, fused_result = Qs_clean.clean_frame(compact.copy(),
+            cutoffs['Bedload all'], overlap, engine='fused')
+
+    assert list(fused_Qs.dtypes) == list(compact.dtypes)
+    pd.testing.assert_frame_equal(fused_Qs, pandas_Qs)
+    assert_results_match(fused_result, pandas_result)
+
+def test_shared_frames_are_not_changed():
+    # With copy-on-write, frames sharing the values (eg. a frame cache entry) 
+    # keep the uncleaned data
+    if int(pd.__version__.split('.')[0]) < 3 and \
+            pd.options.mode.copy_on_write is not True:
+        pytest.skip("needs pandas copy-on-write")
+    combined, overlap = combined_frame()
+    shared = combined.copy(deep=False)
+    uncleaned = combined.copy()
+    fused_Qs, _ = Qs_clean.clean_frame(combined, cutoffs, overlap,
+            engine='fused')
+    pd.testing.assert_frame_equal(shared, uncleaned)
+    assert not fused_Qs.equals(uncleaned)
+
+def test_combined_values_are_cleaned_in_place():
+    # The combined frame's own array is cleaned without copying the frame
+    chunks, names = make_chunks(n_rows=5000,
+            spans=[(0, 2000), (1500, 4000), (3900, 5000)])
+    combined, overlap, values = Qs_combine.combine_chunks(chunks, names,
+            with_values=True)
+    expected, expected_result = Qs_clean.clean_frame(combined.copy(),
+            cutoffs, overlap, engine='pandas')
+
+    fused_Qs, fused_result = Qs_clean.clean_frame(combined, cutoffs, overlap,
+            engine='fused', values=values)
+    assert fused_Qs is combined
+    assert np.shares_memory(fused_Qs['Bedload all'].to_numpy(), values)
+    pd.testing.assert_frame_equal(fused_Qs, expected)
+    assert_results_match(fused_result, expected_result)
+
+    # An array the frame isn't built on is ignored
+    other = combined.to_numpy(copy=True)
+    cleaned, _ = Qs_clean.clean_frame(combined, cutoffs, overlap,
+            engine='fused', values=other)
+    pd.testing.assert_frame_equal(cleaned, expected)
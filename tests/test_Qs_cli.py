@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import Qs_merger_dir
+
+benchmarks_dir = os.path.join(os.path.dirname(Qs_merger_dir), 'benchmarks')
+sys.path.insert(0, benchmarks_dir)
+
+import synthetic_data
+import Qs_cli
+
+
+def test_import_is_cheap():
+    # Importing the console script must not pull in the heavy packages or
+    # make the output directories
+    code = "\n".join([
+            "import os, sys",
+            f"sys.path.insert(0, {Qs_merger_dir!r})",
+            "import settings",
+            "existed = os.path.isdir(settings.output_dir)",
+            "import Qs_cli",
+            "heavy = ['numpy', 'pandas', 'matplotlib', 'helpyr']",
+            "print(sorted(m for m in heavy if m in sys.modules))",
+            "print(existed or not os.path.isdir(settings.output_dir))",
+            ])
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+            capture_output=True, text=True).stdout.split('\n')
+    assert output[0] == '[]'
+    assert output[1] == 'True'
+
+def test_pending_work(tmp_path):
+    root_dir = str(tmp_path / 'data')
+    period_dirs = synthetic_data.write_period_tree(root_dir, n_periods=3,
+            chunks=2, rows_per_chunk=50, conflict_rate=0)
+    output_dir = str(tmp_path / 'output')
+    state = synthetic_data.write_last_run_state(root_dir, output_dir)
+    assert Qs_cli.pending_work(state) is None
+
+    # A touched txt file means a full run
+    txt_path = os.path.join(period_dirs[1], 'Qs2.txt')
+    stat = os.stat(txt_path)
+    os.utime(txt_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    index_path = os.path.join(state.Qs_raw_pickles_dir,
+            state.discovery_index_name)
+    index_stat = os.stat(index_path)
+    assert Qs_cli.pending_work(state) == f"{txt_path} is new or changed"
+    # The check doesn't rewrite the discovery index
+    assert os.stat(index_path) == index_stat
+
+    # So does a new period
+    state = synthetic_data.write_last_run_state(root_dir, output_dir)
+    new_dir = os.path.join(root_dir, 'results-T00_0000')
+    os.makedirs(new_dir)
+    open(os.path.join(new_dir, 'Qs1.txt'), 'w').close()
+    assert "new or changed" in Qs_cli.pending_work(state)
+
+    state.Qs_raw_pickles_dir = str(tmp_path / 'missing')
+    assert Qs_cli.pending_work(state) == "No previous run"
+
+def test_counts_must_be_positive(capsys):
+    parser = Qs_cli.make_parser()
+    assert parser.parse_args(['--max-in-flight', '1']).max_in_flight == 1
+    for option in ['--max-in-flight', '--workers', '--extract-workers']:
+        with pytest.raises(SystemExit):
+            parser.parse_args([option, '0'])
+        assert "must be at least 1" in capsys.readouterr().err
+
+def test_frame_cache_only_when_usable(monkeypatch):
+    import settings
+    monkeypatch.setattr(settings, 'frame_cache_bytes', 2**20)
+    parser = Qs_cli.make_parser()
+    assert Qs_cli.make_frame_cache(parser.parse_args([])) is not None
+    assert Qs_cli.make_frame_cache(parser.parse_args(['--watch'])) is not None
+    for argv in [['--workers', '2'], ['--extract-workers', '2'],
+                 ['--extract-only']]:
+        assert Qs_cli.make_frame_cache(parser.parse_args(argv)) is None
+
+    monkeypatch.setattr(settings, 'frame_cache_bytes', 0)
+    assert Qs_cli.make_frame_cache(parser.parse_args([])) is None
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+from os.path import join as pjoin
+import numpy as np
+import pandas as pd
+
+from conftest import test_data_dir
+from Qs_schema import Qs_column_names
+import Qs_combine
+
+
+def make_chunks(n_rows=200, spans=[(0, 80), (60, 140), (70, 90), (130, 200)],
+        seed=0):
+    # Chunks cover the whole period, but only have data within their span.  
+    # Outside the span the bedload/counts are zero and the D columns are nan, 
+    # like the real Qs#.txt files. The spans overlap, some rows three times.
+    rng = np.random.default_rng(seed)
+    timestamps = 3640694426.0 + np.arange(n_rows)
+    chunks, names = [], []
+    for i, (start, stop) in enumerate(spans):
+        values = np.zeros((n_rows, len(Qs_column_names)))
+        values[:, 0] = timestamps
+        values[:, 1:5] = rng.random((n_rows, 4))
+        values[:, 35:] = np.nan
+        values[start:stop, 5:] = rng.random((stop - start, 39))
+        chunks.append(pd.DataFrame(values, columns=Qs_column_names))
+        names.append(f"Qs{i+1}")
+    return chunks, names
+
+def assert_engines_match(chunks, names):
+    loop_Qs, loop_overlap = Qs_combine.combine_chunks_loop(chunks, names)
+    vec_Qs, vec_overlap = Qs_combine.combine_chunks_vectorized(chunks)
+    pd.testing.assert_frame_equal(vec_Qs, loop_Qs)
+    pd.testing.assert_series_equal(vec_overlap, loop_overlap,
+            check_names=False)
+
+def test_engines_match_synthetic():
+    chunks, names = make_chunks()
+    assert_engines_match(chunks, names)
+
+def test_engines_match_many_overlaps():
+    spans = [(s, s + 30) for s in range(0, 170, 10)]
+    chunks, names = make_chunks(spans=spans, seed=1)
+    assert_engines_match(chunks, names)
+
+def test_engines_match_sample_data():
+    period_dir = pjoin(test_data_dir, 'results-K01_0100')
+    names = ['Qs1', 'Qs2', 'Qs3']
+    chunks = [pd.read_csv(pjoin(period_dir, f"{name}.txt"), sep='\t',
+                          header=None, names=Qs_column_names)
+              for name in names]
+    assert_engines_match(chunks, names)
+
+def test_falls_back_for_mismatched_chunks():
+    chunks, names = make_chunks()
+    chunks[1] = chunks[1].iloc[:150]
+    assert not Qs_combine.can_vectorize(chunks)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+from Qs_schema import Qs_column_names
+import Qs_combine
+import Qs_diff
+from test_Qs_combine import make_chunks
+
+
+def reference_diff(raw_Qs, combined_Qs):
+    # The original dataframe difference check
+    Qs_diff = (combined_Qs != raw_Qs)
+    both_nan_rows = (combined_Qs.isnull() & raw_Qs.isnull()).any(axis=1)
+    Qs_diff.loc[both_nan_rows, :] = False
+    Qs_diff.loc[:, ['missing ratio', 'vel', 'sd vel', 'number vel']] = False
+    return Qs_diff.any(axis=1), Qs_diff.any(axis=0)
+
+def make_frames(n_rows=500, seed=0):
+    rng = np.random.default_rng(seed)
+    raw = rng.integers(0, 5, size=(n_rows, len(Qs_column_names))).astype(float)
+    combined = raw.copy()
+    # Some differences, some in excluded columns, and some nans
+    combined[rng.choice(n_rows, 20), 20] += 1
+    combined[rng.choice(n_rows, 20), 2] += 1
+    combined[rng.choice(n_rows, 30), 40] = np.nan
+    raw[rng.choice(n_rows, 30), 40] = np.nan
+    raw[rng.choice(n_rows, 10), 7] = np.nan
+    return (pd.DataFrame(raw, columns=Qs_column_names),
+            pd.DataFrame(combined, columns=Qs_column_names))
+
+def test_matches_reference():
+    raw, combined = make_frames()
+    diff_rows, diff_cols = reference_diff(raw, combined)
+    for block_rows in [7, 64, Qs_diff.default_block_rows]:
+        diff = Qs_diff.diff_frames(raw, combined, block_rows=block_rows)
+        np.testing.assert_array_equal(diff.diff_rows, diff_rows.to_numpy())
+        np.testing.assert_array_equal(diff.diff_cols, diff_cols.to_numpy())
+        assert diff.n_diff_rows == diff_rows.sum()
+
+    block = Qs_diff.get_diff_block(raw, diff)
+    pd.testing.assert_frame_equal(block, raw.loc[diff_rows, diff_cols])
+
+def test_capped_rows():
+    raw, combined = make_frames()
+    diff = Qs_diff.diff_frames(raw, combined)
+    block = Qs_diff.get_diff_block(combined, diff, max_rows=5)
+    assert len(block) == 5
+    assert list(block.index) == list(np.flatnonzero(diff.diff_rows)[:5])
+
+def test_no_difference():
+    raw, _ = make_frames()
+    assert not Qs_diff.diff_frames(raw, raw.copy()).any()
+
+def test_diff_at_rows_matches_full_diff():
+    # Qs.txt is a near copy of the only chunk, Qs1.txt
+    chunks, names = make_chunks(spans=[(0, 120)])
+    Qs1 = chunks[0]
+    Qs0 = Qs1.copy()
+    changed_rows = [3, 50, 150, 151]
+    Qs0.iloc[3, 10] += 1 # data row
+    Qs0.iloc[50, 36] = np.nan # data row, nan only in Qs.txt
+    Qs0.iloc[150, 36] = 2.0 # row without data in Qs1.txt
+    Qs0.iloc[151, 22] = 1.0 # excluded column
+    combined, _ = Qs_combine.combine_chunks_vectorized([Qs1])
+
+    full = Qs_diff.diff_frames(Qs0, combined)
+    at_rows = Qs_diff.diff_frames_at(Qs0, combined, changed_rows)
+    np.testing.assert_array_equal(at_rows.diff_rows, full.diff_rows)
+    np.testing.assert_array_equal(at_rows.diff_cols, full.diff_cols)
+    assert full.n_diff_rows > 0
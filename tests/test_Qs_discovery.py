@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import os
+import time
+
+from Qs_discovery import QsFileFinder
+
+
+def make_tree(root):
+    layout = {
+            'exp1/results-K01_0100' : ['Qs1.txt', 'Qs2.txt', 'Qs.txt',
+                                       'vel_particle.txt'],
+            'exp1/results-K01_0120' : ['Qs1.txt', 'Qs10.txt', 'image.png'],
+            'exp2/frames'           : ['allparticlesallframes.txt'],
+            'exp2/.hidden'          : ['Qs1.txt'],
+            'Qs-merger-output'      : ['Qs1.txt'],
+            }
+    for subdir, names in layout.items():
+        os.makedirs(os.path.join(root, subdir))
+        for name in names:
+            open(os.path.join(root, subdir, name), 'w').close()
+
+def age_tree(root, seconds=3600):
+    # Move every directory's mtime back, well before the first scan
+    for path, _, _ in os.walk(root):
+        mtime_ns = os.stat(path).st_mtime_ns - seconds * 10**9
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+def relative(root, paths):
+    return [os.path.relpath(p, root) for p in paths]
+
+def test_find_and_prune(tmp_path):
+    root = str(tmp_path / 'data')
+    make_tree(root)
+    finder = QsFileFinder(root)
+    found = relative(root, finder.find())
+    # The old crawl's patterns plus Qs.txt
+    assert found == ['exp1/results-K01_0100/Qs.txt',
+                     'exp1/results-K01_0100/Qs1.txt',
+                     'exp1/results-K01_0100/Qs2.txt',
+                     'exp1/results-K01_0120/Qs1.txt',
+                     'exp1/results-K01_0120/Qs10.txt']
+    assert finder.counts['dirs pruned'] == 2
+
+    threaded = QsFileFinder(root, max_workers=4)
+    assert threaded.find() == finder.find()
+
+def test_index_reuse(tmp_path):
+    root = str(tmp_path / 'data')
+    make_tree(root)
+    age_tree(root)
+    index_path = str(tmp_path / 'index.json')
+    first = QsFileFinder(root, index_path).find()
+
+    # Nothing changed, so nothing is listed again
+    finder = QsFileFinder(root, index_path)
+    assert finder.find() == first
+    assert finder.counts['dirs scanned'] == 0
+
+    # A new file only rescans its directory
+    period_dir = os.path.join(root, 'exp1', 'results-K01_0120')
+    time.sleep(0.01)
+    open(os.path.join(period_dir, 'Qs2.txt'), 'w').close()
+    finder = QsFileFinder(root, index_path)
+    found = finder.find()
+    assert os.path.join(period_dir, 'Qs2.txt') in found
+    assert len(found) == len(first) + 1
+    assert finder.counts['dirs scanned'] == 1
+
+def test_same_mtime_as_the_scan_is_rescanned(tmp_path):
+    # A coarse mtime can miss a file added just after the scan
+    root = str(tmp_path / 'data')
+    make_tree(root)
+    age_tree(root)
+    period_dir = os.path.join(root, 'exp1', 'results-K01_0120')
+    mtime_ns = time.time_ns()
+    os.utime(period_dir, ns=(mtime_ns, mtime_ns))
+    index_path = str(tmp_path / 'index.json')
+    first = QsFileFinder(root, index_path).find()
+
+    open(os.path.join(period_dir, 'Qs2.txt'), 'w').close()
+    os.utime(period_dir, ns=(mtime_ns, mtime_ns))
+    finder = QsFileFinder(root, index_path)
+    assert os.path.join(period_dir, 'Qs2.txt') in finder.find()
+    assert finder.counts['dirs scanned'] == 1
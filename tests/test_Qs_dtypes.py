@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+from Qs_schema import Qs_column_names
+from test_Qs_combine import make_chunks, assert_engines_match
+import Qs_combine
+import Qs_dtypes
+import Qs_storage
+import Qs_txt_writer
+
+
+def make_Qs_frame(n_rows=300, seed=0):
+    # Integer counts, 3 decimal masses, and some nan rows
+    rng = np.random.default_rng(seed)
+    values = np.round(rng.uniform(0, 500, size=(n_rows, len(Qs_column_names))),
+            3)
+    values[:, 0] = 1.5e9 + np.arange(n_rows)
+    values[:, 20:35] = rng.integers(0, 300, size=(n_rows, 15))
+    values[rng.choice(n_rows, 20), 5:] = np.nan
+    return pd.DataFrame(values, columns=Qs_column_names)
+
+
+def test_compact_frame():
+    data = make_Qs_frame()
+    data.loc[3, 'Count 8'] = 70000 # too big for UInt16
+    data.loc[4, 'Count 16'] = 1.5 # not a count
+    compacted = Qs_dtypes.compact_frame(data)
+
+    assert compacted['timestamp'].dtype == np.float64
+    assert compacted['Bedload all'].dtype == np.float32
+    assert str(compacted['Count 1'].dtype) == 'UInt16'
+    assert str(compacted['Count 8'].dtype) == 'Int32'
+    assert compacted['Count 16'].dtype == np.float64
+    assert compacted.memory_usage().sum() < 0.6 * data.memory_usage().sum()
+
+    # Nothing changed beyond float32 precision, and the nans are the same
+    assert Qs_dtypes.compare_frames(data, compacted, 5e-4).empty
+    pd.testing.assert_frame_equal(data.isnull(), compacted.isnull())
+
+    # Values float32 can't hold are reported
+    data.loc[0, 'D50'] = 16777217.0
+    losses = Qs_dtypes.compare_frames(data, Qs_dtypes.compact_frame(data),
+            5e-4)
+    assert list(losses.index) == ['D50']
+    assert losses.loc['D50', 'changed'] == 1
+
+def test_combine_compact_chunks():
+    # Combining compact chunks gives the compacted float64 result
+    chunks, names = make_chunks()
+    for chunk in chunks:
+        chunk.iloc[:, 20:35] = np.round(chunk.iloc[:, 20:35] * 100)
+    compact_chunks = [Qs_dtypes.compact_frame(c) for c in chunks]
+    assert_engines_match(compact_chunks, names)
+
+    expected, _ = Qs_combine.combine_chunks(chunks, names)
+    combined, _ = Qs_combine.combine_chunks(compact_chunks, names)
+    pd.testing.assert_frame_equal(combined,
+            Qs_dtypes.compact_frame(expected))
+
+def test_compact_storage_and_txt(tmp_path):
+    compacted = Qs_dtypes.compact_frame(make_Qs_frame())
+
+    path = str(tmp_path / 'frame.npyd')
+    Qs_storage.write_npy_frame(path, compacted)
+    pd.testing.assert_frame_equal(Qs_storage.read_npy_frame(path), compacted)
+
+    compacted.to_csv(tmp_path / 'old.txt')
+    txt_path = Qs_txt_writer.write_txt(compacted, str(tmp_path / 'new.txt'))
+    with open(txt_path, 'rb') as new, open(tmp_path / 'old.txt', 'rb') as old:
+        assert new.read() == old.read()
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+
+import pytest
+
+
+def test_extractor_logs_the_reader(run_settings, monkeypatch):
+    pytest.importorskip('helpyr')
+    import Qs_extractor
+    def reader_line(fast_reader=True):
+        extractor = Qs_extractor.QsExtractor(root_dir=run_settings.root_dir,
+                output_dir=run_settings.Qs_raw_pickles_dir,
+                fast_reader=fast_reader)
+        line = extractor.reader_line()
+        extractor.end()
+        return line
+
+    monkeypatch.setattr(Qs_extractor, 'fast_reader_available', lambda: True)
+    assert "pyarrow Qs reader" in reader_line()
+    assert reader_line(fast_reader=False).endswith("(turned off)")
+    monkeypatch.setattr(Qs_extractor, 'fast_reader_available', lambda: False)
+    assert reader_line().endswith("(pyarrow is not installed)")
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import Qs_fingerprint
+
+
+def write_rows(path, rows):
+    path.write_text(''.join(f"{row}\n" for row in rows))
+    return str(path)
+
+def test_compare_files(tmp_path):
+    rows = [f"{3640694426 + i}\t0.5\t{i % 7}\tNaN" for i in range(200)]
+    original = write_rows(tmp_path / 'Qs1.txt', rows)
+
+    exact = Qs_fingerprint.compare_files(
+            write_rows(tmp_path / 'exact.txt', rows), original)
+    assert exact.kind == 'exact' and len(exact.diff_rows) == 0
+
+    near_rows = list(rows)
+    near_rows[0] = near_rows[0].replace('0.5', '0.6')
+    near_rows[123] = near_rows[123].replace('NaN', '1.0')
+    near = Qs_fingerprint.compare_files(
+            write_rows(tmp_path / 'near.txt', near_rows), original)
+    assert near.kind == 'near' and near.n_rows == 200
+    np.testing.assert_array_equal(near.diff_rows, [0, 123])
+
+    # Too many different rows, or rows that don't line up
+    assert Qs_fingerprint.compare_files(str(tmp_path / 'near.txt'), original,
+            max_diff_fraction=0.005) is None
+    assert Qs_fingerprint.compare_files(
+            write_rows(tmp_path / 'short.txt', rows[1:]), original) is None
+    assert Qs_fingerprint.compare_files(
+            write_rows(tmp_path / 'blank.txt', rows[:50] + [''] + rows[51:]),
+            original) is None
+
+def test_crlf_rows_match():
+    rows = Qs_fingerprint.split_rows(b"1\t2\r\n3\t4\r\n")
+    assert rows == Qs_fingerprint.split_rows(b"1\t2\n3\t4")
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+from Qs_frame_cache import FrameCache, frame_nbytes
+
+
+def make_frame(n_rows, value=0.0):
+    return pd.DataFrame({'timestamp' : np.arange(n_rows, dtype=np.float64),
+                         'Bedload all' : np.full(n_rows, value)})
+
+def test_lru_eviction():
+    frame_bytes = frame_nbytes(make_frame(100))
+    cache = FrameCache(3 * frame_bytes)
+    for name in 'abc':
+        assert cache.put(name, make_frame(100))
+    assert cache.get('a') is not None # a is now the most recently used
+
+    cache.put('d', make_frame(100))
+    assert 'b' not in cache
+    assert all(name in cache for name in 'acd')
+    assert cache.nbytes == 3 * frame_bytes and cache.evictions == 1
+
+    # Too big for the whole budget
+    assert not cache.put('e', make_frame(1000))
+    assert 'e' not in cache and len(cache) == 3
+
+def test_take_and_link():
+    cache = FrameCache(10 * frame_nbytes(make_frame(100)))
+    data = make_frame(100, 2.0)
+    cache.put('Qs1', data)
+    assert cache.link('Qs', 'Qs1')
+    assert not cache.link('Qs2', 'missing')
+
+    assert cache.take('Qs') is data
+    assert cache.take('Qs') is None
+    assert cache.get('Qs1') is data
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache.discard('Qs1')
+    assert len(cache) == 0 and cache.nbytes == 0
+
+def test_linked_frames_count_once():
+    frame_bytes = frame_nbytes(make_frame(100))
+    cache = FrameCache(2 * frame_bytes)
+    data = make_frame(100)
+    cache.put('Qs1', data)
+    assert cache.link('Qs', 'Qs1')
+    assert cache.nbytes == frame_bytes
+
+    # The frame's bytes stay counted until its last path leaves
+    cache.put('Qs2', make_frame(100))
+    assert len(cache) == 3 and cache.evictions == 0
+    assert cache.take('Qs1') is data
+    assert cache.nbytes == 2 * frame_bytes
+    assert cache.take('Qs') is data
+    assert cache.nbytes == frame_bytes
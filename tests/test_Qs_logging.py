@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import Qs_logging
+from Qs_log_buffer import LogRecorder, replay_records
+
+
+def test_format_ranges():
+    rows = np.array([3, 4, 5, 9, 11, 12])
+    assert Qs_logging.format_ranges(rows) == "3-5, 9, 11-12"
+    assert Qs_logging.format_ranges(rows, rows + 0.5) == \
+            "3-5 (3.500000-5.500000), 9 (9.500000), 11-12 (11.500000-12.500000)"
+    assert Qs_logging.format_ranges(rows, max_ranges=1) == \
+            "3-5, ... 2 more ranges"
+    assert Qs_logging.format_ranges([]) == ""
+
+def test_buffered_logger(tmp_path):
+    log_path = str(tmp_path / 'log-files' / 'Qs.txt') # made by the logger
+    logger = Qs_logging.make_logger(log_path, 'buffered', 'info',
+            default_verbose=False)
+    logger.write("first")
+    logger.run_indented_function(lambda: logger.debug("hidden"),
+            before_msg="period")
+    logger.debug_dataframe(pd.DataFrame({'a' : [1]}), "hidden too")
+    logger.warning(["MMD", "details"])
+    logger.write_period_record({'name' : 'Qs_K01', 'errors' : ['MMD']})
+    logger.end_output()
+
+    lines = open(log_path).read().split('\n')
+    assert lines[:5] == ["first", "period", "Warning!", "MMD", "details"]
+    assert not any('hidden' in line for line in lines)
+    records = [json.loads(line) for line in
+               open(Qs_logging.records_path_for(log_path))]
+    assert [r['errors'] for r in records] == [['MMD']]
+
+def test_recorded_records_replay(tmp_path):
+    # Worker and pipeline records end up in the parent's records file
+    log_path = str(tmp_path / 'Qs.txt')
+    recorder = LogRecorder('info')
+    assert not recorder.is_enabled('debug')
+    recorder.write_period_record({'name' : 'Qs_K01', 'errors' : []})
+    recorder.debug("dropped")
+
+    logger = Qs_logging.BufferedLogger(log_path, False, 'info',
+            flush_lines=1, records_path=str(tmp_path / 'records.jsonl'))
+    replay_records(logger, recorder.pop_records())
+    logger.close()
+    assert not (tmp_path / 'Qs.txt').exists() # nothing was logged
+    assert json.loads(open(tmp_path / 'records.jsonl').read())['name'] == \
+            'Qs_K01'
+
+def test_buffered_logger_reports_write_errors(tmp_path):
+    # The log path is a directory, so every batch fails to write
+    logger = Qs_logging.BufferedLogger(str(tmp_path), False, flush_lines=1,
+            records_path=str(tmp_path / 'records.jsonl'))
+    logger.write("lost")
+    logger.write("lost too") # a write never raises
+    with pytest.raises(IsADirectoryError):
+        logger.end_output()
+
+def test_period_records_are_written_as_they_come(tmp_path):
+    log_path = str(tmp_path / 'Qs.txt')
+    records_path = Qs_logging.records_path_for(log_path)
+    with open(records_path, 'w') as records_file:
+        records_file.write('{"name" : "last run"}\n')
+
+    # A new run without any periods doesn't keep the last run's records
+    logger = Qs_logging.make_logger(log_path, 'buffered', 'info',
+            default_verbose=False)
+    assert open(records_path).read() == ''
+    logger.end_output()
+    assert open(records_path).read() == ''
+
+    # Records can be read before the logger is closed
+    logger = Qs_logging.make_logger(log_path, 'buffered', 'info',
+            default_verbose=False)
+    logger.write_period_record({'name' : 'Qs_K01', 'errors' : []})
+    logger.write_period_record({'name' : 'Qs_K02', 'errors' : ['MMD']})
+    records = [json.loads(line) for line in open(records_path)]
+    assert [r['name'] for r in records] == ['Qs_K01', 'Qs_K02']
+    logger.end_output()
+    assert len(open(records_path).readlines()) == 2
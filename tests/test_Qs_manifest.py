@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import os
+
+import Qs_manifest
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+def test_touch_is_not_a_change(tmp_path):
+    txt_path = str(tmp_path / 'Qs1.txt')
+    write(txt_path, '1.0\t2.0\n')
+    manifest = Qs_manifest.BuildManifest(str(tmp_path / 'manifest.json'))
+    manifest.record(txt_path)
+
+    stat = os.stat(txt_path)
+    os.utime(txt_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert manifest.is_unchanged(txt_path)
+
+    write(txt_path, '1.0\t3.0\n')
+    assert not manifest.is_unchanged(txt_path)
+
+def test_unknown_path_is_changed(tmp_path):
+    txt_path = str(tmp_path / 'Qs1.txt')
+    write(txt_path, '1.0\n')
+    manifest = Qs_manifest.BuildManifest(str(tmp_path / 'manifest.json'))
+    assert not manifest.is_unchanged(txt_path)
+
+def test_period_record(tmp_path):
+    inputs = [str(tmp_path / f'K01_Qs{i}.pkl') for i in [1, 2]]
+    output = str(tmp_path / 'Qs_K01.pkl')
+    for path in inputs + [output]:
+        write(path, path)
+
+    manifest_path = str(tmp_path / 'manifest.json')
+    manifest = Qs_manifest.BuildManifest(manifest_path)
+    assert manifest.is_period_current('K01', inputs) is None
+
+    manifest.update_period('K01', *manifest.make_period_record(
+        inputs, [output]))
+    manifest.save()
+
+    # Reload from disk
+    manifest = Qs_manifest.BuildManifest(manifest_path)
+    assert manifest.is_period_current('K01', inputs)
+
+    # A new chunk for the period
+    new_input = str(tmp_path / 'K01_Qs3.pkl')
+    write(new_input, 'new')
+    assert not manifest.is_period_current('K01', inputs + [new_input])
+
+    # A changed chunk
+    write(inputs[0], 'changed')
+    assert not manifest.is_period_current('K01', inputs)
+
+def test_npy_directory_hash(tmp_path):
+    frame_dir = tmp_path / 'K01_Qs1.npyd'
+    frame_dir.mkdir()
+    write(str(frame_dir / 'c000.npy'), 'a')
+    first = Qs_manifest.hash_path(str(frame_dir))
+    write(str(frame_dir / 'c000.npy'), 'b')
+    assert Qs_manifest.hash_path(str(frame_dir)) != first
+
+def test_period_manifest(tmp_path):
+    paths = {}
+    for period in ['K01', 'K02']:
+        paths[period] = [str(tmp_path / f'{period}_Qs{i}.pkl') for i in [1, 2]]
+        output = str(tmp_path / f'Qs_{period}.pkl')
+        for path in paths[period] + [output]:
+            write(path, path)
+    manifest = Qs_manifest.BuildManifest(str(tmp_path / 'manifest.json'))
+    for period in paths:
+        manifest.update_period(period, *manifest.make_period_record(
+            paths[period], [str(tmp_path / f'Qs_{period}.pkl')]))
+
+    period_manifest = manifest.period_manifest('K01', paths['K01'])
+    assert period_manifest.manifest_path is None
+    assert list(period_manifest.periods) == ['K01']
+    assert sorted(period_manifest.files) == sorted(
+            paths['K01'] + [str(tmp_path / 'Qs_K01.pkl')])
+    assert period_manifest.is_period_current('K01', paths['K01'])
+
+def test_replace_paths(tmp_path):
+    inputs, outputs = {}, {}
+    manifest = Qs_manifest.BuildManifest(str(tmp_path / 'manifest.json'))
+    for period in ['K01', 'K02']:
+        inputs[period] = [str(tmp_path / f'{period}_Qs{i}.pkl') for i in [1, 2]]
+        outputs[period] = [str(tmp_path / f'Qs_{period}.pkl')]
+        for path in inputs[period] + outputs[period]:
+            write(path, path)
+        manifest.update_period(period, *manifest.make_period_record(
+            inputs[period], outputs[period]))
+
+    # Convert every file. One of K02's inputs changed since it was recorded.
+    path_map = {path : path.replace('.pkl', '.qsmap')
+                for period in inputs for path in inputs[period] + outputs[period]}
+    for old_path, new_path in path_map.items():
+        write(new_path, 'converted ' + old_path)
+    write(inputs['K02'][1], 'changed')
+    manifest.replace_paths(path_map)
+
+    assert not any(path in manifest.files for path in path_map)
+    new_inputs = {period : [path_map[path] for path in paths]
+                  for period, paths in inputs.items()}
+    assert manifest.is_period_current('K01', new_inputs['K01'])
+    assert not manifest.is_period_current('K02', new_inputs['K02'])
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import sqlite3
+
+import pytest
+
+from Qs_metastore import MetaStore, open_metastore, share_metastore
+from Qs_metastore import Qs_file_num
+
+
+def test_add_and_lookup(tmp_path):
+    db_path = str(tmp_path / 'meta.sqlite')
+    store = MetaStore(db_path)
+    store.add_paths('/data/results-A', ['/raw/A_Qs10.pkl', '/raw/A_Qs2.pkl'])
+    store.add_paths('/data/results-B', [])
+    # Adding again only adds the new path
+    store.add_paths('/data/results-A', ['/raw/A_Qs2.pkl', '/raw/A_Qs1.npyd'])
+
+    assert list(store) == ['/data/results-A', '/data/results-B']
+    assert len(store) == 2
+    assert store['/data/results-A'] == \
+            ['/raw/A_Qs1.npyd', '/raw/A_Qs2.pkl', '/raw/A_Qs10.pkl']
+    assert store['/data/results-B'] == []
+    assert '/data/results-C' not in store
+    with pytest.raises(KeyError):
+        store['/data/results-C']
+
+    # A second connection (eg. another process) sees the same data
+    other = MetaStore(db_path)
+    other.replace_paths({'/raw/A_Qs2.pkl' : '/raw/A_Qs2.npyd'})
+    assert store['/data/results-A'][1] == '/raw/A_Qs2.npyd'
+    other.close()
+    store.close()
+
+def test_links(tmp_path):
+    db_path = str(tmp_path / 'meta.sqlite')
+    store = MetaStore(db_path)
+    store.add_paths('/data/results-A', ['/raw/A_Qs.pkl', '/raw/A_Qs1.pkl'])
+    store.set_links({'/data/results-A' : ('/raw/A_Qs.pkl', '/raw/A_Qs1.pkl',
+                                          'near', [0, 17])})
+    store.replace_paths({'/raw/A_Qs1.pkl' : '/raw/A_Qs1.npyd'})
+
+    original_path, kind, diff_rows = store.links('/data/results-A')[
+            '/raw/A_Qs.pkl']
+    assert (original_path, kind) == ('/raw/A_Qs1.npyd', 'near')
+    assert list(diff_rows) == [0, 17]
+
+    store.set_links({'/data/results-A' : None})
+    assert store.links('/data/results-A') == {}
+    store.close()
+
+def test_import_metapickle(tmp_path):
+    metapickle_path = str(tmp_path / 'Qs_metapickle.pkl')
+    metapickle = {'/data/results-A' : ['/raw/A_Qs.pkl', '/raw/A_Qs1.pkl']}
+    with open(metapickle_path, 'wb') as metapickle_file:
+        pickle.dump(metapickle, metapickle_file)
+
+    store = open_metastore(str(tmp_path / 'meta.sqlite'), metapickle_path)
+    assert dict(store.items()) == metapickle
+
+def test_file_num():
+    assert Qs_file_num('/raw/K01_0100_Qs.pkl') == 0
+    assert Qs_file_num('/raw/K01_0100_Qs12.feather') == 12
+
+def test_read_only_after_share(tmp_path):
+    db_path = str(tmp_path / 'meta.sqlite')
+    store = MetaStore(db_path)
+    store.add_paths('/data/results-A', ['/raw/A_Qs1.pkl'])
+    store.close()
+    with pytest.raises(ValueError):
+        MetaStore(db_path, read_only=True)
+
+    share_metastore(db_path)
+    assert sorted(os.listdir(tmp_path)) == ['meta.sqlite'] # no wal files
+    store = open_metastore(db_path, read_only=True)
+    assert dict(store.items()) == {'/data/results-A' : ['/raw/A_Qs1.pkl']}
+    with pytest.raises(sqlite3.OperationalError):
+        store.add_paths('/data/results-B', [])
+    store.close()
+    assert sorted(os.listdir(tmp_path)) == ['meta.sqlite']
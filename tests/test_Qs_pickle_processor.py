@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import sys
+from os.path import join as pjoin
+
+import pandas as pd
+import pytest
+
+from conftest import Qs_merger_dir
+sys.path.insert(0, os.path.join(os.path.dirname(Qs_merger_dir), 'benchmarks'))
+
+import synthetic_data
+import Qs_stats
+import Qs_storage
+
+
+def load_stats(settings):
+    if settings.stats_storage == 'append':
+        return Qs_stats.StatsLog(pjoin(settings.Qs_merged_pickles_dir,
+                f"{settings.statspickle_name}-log")).load()
+    return pd.read_pickle(pjoin(settings.Qs_merged_pickles_dir,
+            settings.statspickle_name + Qs_storage.pickle_extension))
+
+@pytest.mark.parametrize('stats_storage', ['pickle', 'append'])
+def test_failed_rebuild_drops_old_stats(run_settings, monkeypatch,
+        stats_storage):
+    pytest.importorskip('helpyr')
+    import Qs_cli
+    from Qs_pickle_processor import QsPickleProcessor
+    monkeypatch.setattr(run_settings, 'stats_storage', stats_storage)
+    period_paths = synthetic_data.write_period_tree(run_settings.root_dir,
+            n_periods=3, chunks=2, rows_per_chunk=50)
+    assert Qs_cli.main(['--force']) == 0
+    names = ['Qs_' + os.path.basename(path).replace('results-', '')
+             for path in period_paths]
+    assert sorted(load_stats(run_settings).index.unique(0)) == sorted(names)
+
+    # The first period's data changes and its rebuild fails
+    shutil.copy(pjoin(period_paths[0], 'Qs2.txt'),
+            pjoin(period_paths[0], 'Qs1.txt'))
+    merge_period = QsPickleProcessor.merge_period
+    def failing_merge(period):
+        if period.pkl_name == names[0]:
+            raise ValueError("bad data")
+        merge_period(period)
+    monkeypatch.setattr(QsPickleProcessor, 'merge_period', failing_merge)
+    assert Qs_cli.main(['--force', '--pipeline']) == 0
+    assert sorted(load_stats(run_settings).index.unique(0)) == \
+            sorted(names[1:])
+
+def test_run_closes_the_metastore(run_settings):
+    pytest.importorskip('helpyr')
+    import sqlite3
+    import Qs_extractor
+    from Qs_pickle_processor import QsPickleProcessor
+    synthetic_data.write_period_tree(run_settings.root_dir, n_periods=2,
+            chunks=2, rows_per_chunk=50)
+    run_settings.ensure_output_dirs()
+    metapickle_path = Qs_extractor.QsExtractor(
+            root_dir=run_settings.root_dir,
+            output_dir=run_settings.Qs_raw_pickles_dir).run()
+
+    processor = QsPickleProcessor(output_txt=True,
+            metapickle_path=metapickle_path)
+    processor.run()
+    with pytest.raises(sqlite3.ProgrammingError):
+        len(processor.metapickle)
+
+def test_watch_batches_compact_the_stats_log(run_settings, monkeypatch):
+    pytest.importorskip('helpyr')
+    import Qs_extractor
+    from Qs_pickle_processor import QsPickleProcessor
+    monkeypatch.setattr(run_settings, 'stats_storage', 'append')
+    monkeypatch.setattr(Qs_stats.StatsLog, 'max_parts', 2)
+    synthetic_data.write_period_tree(run_settings.root_dir, n_periods=5,
+            chunks=2, rows_per_chunk=50)
+    run_settings.ensure_output_dirs()
+    metapickle_path = Qs_extractor.QsExtractor(
+            root_dir=run_settings.root_dir,
+            output_dir=run_settings.Qs_raw_pickles_dir).run()
+
+    # One batch per period, like watch mode as the periods come in
+    processor = QsPickleProcessor(metapickle_path=metapickle_path)
+    processor.start_run()
+    processor.open_metapickle()
+    period_paths = list(processor.metapickle.keys())
+    for period_path in period_paths:
+        processor.run_periods([period_path])
+        assert 1 <= len(processor.stats_log.part_paths()) <= 2
+    processor.end_run()
+    assert len(load_stats(run_settings).index.unique(0)) == 5
+
+@pytest.mark.parametrize('start_method', ['fork', 'spawn'])
+def test_workers_match_serial_run(run_settings, monkeypatch, start_method):
+    pytest.importorskip('helpyr')
+    import functools
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    import Qs_cli
+    import Qs_pickle_processor
+    if start_method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f"no {start_method} start method here")
+    # Spawned workers only see the test settings if they are passed in
+    monkeypatch.setattr(Qs_pickle_processor, 'ProcessPoolExecutor',
+            functools.partial(ProcessPoolExecutor,
+                mp_context=multiprocessing.get_context(start_method)))
+    synthetic_data.write_period_tree(run_settings.root_dir, n_periods=4,
+            chunks=3, rows_per_chunk=200, conflict_rate=0.5)
+    txt_dir = run_settings.Qs_merged_txt_dir
+    def merged_files():
+        return {name : open(pjoin(txt_dir, name), 'rb').read()
+                for name in os.listdir(txt_dir)}
+
+    assert Qs_cli.main(['--force']) == 0
+    serial = merged_files()
+    shutil.rmtree(run_settings.output_dir)
+    assert Qs_cli.main(['--force', '--workers', '2']) == 0
+    workers = merged_files()
+    assert len(workers) == 5 # 4 periods and the summary stats
+    assert workers == serial
+
+def test_combined_frames_are_cleaned_in_place(run_settings, monkeypatch):
+    pytest.importorskip('helpyr')
+    import Qs_clean
+    import Qs_cli
+    import Qs_combine
+    synthetic_data.write_period_tree(run_settings.root_dir, n_periods=2,
+            chunks=2, rows_per_chunk=50, conflict_rate=0)
+    combined, cleaned = [], []
+    combine = Qs_combine.combine_chunk_arrays
+    def spy_combine(*args):
+        result = combine(*args)
+        combined.append(result[0])
+        return result
+    clean = Qs_clean.clean_array
+    def spy_clean(values, *args, **kwargs):
+        cleaned.append(values)
+        return clean(values, *args, **kwargs)
+    monkeypatch.setattr(Qs_combine, 'combine_chunk_arrays', spy_combine)
+    monkeypatch.setattr(Qs_clean, 'clean_array', spy_clean)
+
+    assert Qs_cli.main(['--force']) == 0
+    assert len(cleaned) == len(combined) == 2
+    assert all(c is v for c, v in zip(cleaned, combined))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+import pytest
+
+from Qs_pipeline import PeriodPipeline
+
+
+def test_order_and_failures():
+    written = []
+    def read(item):
+        if item == 2:
+            raise OSError("unreadable")
+        return item != 4 # 4 is up to date
+    def merge(item):
+        if item == 5:
+            raise ValueError("bad data")
+    def write(item):
+        time.sleep(0.01 * (item % 3))
+        written.append(item)
+
+    pipeline = PeriodPipeline(read, merge, write)
+    results = list(pipeline.run(range(8)))
+
+    assert [item for item, _ in results] == list(range(8))
+    failures = {item : f.stage for item, f in results if f is not None}
+    assert failures == {2 : 'read', 5 : 'merge'}
+    assert written == [0, 1, 3, 6, 7]
+    assert any('unreadable' in line for line in results[2][1].lines())
+
+def test_backpressure():
+    # The reader can't get more than prefetch + 1 periods ahead of the merge
+    lock = threading.Lock()
+    read, merged = [], []
+    max_ahead = []
+    def read_item(item):
+        with lock:
+            read.append(item)
+            max_ahead.append(len(read) - len(merged))
+        return True
+    def merge(item):
+        time.sleep(0.005)
+        with lock:
+            merged.append(item)
+
+    pipeline = PeriodPipeline(read_item, merge, lambda item: None,
+            prefetch=2, pending_writes=1)
+    assert len(list(pipeline.run(range(30)))) == 30
+    assert max(max_ahead) <= 2 + 2
+
+def test_fatal_error_stops_pipeline():
+    def items():
+        yield 0
+        raise RuntimeError("metastore is gone")
+
+    pipeline = PeriodPipeline(lambda item: True, lambda item: None,
+            lambda item: None)
+    with pytest.raises(RuntimeError):
+        list(pipeline.run(items()))
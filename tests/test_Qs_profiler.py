@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import csv
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from Qs_profiler import StageProfiler, frame_sizes
+
+
+def test_stage_records(tmp_path):
+    profiler = StageProfiler('test')
+    for period, sleep in [('fast', 0.0), ('slow', 0.05)]:
+        with profiler.stage('load', period) as record:
+            data = pd.DataFrame(np.zeros((100, 4)))
+            record['rows'], record['bytes'] = frame_sizes([data, None])
+        with profiler.stage('work', period):
+            time.sleep(sleep)
+    with profiler.stage('summary'):
+        pass
+
+    assert len(profiler.records) == 5
+    load = profiler.records[0]
+    assert load['rows'] == 100
+    assert load['bytes'] >= 100 * 4 * 8
+    assert all(r['wall_s'] >= 0 and r['cpu_s'] >= 0 for r in profiler.records)
+
+    totals = profiler.period_totals()
+    assert list(totals.index) == ['slow', 'fast']
+    assert totals.loc['slow', 'slowest_stage'] == 'work'
+    assert any('slow' in line for line in profiler.summary_lines())
+
+    json_path, csv_path = profiler.write_report(str(tmp_path))
+    with open(json_path) as json_file:
+        assert len(json.load(json_file)['records']) == 5
+    with open(csv_path, newline='') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    assert [r['stage'] for r in rows] == ['load', 'work'] * 2 + ['summary']
+
+    # A second report in the same second gets its own files
+    assert profiler.write_report(str(tmp_path))[0] != json_path
+    assert len(list(tmp_path.iterdir())) == 4
+
+def test_disabled():
+    profiler = StageProfiler('test', enabled=False)
+    with profiler.stage('load', 'period') as record:
+        record['rows'] = 1
+    assert profiler.records == []
+
+def test_process_wide_memory(monkeypatch):
+    # Pipelined stages run at the same time, so the peak isn't reset
+    import Qs_profiler
+    resets = []
+    monkeypatch.setattr(Qs_profiler, 'reset_peak_rss',
+            lambda: resets.append(1))
+    profiler = StageProfiler('test', stage_memory=False)
+    with profiler.stage('load', 'period'):
+        pass
+    assert resets == []
+    assert profiler.records[0]['peak_rss_scope'] == 'process'
+    assert any("process peak rss MB" in line
+               for line in profiler.summary_lines())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Qs_schema import Qs_column_names
+import Qs_query
+import Qs_storage
+
+
+# Period directories as the metastore has them: experiment/step/results-*
+period_dirs = ['/data/1A/rising-50L/results-r50L-t20',
+               '/data/1A/rising-50L/results-r50L-t40',
+               '/data/2A/rising-62L/results-r62L-t20']
+
+
+def make_merged_store(merged_dir, n_rows=100):
+    # Three merged periods in a mix of formats, plus a summary stats pickle
+    # that should be ignored
+    periods = {}
+    rng = np.random.default_rng(0)
+    for i, name in enumerate(['r50L-t20', 'r50L-t40', 'r62L-t20']):
+        values = rng.random((n_rows, len(Qs_column_names)))
+        values[:, 0] = 1000.0 * i + np.arange(n_rows)
+        values[rng.choice(n_rows, 5), 5] = np.nan
+        data = pd.DataFrame(values, columns=Qs_column_names)
+        periods[name] = data
+        path = str(merged_dir / f"Qs_{name}")
+        if i == 1:
+            data.to_pickle(f"{path}.pkl")
+        else:
+            Qs_storage.write_npy_frame(f"{path}.npyd", data)
+    periods['r50L-t20'].iloc[:2].to_pickle(merged_dir / 'Qs_summary_stats.pkl')
+    return periods
+
+
+def test_filters_and_window(tmp_path):
+    periods = make_merged_store(tmp_path)
+
+    query = Qs_query.QsQuery(str(tmp_path), fields={'experiment' : '1A'},
+            columns=['Bedload all'], start=1050, stop=1080, max_workers=2,
+            period_dirs=period_dirs)
+    assert list(query.period_paths()) == ['r50L-t20', 'r50L-t40']
+    result = query.to_frame()
+    # Only r50L-t40 has rows in the window, and the timestamp isn't kept
+    expected = periods['r50L-t40'].loc[50:79, ['Bedload all']]
+    pd.testing.assert_frame_equal(result.loc['r50L-t40'], expected)
+    assert list(result.index.levels[0]) == ['r50L-t40']
+
+    query = Qs_query.QsQuery(str(tmp_path), periods=['*-t20'])
+    assert list(query.period_paths()) == ['r50L-t20', 'r62L-t20']
+    assert query.to_array().shape == (200, len(Qs_column_names))
+
+def test_period_path_fields():
+    assert Qs_query.period_name(period_dirs[0]) == 'r50L-t20'
+    assert Qs_query.parse_period_path(period_dirs[2]) == \
+            {'experiment' : '2A', 'step' : 'rising-62L'}
+    assert Qs_query.parse_period_path('/results-t20') == \
+            {'experiment' : None, 'step' : None}
+
+def test_bad_arguments(tmp_path):
+    with pytest.raises(ValueError):
+        Qs_query.QsQuery(str(tmp_path), max_in_flight=0)
+    with pytest.raises(ValueError):
+        Qs_query.QsQuery(str(tmp_path), fields={'run' : '1'},
+                period_dirs=period_dirs)
+    with pytest.raises(ValueError):
+        # The fields come from the period directories
+        Qs_query.QsQuery(str(tmp_path), fields={'experiment' : '1A'})
+
+def test_reduce(tmp_path):
+    periods = make_merged_store(tmp_path)
+    columns = ['Bedload all', 'Count all']
+    query = Qs_query.QsQuery(str(tmp_path), columns=columns, max_in_flight=1,
+            period_dirs=period_dirs)
+
+    by_period = query.reduce('period')
+    for name, data in periods.items():
+        subset = data[columns]
+        np.testing.assert_allclose(by_period.loc[(name, 'sum')], subset.sum())
+        np.testing.assert_allclose(by_period.loc[(name, 'av')], subset.mean())
+        np.testing.assert_array_equal(by_period.loc[(name, 'nans')],
+                subset.isnull().sum())
+        np.testing.assert_array_equal(by_period.loc[(name, 'max')],
+                subset.max())
+
+    by_experiment = query.reduce('experiment')
+    exp_1A = pd.concat([periods['r50L-t20'], periods['r50L-t40']])[columns]
+    np.testing.assert_allclose(by_experiment.loc[('1A', 'min')], exp_1A.min())
+    np.testing.assert_array_equal(by_experiment.loc[('1A', 'count')],
+            exp_1A.count())
+    assert list(query.reduce(None).index.levels[0]) == ['all']
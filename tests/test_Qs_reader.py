@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+from os.path import join as pjoin
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import test_data_dir
+from Qs_schema import Qs_column_names
+import Qs_reader
+from Qs_reader import read_Qs_txt
+
+pytestmark = pytest.mark.skipif(not Qs_reader.is_available(),
+        reason="pyarrow not installed")
+
+period_dir = pjoin(test_data_dir, 'results-K01_0100')
+
+
+def test_matches_pandas_reader():
+    for name in ['Qs1.txt', 'Qs2.txt', 'Qs3.txt']:
+        filepath = pjoin(period_dir, name)
+        fast = read_Qs_txt(filepath)
+        generic = pd.read_csv(filepath, sep='\t', index_col=None, header=None,
+                names=Qs_column_names)
+        assert fast is not None
+        pd.testing.assert_frame_equal(fast, generic)
+
+def test_wraps_single_block():
+    fast = read_Qs_txt(pjoin(period_dir, 'Qs1.txt'))
+    assert fast.values.dtype == np.float64
+    assert len(fast.columns) == 44
+    assert len(fast._mgr.blocks) == 1
+
+def test_malformed_returns_none(tmp_path):
+    row = '\t'.join(['1.000'] * 44)
+    bad_files = {
+            'bad_token'     : '\n'.join([row, row.replace('1.000', 'abc', 1)]),
+            'missing_field' : '\n'.join([row, '\t'.join(['1.000'] * 43)]),
+            'empty_field'   : '\n'.join([row, row.replace('1.000', '', 1)]),
+            }
+    good_path = tmp_path / 'good.txt'
+    good_path.write_text('\n'.join([row, row]) + '\n')
+    assert read_Qs_txt(str(good_path)) is not None
+
+    for name, text in bad_files.items():
+        path = tmp_path / f'{name}.txt'
+        path.write_text(text + '\n')
+        assert read_Qs_txt(str(path)) is None, name
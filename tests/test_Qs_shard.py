@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import json
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import time
+
+import pandas as pd
+import pytest
+
+from conftest import Qs_merger_dir
+sys.path.insert(0, os.path.join(os.path.dirname(Qs_merger_dir), 'benchmarks'))
+
+import synthetic_data
+import Qs_shard
+import Qs_stats
+
+items = [f"/data/1A/rising-{n}L/t{m}" for n in (50, 62) for m in range(5)]
+
+
+def claim_all(queue_dir, node_id, results):
+    queue = Qs_shard.LeaseQueue(queue_dir, node_id, lease_seconds=60,
+            poll_interval=0.01)
+    claimed = []
+    for item in queue.claim_items(items):
+        with queue.hold(item):
+            time.sleep(0.01)
+        queue.complete(item, 'merged')
+        claimed.append(item)
+    results.put((node_id, claimed))
+
+def test_nodes_claim_each_item_once(tmp_path):
+    context = mp.get_context('fork')
+    results = context.Queue()
+    nodes = [context.Process(target=claim_all,
+                             args=(str(tmp_path), f"node{i}", results))
+             for i in range(3)]
+    for node in nodes:
+        node.start()
+    claimed = dict(results.get(timeout=30) for _ in nodes)
+    for node in nodes:
+        node.join()
+
+    all_claimed = sum(claimed.values(), [])
+    assert sorted(all_claimed) == sorted(items)
+    queue = Qs_shard.LeaseQueue(str(tmp_path), 'reduce')
+    states = queue.status(items)
+    assert all(state['status'] == 'merged' for state in states.values())
+    assert not any(f.endswith('.lease') for f in os.listdir(tmp_path))
+
+def test_expired_leases_are_taken_over(tmp_path):
+    queue = Qs_shard.LeaseQueue(str(tmp_path), 'node1')
+    dead, remote, remote_expired = items[:3]
+
+    # A process on this host that died
+    child = mp.get_context('fork').Process(target=os.getpid)
+    child.start()
+    child.join()
+    lease = dict(queue.make_lease(dead), node='crashed', pid=child.pid)
+    Qs_shard.write_json(queue.lease_path(dead), lease)
+
+    # Nodes on another host, still renewing and gone quiet
+    lease = dict(queue.make_lease(remote), node='other', host='elsewhere')
+    Qs_shard.write_json(queue.lease_path(remote), lease)
+    lease = dict(lease, item=remote_expired, expires=time.time() - 1)
+    Qs_shard.write_json(queue.lease_path(remote_expired), lease)
+
+    assert queue.claim(dead)
+    assert not queue.claim(remote)
+    assert queue.claim(remote_expired)
+    assert queue.status([remote])[remote] == 'leased'
+
+def test_heartbeat_keeps_lease(tmp_path):
+    queue = Qs_shard.LeaseQueue(str(tmp_path), 'node1', lease_seconds=0.3)
+    other = Qs_shard.LeaseQueue(str(tmp_path), 'node2', lease_seconds=0.3)
+    item = items[0]
+    assert queue.claim(item)
+    with queue.hold(item) as heartbeat:
+        time.sleep(0.6)
+        assert not other.claim(item) # still renewed
+    assert heartbeat.lost is None
+
+    time.sleep(0.4) # expired once the heartbeat stopped
+    assert other.claim(item)
+    with queue.hold(item) as heartbeat:
+        time.sleep(0.3)
+    assert isinstance(heartbeat.lost, Qs_shard.LeaseLost)
+    assert json.load(open(other.lease_path(item)))['node'] == 'node2'
+
+def test_only_one_node_takes_over_an_expired_lease(tmp_path):
+    node_a = Qs_shard.LeaseQueue(str(tmp_path), 'nodeA')
+    node_b = Qs_shard.LeaseQueue(str(tmp_path), 'nodeB')
+    item = items[0]
+    lease = dict(node_a.make_lease(item), node='gone', host='elsewhere',
+                 expires=time.time() - 1)
+    Qs_shard.write_json(node_a.lease_path(item), lease)
+
+    # Node B reads the expired lease, then node A breaks it and claims the
+    # item before B gets to break it
+    is_expired = node_b.is_expired
+    def a_claims_first(lease):
+        expired = is_expired(lease)
+        assert node_a.claim(item)
+        return expired
+    node_b.is_expired = a_claims_first
+
+    assert not node_b.claim(item)
+    assert json.load(open(node_a.lease_path(item)))['node'] == 'nodeA'
+    assert os.listdir(tmp_path) == [os.path.basename(node_a.lease_path(item))]
+    node_a.renew(item) # A still holds it
+
+def test_reduce_shards(run_settings):
+    pytest.importorskip('helpyr')
+    import Qs_manifest
+    import Qs_metastore
+    from Qs_pickle_processor import QsPickleProcessor
+
+    raw_dir = run_settings.Qs_raw_pickles_dir
+    os.makedirs(raw_dir)
+    db_path = os.path.join(raw_dir, run_settings.metastore_name)
+    metastore = Qs_metastore.MetaStore(db_path)
+    periods = [os.path.join(run_settings.root_dir, f"results-S00_000{n}")
+               for n in range(3)]
+    raw_paths = {}
+    for n, period_path in enumerate(periods):
+        raw_paths[period_path] = [os.path.join(raw_dir, f"S00_000{n}_Qs1.pkl")]
+        open(raw_paths[period_path][0], 'w').close()
+    metastore.add_periods(raw_paths)
+    metastore.close()
+    Qs_metastore.share_metastore(db_path)
+
+    queue_dir = os.path.join(raw_dir, run_settings.shard_queue_name)
+    node = Qs_shard.LeaseQueue(queue_dir, 'node1')
+    manifest = Qs_manifest.BuildManifest(os.path.join(raw_dir, 'unused.json'))
+    columns = ['Bedload all', 'Count all']
+    for n, period_path in enumerate(periods[:2]):
+        stats = Qs_stats.StatsTable()
+        stats.add_period(f"Qs_S00_000{n}", [n, n], [2 * n, 2 * n], [0, 1],
+                         columns)
+        stats.to_frame().to_pickle(node.stats_path(period_path))
+        node.complete(period_path, 'merged', {
+                'period_record' : manifest.make_period_record(
+                        raw_paths[period_path], []),
+                'raw_file_counter' : 1, 'combined_file_counter' : 1})
+
+    # One period is still being merged
+    assert node.claim(periods[2])
+    reduce_queue = Qs_shard.LeaseQueue(queue_dir, 'reduce')
+    merger = QsPickleProcessor(shard_queue=reduce_queue)
+    assert not merger.reduce_shards()
+    assert not os.path.exists(os.path.join(
+            run_settings.Qs_merged_pickles_dir, 'Qs_summary_stats.pkl'))
+
+    # It failed, so it has no stats rows or build record
+    pd.DataFrame().to_pickle(node.stats_path(periods[2]))
+    node.complete(periods[2], 'failed', {'period_record' : None,
+            'raw_file_counter' : 1, 'combined_file_counter' : 0})
+    merger = QsPickleProcessor(shard_queue=reduce_queue)
+    assert merger.reduce_shards()
+
+    summary_stats = pd.read_pickle(os.path.join(
+            run_settings.Qs_merged_pickles_dir, 'Qs_summary_stats.pkl'))
+    assert list(summary_stats.index) == [(f"Qs_S00_000{n}", stat)
+            for n in range(2) for stat in Qs_stats.stat_names]
+    assert summary_stats.loc[('Qs_S00_0001', 'sum'), 'Count all'] == 2
+    manifest = Qs_manifest.BuildManifest(os.path.join(raw_dir,
+            run_settings.manifest_name))
+    assert sorted(manifest.periods) == periods[:2]
+    assert os.listdir(queue_dir) == []
+    assert (merger.raw_file_counter, merger.combined_file_counter) == (3, 2)
+
+def test_sharded_run_matches_serial_run(run_settings, tmp_path):
+    pytest.importorskip('helpyr')
+    import Qs_cli
+    synthetic_data.write_period_tree(run_settings.root_dir, n_periods=4,
+            chunks=2, rows_per_chunk=50)
+    assert Qs_cli.main(['--extract-only']) == 0
+    run_settings.shard_poll_interval = 0.01
+    for node_id in ['node1', 'node2']:
+        assert Qs_cli.main(['--shard', node_id]) == 0
+    assert Qs_cli.main(['--reduce']) == 0
+    txt_dir = run_settings.Qs_merged_txt_dir
+    sharded = {name : open(os.path.join(txt_dir, name), 'rb').read()
+               for name in os.listdir(txt_dir)}
+
+    shutil.rmtree(run_settings.output_dir)
+    assert Qs_cli.main(['--force']) == 0
+    serial = {name : open(os.path.join(txt_dir, name), 'rb').read()
+              for name in os.listdir(txt_dir)}
+    assert len(serial) == 5 # 4 periods and the summary stats
+    assert sharded == serial
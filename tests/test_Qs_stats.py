@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+import Qs_stats
+from Qs_schema import Qs_column_names
+
+
+def make_frame(n_rows=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.random((n_rows, len(Qs_column_names))) * 100
+    values[rng.random(values.shape) < 0.1] = np.nan
+    values[:, 3] = np.nan
+    return pd.DataFrame(values, columns=Qs_column_names)
+
+def test_column_stats_match_pandas():
+    data = make_frame()
+    av, sums, nans = Qs_stats.column_stats(data)
+    np.testing.assert_array_equal(av, data.mean(axis=0).values)
+    np.testing.assert_array_equal(sums, data.sum(axis=0).values)
+    np.testing.assert_array_equal(nans, data.isnull().sum(axis=0).values)
+
+    # Any column block size gives the same sums
+    for block_values in [1, 3 * len(data), 10**9]:
+        for blocked, whole in zip(Qs_stats.column_stats(data, block_values),
+                                  (av, sums, nans)):
+            np.testing.assert_array_equal(blocked, whole)
+    row_major = Qs_stats.column_stats(np.ascontiguousarray(data.to_numpy()),
+            block_values=7 * len(data))
+    np.testing.assert_array_equal(row_major[1], sums)
+
+def test_accumulator_matches_column_stats():
+    data = make_frame()
+    accumulator = Qs_stats.ColumnStatsAccumulator(data.shape[1])
+    values = data.to_numpy()
+    for start in range(0, len(values), 700):
+        accumulator.add(values[start:start + 700])
+    for streamed, whole in zip(accumulator.get_stats(),
+                               Qs_stats.column_stats(data)):
+        np.testing.assert_allclose(streamed, whole, rtol=1e-12)
+
+def test_table_matches_from_dict():
+    stats_dict = {}
+    table = Qs_stats.StatsTable(capacity=2)
+    for i in range(5):
+        data = make_frame(100, seed=i)
+        name = f"Qs_K01_{i:04d}"
+        rows = [data.mean(axis=0), data.sum(axis=0), data.isnull().sum(axis=0)]
+        for stat, row in zip(Qs_stats.stat_names, rows):
+            stats_dict[(name, stat)] = row
+        table.add_period(name, *Qs_stats.column_stats(data), data.columns)
+
+    expected = pd.DataFrame.from_dict(stats_dict, orient='index')
+    pd.testing.assert_frame_equal(table.to_frame(), expected,
+            check_dtype=False)
+
+def test_stats_log_append_and_replace(tmp_path):
+    log = Qs_stats.StatsLog(str(tmp_path / 'stats-log'))
+    assert log.load().empty
+
+    first = Qs_stats.StatsTable()
+    first.add_period('Qs_A', np.ones(2), np.ones(2), np.zeros(2), ['a', 'b'])
+    first.add_period('Qs_B', np.ones(2), np.ones(2), np.zeros(2), ['a', 'b'])
+    log.append(first.to_frame())
+
+    # Rebuild Qs_B
+    second = Qs_stats.StatsTable()
+    second.add_period('Qs_B', np.full(2, 5.), np.ones(2), np.zeros(2),
+            ['a', 'b'])
+    log.append(second.to_frame())
+
+    stats = log.load()
+    assert len(stats) == 6
+    assert stats.loc[('Qs_B', 'av'), 'a'] == 5.
+
+    log.max_parts = 2
+    assert not log.compact_if_needed()
+    log.max_parts = 1
+    assert log.compact_if_needed()
+    assert len(log.part_paths()) == 1
+    pd.testing.assert_frame_equal(log.load(), stats)
+
+    # A rebuilt period without new rows
+    assert log.drop_periods(['Qs_A'])
+    assert not log.drop_periods(['Qs_C'])
+    assert len(log.part_paths()) == 1
+    assert list(log.load().index.unique(0)) == ['Qs_B']
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import Qs_merger_dir
+sys.path.insert(0, os.path.join(os.path.dirname(Qs_merger_dir), 'benchmarks'))
+
+import synthetic_data
+from Qs_schema import Qs_column_names
+import Qs_dtypes
+import Qs_storage
+
+
+def make_Qs_frame(n_rows=50):
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(rng.random((n_rows, len(Qs_column_names))),
+            columns=Qs_column_names)
+    data.iloc[::7, 5:] = np.nan
+    return data
+
+def is_memmap(array):
+    # Follow the chain of views back to the original array
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+def test_npy_round_trip(tmp_path):
+    data = make_Qs_frame()
+    store = Qs_storage.NpyStore(str(tmp_path))
+    assert not store.is_stored('K01_Qs1')
+
+    paths = store.save('K01_Qs1', data)
+    assert store.is_stored('K01_Qs1')
+    assert store.save('K01_Qs1', data) == []
+
+    loaded = Qs_storage.load_frame(paths[0], loader=None)
+    pd.testing.assert_frame_equal(loaded, data)
+
+def test_npy_projection_and_mmap(tmp_path):
+    data = make_Qs_frame()
+    store = Qs_storage.NpyStore(str(tmp_path))
+    path = store.save('K01_Qs1', data)[0]
+
+    columns = ['timestamp', 'Bedload all']
+    loaded = Qs_storage.load_frame(path, None, columns=columns, mmap=True)
+    assert list(loaded.columns) == columns
+    assert is_memmap(loaded['Bedload all'].to_numpy())
+    pd.testing.assert_frame_equal(loaded, data.loc[:, columns],
+            check_freq=False)
+
+def test_feather_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+    data = make_Qs_frame()
+    store = Qs_storage.FeatherStore(str(tmp_path))
+    path = store.save('Qs_K01', data)[0]
+
+    pd.testing.assert_frame_equal(Qs_storage.load_frame(path, None), data)
+    loaded = Qs_storage.load_frame(path, None, columns=['Count all'],
+            mmap=True)
+    pd.testing.assert_frame_equal(loaded, data.loc[:, ['Count all']])
+
+def test_mmap_zero_copy(tmp_path):
+    data = make_Qs_frame()
+    store = Qs_storage.MmapStore(str(tmp_path))
+    path = store.save('K01_Qs1', data)[0]
+    assert Qs_storage.read_shape(path) == data.shape
+
+    loaded = Qs_storage.load_frame(path, None, mmap=True)
+    pd.testing.assert_frame_equal(loaded, data)
+    # The whole frame is one read only view of the file
+    values = loaded.to_numpy()
+    assert is_memmap(values) and not values.flags.writeable
+
+    in_memory = Qs_storage.load_frame(path, None, columns=['Count all'])
+    assert not is_memmap(in_memory['Count all'].to_numpy())
+    pd.testing.assert_frame_equal(in_memory, data.loc[:, ['Count all']])
+
+def test_mmap_compact_round_trip(tmp_path):
+    data = Qs_dtypes.compact_frame(make_Qs_frame())
+    data.index = data.index * 2
+    path = str(tmp_path / 'K01_Qs1.qsmap')
+    Qs_storage.write_mmap_frame(path, data)
+
+    loaded = Qs_storage.read_mmap_frame(path)
+    pd.testing.assert_frame_equal(loaded, data)
+    assert is_memmap(loaded['Bedload all'].to_numpy())
+
+def test_path_format():
+    assert Qs_storage.path_format('a/K01_Qs1.pkl') == 'pickle'
+    assert Qs_storage.path_format('a/K01_Qs1.npyd') == 'npy'
+    assert Qs_storage.path_format('a/K01_Qs1.feather') == 'feather'
+    assert Qs_storage.path_format('a/K01_Qs1.qsmap') == 'mmap'
+
+def test_migrate_keeps_links_and_build_records(run_settings, monkeypatch):
+    pytest.importorskip('helpyr')
+    import Qs_cli
+    from Qs_pickle_processor import QsPickleProcessor
+    period_paths = synthetic_data.write_period_tree(run_settings.root_dir,
+            n_periods=2, chunks=2, rows_per_chunk=50, conflict_rate=0)
+    # Qs.txt is a copy of Qs1.txt, so their raw frames are linked
+    shutil.copy(os.path.join(period_paths[0], 'Qs1.txt'),
+            os.path.join(period_paths[0], 'Qs.txt'))
+    assert Qs_cli.main(['--force']) == 0
+    raw_dir = run_settings.Qs_raw_pickles_dir
+    period_name = os.path.basename(period_paths[0]).replace('results-', '')
+    assert Qs_storage.is_linked(os.path.join(raw_dir, f"{period_name}_Qs.pkl"))
+
+    monkeypatch.setattr(run_settings, 'storage_format', 'npy')
+    Qs_storage.migrate_pickle_tree('npy', delete_pickles=True)
+    linked = [os.path.join(raw_dir, f"{period_name}_Qs{n}.npyd")
+              for n in ['', '1']]
+    assert all(Qs_storage.is_linked(path) for path in linked)
+    assert os.stat(os.path.join(linked[0], 'header.json')).st_ino == \
+            os.stat(os.path.join(linked[1], 'header.json')).st_ino
+
+    # Nothing needs to be rebuilt after the migration
+    processor = QsPickleProcessor(output_txt=True)
+    processor.run()
+    assert processor.rebuilt_periods == set()
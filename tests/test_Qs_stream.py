@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+import Qs_combine
+import Qs_storage
+from Qs_stream import StreamingMerge
+from test_Qs_combine import make_chunks
+
+cutoff = 0.9
+
+
+def reference_merge(Qs0, chunks, names):
+    # The in-memory QsPickleProcessor steps written out with pandas
+    combined, overlap = Qs_combine.combine_chunks_loop(chunks, names)
+
+    Qs_diff = (combined != Qs0)
+    both_nan_rows = (combined.isnull() & Qs0.isnull()).any(axis=1)
+    Qs_diff.loc[both_nan_rows, :] = False
+    Qs_diff.loc[:, ['missing ratio', 'vel', 'sd vel', 'number vel']] = False
+    diff_rows = Qs_diff.any(axis=1)
+
+    final = combined
+    nan_rows = final.isnull().any(axis=1)
+    final.loc[nan_rows, 'missing ratio':] = np.nan
+    trim_rows = final['Bedload all'] > cutoff
+    trim_vals = final.loc[trim_rows, 'Bedload all'].values
+    final.loc[trim_rows, 'missing ratio':] = np.nan
+
+    stats = {'av' : final.mean(axis=0), 'sum' : final.sum(axis=0),
+             'nans' : final.isnull().sum(axis=0)}
+    return final, overlap, diff_rows, trim_vals, stats
+
+def test_streaming_matches_in_memory(tmp_path):
+    chunks, names = make_chunks()
+    Qs0 = chunks[0].copy()
+    Qs0.iloc[100:110, 7] += 1
+
+    final, overlap, diff_rows, trim_vals, stats = \
+            reference_merge(Qs0, chunks, names)
+
+    for block_rows in [7, 64, 1000]:
+        path = str(tmp_path / f'Qs_K01_{block_rows}.npyd')
+        merger = StreamingMerge(Qs0, chunks, block_rows, cutoff,
+                max_diff_rows=5)
+        writer = Qs_storage.NpyFrameWriter(path, merger.columns,
+                merger.n_rows)
+        merger.run([writer.write_block])
+        writer.close()
+
+        streamed = Qs_storage.read_npy_frame(path)
+        pd.testing.assert_frame_equal(streamed, final)
+        assert merger.overlap_count == overlap.sum()
+        assert merger.diff_rows_count == diff_rows.sum()
+        assert len(merger.get_diff_frames()[0]) == 5
+        np.testing.assert_array_equal(np.sort(merger.get_trim_vals()),
+                np.sort(trim_vals))
+
+        streamed_stats = merger.get_stats()
+        for stat in ['av', 'sum']:
+            pd.testing.assert_series_equal(streamed_stats[stat], stats[stat],
+                    check_names=False, rtol=1e-12)
+        pd.testing.assert_series_equal(streamed_stats['nans'], stats['nans'],
+                check_names=False)
+
+def test_can_stream():
+    assert StreamingMerge.can_stream((10, 44), [(10, 44), (10, 44)])
+    assert StreamingMerge.can_stream(None, [(10, 44)])
+    assert not StreamingMerge.can_stream((9, 44), [(10, 44)])
+    assert not StreamingMerge.can_stream(None, [])
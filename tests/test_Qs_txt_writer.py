@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import gzip
+import numpy as np
+import pandas as pd
+import pytest
+
+from Qs_schema import Qs_column_names
+import Qs_txt_writer
+
+
+def make_frame(n_rows=2000, seed=0):
+    # Qs like values with 0-3 decimals, some nans, and some odd values
+    rng = np.random.default_rng(seed)
+    shape = (n_rows, len(Qs_column_names))
+    values = np.round(rng.uniform(-50, 5000, size=shape), rng.integers(0, 4))
+    values[rng.random(shape) < 0.05] = np.nan
+    values[:, 0] = np.arange(n_rows) + 1.5e9
+    odd = [0.0, -0.0, 1e-5, 1e20, np.inf, -np.inf, 0.1 + 0.2, 1/3, 2.0**45,
+           -123.456, 0.001, 999.999, 1e16]
+    values[:len(odd), 5] = odd
+    return pd.DataFrame(values, columns=Qs_column_names)
+
+def read_bytes(path, opener=open):
+    with opener(path, 'rb') as txt_file:
+        return txt_file.read()
+
+
+def test_same_as_to_csv(tmp_path):
+    data = make_frame()
+    data.to_csv(tmp_path / 'old.txt')
+    path = Qs_txt_writer.write_txt(data, str(tmp_path / 'new.txt'))
+    assert read_bytes(path) == read_bytes(tmp_path / 'old.txt')
+
+def test_stats_frame(tmp_path):
+    # MultiIndex rows like the summary stats, with ints and floats
+    index = pd.MultiIndex.from_product([['K01-0000', 'K01,0020'],
+            ['mean', 'sum', 'nans']])
+    data = pd.DataFrame({'Bedload all' : np.arange(6) / 8,
+                         'count' : np.arange(6) - 2})
+    data.index = index
+    data.to_csv(tmp_path / 'old.txt')
+    path = Qs_txt_writer.write_txt(data, str(tmp_path / 'new.txt'))
+    assert read_bytes(path) == read_bytes(tmp_path / 'old.txt')
+
+def test_blocks_and_precision(tmp_path):
+    # Writing blocks one at a time is the same as writing the whole frame
+    data = make_frame(n_rows=1000, seed=1)
+    data.to_csv(tmp_path / 'old.txt', float_format='%.2f')
+    with Qs_txt_writer.QsTxtWriter(str(tmp_path / 'new.txt'), precision=2,
+            block_rows=64) as writer:
+        for start in range(0, len(data), 300):
+            writer.write(data.iloc[start:start + 300])
+    assert read_bytes(writer.path) == read_bytes(tmp_path / 'old.txt')
+
+def test_gzip(tmp_path):
+    data = make_frame(n_rows=300, seed=2)
+    data.to_csv(tmp_path / 'old.txt')
+    path = Qs_txt_writer.write_txt(data, str(tmp_path / 'new.txt'),
+            compression='gzip')
+    assert path.endswith('.txt.gz')
+    assert read_bytes(path, gzip.open) == read_bytes(tmp_path / 'old.txt')
+
+def test_same_as_helpyr_save_txt(tmp_path):
+    # The processor's fallback writer, called the way the processor calls it
+    data_loading = pytest.importorskip('helpyr.data_loading')
+    from Qs_log_buffer import LogRecorder
+    data = make_frame(n_rows=500, seed=3)
+    loader = data_loading.DataLoader(str(tmp_path), str(tmp_path),
+            LogRecorder())
+    loader.save_txt(data, str(tmp_path / 'old.txt'), is_path=True)
+    path = Qs_txt_writer.write_txt(data, str(tmp_path / 'new.txt'))
+    assert read_bytes(path) == read_bytes(tmp_path / 'old.txt')
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import sys
+
+import pytest
+
+from conftest import Qs_merger_dir
+sys.path.insert(0, os.path.join(os.path.dirname(Qs_merger_dir), 'benchmarks'))
+
+import synthetic_data
+import Qs_manifest
+import Qs_watch
+from Qs_discovery import QsFileFinder
+from Qs_log_buffer import LogRecorder
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as txt_file:
+        txt_file.write(text)
+
+def make_period(root, name, n_files=2):
+    period_path = os.path.join(root, f"results-{name}")
+    for n in range(1, n_files + 1):
+        write(os.path.join(period_path, f"Qs{n}.txt"), "1 2 3\n")
+    return period_path
+
+
+class FakeExtractor:
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.extracted = []
+
+    def extract_light_table(self, txt_paths):
+        self.extracted.append(txt_paths)
+
+    def end(self):
+        pass
+
+
+class FakeProcessor:
+
+    def __init__(self, failures=0):
+        self.logger = LogRecorder()
+        self.frame_cache = None
+        self.merged = []
+        self.failures = failures
+
+    def run_periods(self, period_paths):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("data root is gone")
+        self.merged.append(period_paths)
+
+
+def test_polling_detector(tmp_path):
+    root = str(tmp_path / 'data')
+    period_a = make_period(root, 'A')
+    detector = Qs_watch.PollingDetector(QsFileFinder(root))
+    assert sorted(detector.poll()) == [os.path.join(period_a, 'Qs1.txt'),
+                                       os.path.join(period_a, 'Qs2.txt')]
+    assert detector.poll() == {}
+
+    write(os.path.join(period_a, 'Qs1.txt'), "4 5 6\n")
+    period_b = make_period(root, 'B', n_files=1)
+    os.remove(os.path.join(period_a, 'Qs2.txt'))
+    changes = detector.poll()
+    assert changes[os.path.join(period_a, 'Qs1.txt')][0] == 12
+    assert changes[os.path.join(period_a, 'Qs2.txt')] is None
+    assert os.path.join(period_b, 'Qs1.txt') in changes
+    assert len(changes) == 3
+
+def test_debouncer():
+    debouncer = Qs_watch.Debouncer(settle_seconds=10,
+            empty_settle_seconds=200)
+    debouncer.update({'/A/Qs1.txt' : (6, 1), '/A/Qs2.txt' : (6, 1),
+                      '/B/Qs1.txt' : (0, 1)}, now=0)
+    assert debouncer.pop_ready(now=5) == {}
+
+    # Still being written
+    debouncer.update({'/A/Qs2.txt' : (12, 2), '/A/Qs1.txt' : (6, 1)}, now=8)
+    assert debouncer.pop_ready(now=12) == {}
+    assert debouncer.pop_ready(now=18) == \
+            {'/A' : ['/A/Qs1.txt', '/A/Qs2.txt']}
+
+    # Empty files wait longer for data
+    assert debouncer.pop_ready(now=100) == {}
+    debouncer.update({'/B/Qs1.txt' : (6, 3)}, now=100)
+    assert debouncer.pop_ready(now=110) == {'/B' : ['/B/Qs1.txt']}
+    assert debouncer.pending == {}
+
+    # but one that stays empty doesn't hold up its period for ever
+    debouncer.update({'/C/Qs1.txt' : (6, 4), '/C/Qs2.txt' : (0, 4)}, now=120)
+    assert debouncer.pop_ready(now=300) == {}
+    assert debouncer.pop_ready(now=320) == \
+            {'/C' : ['/C/Qs1.txt', '/C/Qs2.txt']}
+
+def test_watcher_merges_changed_periods(tmp_path):
+    root = str(tmp_path / 'data')
+    period_a = make_period(root, 'A')
+    period_b = make_period(root, 'B', n_files=1)
+
+    # A was merged by an earlier run
+    manifest = Qs_manifest.BuildManifest(str(tmp_path / 'manifest.json'))
+    a_paths = Qs_watch.period_Qs_files(period_a, ['Qs?.txt'])
+    for path in a_paths:
+        manifest.record(path)
+    manifest.update_period(period_a, {'inputs' : {}, 'outputs' : {}}, {})
+
+    extractor, processor = FakeExtractor(manifest), FakeProcessor()
+    watcher = Qs_watch.QsWatcher(extractor, processor,
+            Qs_watch.PollingDetector(QsFileFinder(root)), settle_seconds=10)
+    assert processor.manifest is manifest
+    assert watcher.poll_once(now=0) == []
+    assert watcher.poll_once(now=10) == [period_b]
+    assert extractor.extracted == [[os.path.join(period_b, 'Qs1.txt')]]
+
+    write(a_paths[1], "4 5 6\n")
+    assert watcher.poll_once(now=20) == []
+    assert watcher.poll_once(now=30) == [period_a]
+    assert extractor.extracted[-1] == a_paths
+    assert processor.merged == [[period_b], [period_a]]
+
+def test_watcher_retries_failed_periods(tmp_path):
+    root = str(tmp_path / 'data')
+    period_a = make_period(root, 'A')
+    manifest = Qs_manifest.BuildManifest(str(tmp_path / 'manifest.json'))
+    extractor, processor = FakeExtractor(manifest), FakeProcessor(failures=2)
+    watcher = Qs_watch.QsWatcher(extractor, processor,
+            Qs_watch.PollingDetector(QsFileFinder(root)), settle_seconds=10,
+            retry_seconds=30, max_retry_seconds=40)
+
+    assert watcher.poll_once(now=0) == []
+    assert watcher.poll_once(now=10) == [] # failed, retry at 40
+    assert watcher.poll_once(now=39) == []
+    assert watcher.poll_once(now=40) == [] # failed again, retry at 80
+    assert watcher.retries == {period_a : (2, 80)}
+    assert watcher.poll_once(now=79) == []
+    assert watcher.poll_once(now=80) == [period_a]
+    assert watcher.retries == {}
+    assert processor.merged == [[period_a]]
+
+def test_watch_command(run_settings, monkeypatch):
+    pytest.importorskip('helpyr')
+    import Qs_cli
+    synthetic_data.write_period_tree(run_settings.root_dir, n_periods=3,
+            chunks=2, rows_per_chunk=50)
+    txt_dir = run_settings.Qs_merged_txt_dir
+    assert Qs_cli.main(['--force']) == 0
+    full_run = {name : open(os.path.join(txt_dir, name), 'rb').read()
+                for name in os.listdir(txt_dir)}
+
+    # The files are already settled, so one poll merges every period
+    shutil.rmtree(run_settings.output_dir)
+    monkeypatch.setattr(run_settings, 'watch_settle_seconds', 0)
+    run = Qs_watch.QsWatcher.run
+    monkeypatch.setattr(Qs_watch.QsWatcher, 'run',
+            lambda watcher: run(watcher, max_polls=1))
+    assert Qs_cli.main(['--watch']) == 0
+    watched = {name : open(os.path.join(txt_dir, name), 'rb').read()
+               for name in os.listdir(txt_dir)}
+    assert len(watched) == 4 # 3 periods and the summary stats
+    assert watched == full_run
+    assert Qs_cli.pending_work() is None
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+import pandas as pd
+
+benchmarks_dir = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks')
+sys.path.insert(0, benchmarks_dir)
+
+import synthetic_data
+import Qs_combine
+from Qs_schema import Qs_column_names
+
+
+def test_period_shape_and_overlap():
+    Qs0, chunks = synthetic_data.make_period(chunks=3, rows_per_chunk=500,
+            overlap_fraction=0.1, with_Qs0=True, mismatch_rate=0.01)
+    n_rows = synthetic_data.period_length(3, 500, 0.1)
+    assert n_rows == 1400
+    assert len(chunks) == 3
+    for data in [Qs0] + chunks:
+        assert data.shape == (n_rows, len(Qs_column_names))
+        assert list(data.columns) == Qs_column_names
+
+    # Overlap rows are the shared rows that have data in both chunks
+    combined, overlap = Qs_combine.combine_chunks(chunks,
+            ['Qs1', 'Qs2', 'Qs3'])
+    assert 0 < overlap.sum() <= 2 * 50
+    assert combined.loc[overlap, 'Bedload all'].isnull().all()
+
+def test_tree_round_trip(tmp_path):
+    period_dirs = synthetic_data.write_period_tree(str(tmp_path), n_periods=3,
+            chunks=2, rows_per_chunk=200, conflict_rate=1.0)
+    assert len(period_dirs) == 3
+    for period_dir in period_dirs:
+        assert sorted(os.listdir(period_dir)) == \
+                ['Qs.txt', 'Qs1.txt', 'Qs2.txt']
+
+    path = os.path.join(period_dirs[0], 'Qs1.txt')
+    data = pd.read_csv(path, sep='\t', header=None, names=Qs_column_names)
+    assert data.shape == (synthetic_data.period_length(2, 200, 0.01), 44)
+    assert data['Bedload all'].notnull().all()
+    with open(path) as Qs_file:
+        assert 'NaN' in Qs_file.read()